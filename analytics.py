@@ -0,0 +1,262 @@
+"""Журнал событий воронки и его свёртка.
+
+Бот дописывает события в бинарные файлы с записями фиксированной длины
+(ANALYTICS_DIR/events-YYYYMMDD-<shard>.bin). Свёртка по дням и урокам:
+
+    python analytics.py [каталог] [--json]
+
+С numpy файлы читаются целиком как столбцы и считаются векторно; без numpy —
+тот же расчёт на массивах array, заметно медленнее, но без зависимостей.
+"""
+import argparse
+import glob
+import json
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_right
+
+from buffered import BufferedWriter
+
+# numpy нужен только свёртке: бот пишет журнал без него и не тратит время на импорт при старте
+np = None
+
+# Событие: время (float64), user_id (int64), тип (uint8), урок (uint8), значение (float32)
+RECORD = struct.Struct('<dqBB2xf')
+
+START = 1
+LESSON_SENT = 2
+WATCHED_BUTTON = 3
+WATCHED_AUTO = 4
+COMPLETED = 5
+DISCOUNT_SENT = 6
+EVENT_NAMES = {
+    START: 'start', LESSON_SENT: 'lesson_sent', WATCHED_BUTTON: 'watched_button',
+    WATCHED_AUTO: 'watched_auto', COMPLETED: 'completed', DISCOUNT_SENT: 'discount_sent',
+}
+
+# Границы распределения времени до нажатия кнопки, секунды
+CLICK_BUCKETS = (30, 60, 120, 180, 300, 450, 600, 900, 1800, 3600)
+
+
+# ========== ЗАПИСЬ ==========
+class EventLog(BufferedWriter):
+    """Буфер событий в памяти, который сбрасывается в файл пачками вне цикла событий"""
+
+    write_error = "Не удалось записать события аналитики: %s"
+
+    def __init__(self, directory, shard='0', flush_interval=1.0, max_buffer=64 * 1024, clock=time.time):
+        super().__init__(directory, flush_interval, max_buffer, clock)
+        self.shard = shard
+
+    def _new_buffer(self):
+        return bytearray()
+
+    def _count(self, batch):
+        return len(batch) // RECORD.size
+
+    def record(self, event, user_id, lesson=0, value=0.0):
+        """Добавляет событие в буфер (горячий путь: только pack в bytearray)"""
+        if not self.directory or not self._accept():
+            return
+        self._buffer += RECORD.pack(self.clock(), user_id, event, lesson, value)
+
+    def _path(self, now):
+        return os.path.join(self.directory, f"events-{time.strftime('%Y%m%d', time.gmtime(now))}-{self.shard}.bin")
+
+    def _write(self, batch):
+        # Файл выбирается по времени сброса: события на стыке суток попадают в новый день
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(self.clock()), 'ab') as f:
+            f.write(batch)
+
+
+# ========== ЧТЕНИЕ ==========
+def load_numpy():
+    """numpy или None, если он не установлен (импортируется при первом вызове)"""
+    global np
+    if np is None:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = False
+    return np or None
+
+
+def event_files(directory):
+    return sorted(glob.glob(os.path.join(directory, 'events-*.bin')))
+
+
+def load_columns(paths):
+    """Читает файлы событий в столбцы: ts, user_id, event, lesson, value"""
+    if load_numpy() is not None:
+        dtype = np.dtype([('ts', '<f8'), ('user_id', '<i8'), ('event', 'u1'),
+                          ('lesson', 'u1'), ('pad', 'V2'), ('value', '<f4')])
+        parts = [np.fromfile(path, dtype=dtype, count=os.path.getsize(path) // RECORD.size) for path in paths]
+        data = np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+        return {name: data[name] for name in ('ts', 'user_id', 'event', 'lesson', 'value')}
+
+    columns = {'ts': array('d'), 'user_id': array('q'), 'event': array('B'),
+               'lesson': array('B'), 'value': array('f')}
+    for path in paths:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        raw = raw[:len(raw) - len(raw) % RECORD.size]
+        for ts, user_id, event, lesson, value in RECORD.iter_unpack(raw):
+            columns['ts'].append(ts)
+            columns['user_id'].append(user_id)
+            columns['event'].append(event)
+            columns['lesson'].append(lesson)
+            columns['value'].append(value)
+    return columns
+
+
+# ========== СВЁРТКА ==========
+def _percentile(sorted_values, share):
+    if not len(sorted_values):
+        return None
+    return float(sorted_values[int(share * (len(sorted_values) - 1))])
+
+
+def _rollup_numpy(columns):
+    days, day_index = np.unique((columns['ts'] // 86400).astype(np.int64), return_inverse=True)
+    event = columns['event'].astype(np.int64)
+    lesson = columns['lesson'].astype(np.int64)
+    # Все счётчики за один проход: ключ (день, урок, событие) -> число событий
+    counts = np.bincount(
+        (day_index * 256 + lesson) * 8 + event, minlength=len(days) * 256 * 8
+    ).reshape(len(days), 256, 8)
+
+    # Времена до нажатия, отсортированные внутри каждой пары (день, урок)
+    clicked = event == WATCHED_BUTTON
+    groups = day_index[clicked] * 256 + lesson[clicked]
+    values = columns['value'][clicked]
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    bounds = np.searchsorted(groups, np.arange(len(days) * 256 + 1))
+
+    rows = []
+    for index, day in enumerate(days):
+        per_day = counts[index]
+        lessons = []
+        for current_lesson in np.flatnonzero(per_day[:, LESSON_SENT]):
+            group = index * 256 + current_lesson
+            clicks = values[bounds[group]:bounds[group + 1]]
+            lessons.append(_lesson_row(
+                int(current_lesson),
+                int(per_day[current_lesson, LESSON_SENT]),
+                len(clicks),
+                int(per_day[current_lesson, WATCHED_AUTO]),
+                [_percentile(clicks, share) for share in (0.5, 0.9, 0.99)],
+                np.searchsorted(clicks, CLICK_BUCKETS, side='right').tolist(),
+            ))
+        totals = per_day.sum(axis=0)
+        rows.append(_day_row(int(day), int(totals[START]), int(totals[COMPLETED]), int(totals[DISCOUNT_SENT]), lessons))
+    return rows
+
+
+def _rollup_python(columns):
+    days = {}
+    for ts, event, lesson, value in zip(columns['ts'], columns['event'], columns['lesson'], columns['value']):
+        stats = days.setdefault(int(ts // 86400), {'events': [0] * 7, 'lessons': {}})
+        stats['events'][event] += 1
+        if event in (LESSON_SENT, WATCHED_BUTTON, WATCHED_AUTO):
+            per_lesson = stats['lessons'].setdefault(lesson, {'sent': 0, 'auto': 0, 'clicks': []})
+            if event == LESSON_SENT:
+                per_lesson['sent'] += 1
+            elif event == WATCHED_AUTO:
+                per_lesson['auto'] += 1
+            else:
+                per_lesson['clicks'].append(value)
+    rows = []
+    for day in sorted(days):
+        stats = days[day]
+        lessons = []
+        for lesson in sorted(stats['lessons']):
+            per_lesson = stats['lessons'][lesson]
+            if not per_lesson['sent']:
+                continue
+            clicks = sorted(per_lesson['clicks'])
+            lessons.append(_lesson_row(
+                lesson, per_lesson['sent'], len(clicks), per_lesson['auto'],
+                [_percentile(clicks, share) for share in (0.5, 0.9, 0.99)],
+                [bisect_right(clicks, bound) for bound in CLICK_BUCKETS],
+            ))
+        events = stats['events']
+        rows.append(_day_row(day, events[START], events[COMPLETED], events[DISCOUNT_SENT], lessons))
+    return rows
+
+
+def _lesson_row(lesson, sent, clicked, auto, percentiles, cumulative):
+    return {
+        'lesson': lesson,
+        'sent': sent,
+        'watched_button': clicked,
+        'watched_auto': auto,
+        'click_rate': clicked / sent if sent else 0.0,
+        'time_to_click_p50': percentiles[0],
+        'time_to_click_p90': percentiles[1],
+        'time_to_click_p99': percentiles[2],
+        # Доля нажатий не позже каждой границы CLICK_BUCKETS
+        'clicks_within': {bound: count / clicked if clicked else 0.0
+                          for bound, count in zip(CLICK_BUCKETS, cumulative)},
+    }
+
+
+def _day_row(day, starts, completed, discounts, lessons):
+    return {
+        'day': time.strftime('%Y-%m-%d', time.gmtime(day * 86400)),
+        'starts': starts,
+        'completed': completed,
+        'completion_rate': completed / starts if starts else 0.0,
+        'discount_sent': discounts,
+        'lessons': lessons,
+    }
+
+
+def rollup(columns):
+    """Свёртка по дням (UTC) и урокам: конверсия и распределение времени до нажатия"""
+    if load_numpy() is not None and isinstance(columns['ts'], np.ndarray):
+        return _rollup_numpy(columns)
+    return _rollup_python(columns)
+
+
+def print_rollup(rows):
+    for row in rows:
+        print(f"{row['day']}: /start {row['starts']}, прошли курс {row['completed']} "
+              f"({row['completion_rate']:.1%}), напоминаний о скидке {row['discount_sent']}")
+        for lesson in row['lessons']:
+            p50, p90 = lesson['time_to_click_p50'], lesson['time_to_click_p90']
+            timing = f", до нажатия p50={p50:.0f} с p90={p90:.0f} с" if p50 is not None else ''
+            print(f"  урок {lesson['lesson']}: отправлен {lesson['sent']}, кнопкой {lesson['watched_button']} "
+                  f"({lesson['click_rate']:.1%}), по таймеру {lesson['watched_auto']}{timing}")
+            if lesson['watched_button']:
+                within = ', '.join(f"≤{bound}с {share:.0%}" for bound, share in lesson['clicks_within'].items())
+                print(f"    нажали: {within}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Свёртка журнала событий воронки')
+    parser.add_argument('directory', nargs='?', default=os.getenv('ANALYTICS_DIR', 'analytics'))
+    parser.add_argument('--json', action='store_true', help='вывести результат в JSON')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    paths = event_files(args.directory)
+    columns = load_columns(paths)
+    loaded = time.perf_counter()
+    rows = rollup(columns)
+    finished = time.perf_counter()
+
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+    else:
+        print_rollup(rows)
+        print(f"\nсобытий: {len(columns['ts'])} из {len(paths)} файлов, чтение {loaded - started:.2f} с, "
+              f"свёртка {finished - loaded:.2f} с ({'numpy' if load_numpy() is not None else 'без numpy'})")
+
+
+if __name__ == '__main__':
+    main()
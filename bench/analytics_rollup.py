@@ -0,0 +1,102 @@
+"""Скорость свёртки журнала событий воронки.
+
+Запуск: python -m bench.analytics_rollup [--users N] [--days D]
+
+Генерирует синтетический журнал (start, уроки, нажатия с временем до клика,
+авто-переходы, завершения, напоминания о скидке) во временный каталог и
+замеряет чтение и свёртку analytics.py — с numpy, если он установлен, и на
+массивах array без него.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import analytics
+
+LESSONS = 3
+
+
+def generate(directory, users, days, seed=1):
+    """Пишет журнал по дневным файлам; возвращает число событий"""
+    rng = random.Random(seed)
+    pack = analytics.RECORD.pack
+    start_day = int(time.time() // 86400) - days
+    total = 0
+    for day in range(days):
+        buffer = bytearray()
+        base = (start_day + day) * 86400
+        for user_id in range(day * users, (day + 1) * users):
+            ts = base + rng.random() * 80000
+            buffer += pack(ts, user_id, analytics.START, 0, 0.0)
+            for lesson in range(1, LESSONS + 1):
+                buffer += pack(ts, user_id, analytics.LESSON_SENT, lesson, 0.0)
+                if lesson == LESSONS:
+                    buffer += pack(ts + 5, user_id, analytics.COMPLETED, 0, 0.0)
+                    if rng.random() < 0.9:
+                        buffer += pack(ts + 75600, user_id, analytics.DISCOUNT_SENT, 0, 0.0)
+                    break
+                if rng.random() < 0.15:
+                    # Пользователь ушёл, не дождавшись авто-перехода
+                    break
+                if rng.random() < 0.7:
+                    waited = rng.lognormvariate(5, 0.8)
+                    buffer += pack(ts + waited, user_id, analytics.WATCHED_BUTTON, lesson, waited)
+                    ts += waited
+                else:
+                    ts += 600
+                    buffer += pack(ts, user_id, analytics.WATCHED_AUTO, lesson, 0.0)
+        total += len(buffer) // analytics.RECORD.size
+        path = os.path.join(directory, f"events-{time.strftime('%Y%m%d', time.gmtime(base))}-0.bin")
+        with open(path, 'ab') as f:
+            f.write(buffer)
+    return total
+
+
+def measure(directory):
+    started = time.perf_counter()
+    columns = analytics.load_columns(analytics.event_files(directory))
+    loaded = time.perf_counter()
+    rows = analytics.rollup(columns)
+    finished = time.perf_counter()
+    return rows, loaded - started, finished - loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50_000, help='новых пользователей в день')
+    parser.add_argument('--days', type=int, default=30)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        total = generate(directory, args.users, args.days)
+        size = sum(os.path.getsize(path) for path in analytics.event_files(directory))
+        print(f"событий: {total}, {size / 2**20:.1f} МБ, генерация {time.perf_counter() - started:.1f} с")
+
+        numpy = analytics.load_numpy()
+        variants = [('numpy', numpy)] if numpy is not None else []
+        # False — numpy «не установлен»: свёртка идёт на массивах array
+        variants.append(('без numpy', False))
+        results = []
+        for name, module in variants:
+            saved, analytics.np = analytics.np, module
+            try:
+                rows, load_time, rollup_time = measure(directory)
+            finally:
+                analytics.np = saved
+            results.append(rows)
+            print(f"{name:<10} чтение {load_time:6.2f} с, свёртка {rollup_time:6.2f} с, "
+                  f"{total / (load_time + rollup_time):,.0f} событий/с")
+
+        last = max(results[-1], key=lambda row: row['starts'])
+        print(f"\nдень {last['day']}: /start {last['starts']}, "
+              f"прошли {last['completion_rate']:.1%}")
+        for lesson in last['lessons']:
+            print(f"  урок {lesson['lesson']}: нажали {lesson['click_rate']:.1%}, "
+                  f"p50 {lesson['time_to_click_p50'] or 0:.0f} с, p90 {lesson['time_to_click_p90'] or 0:.0f} с")
+
+
+if __name__ == '__main__':
+    main()
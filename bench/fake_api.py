@@ -0,0 +1,159 @@
+"""Локальная замена Telegram Bot API для нагрузочных тестов.
+
+Отвечает на методы, которые использует бот, с настраиваемой задержкой, долей
+ответов 429 (Flood control) и долей ошибок сервера. Боту достаточно указать
+base_url=f'http://127.0.0.1:{port}/bot'.
+"""
+import asyncio
+import itertools
+import json
+import random
+import re
+import time
+from urllib.parse import parse_qs
+
+from http_server import HttpServer, Response
+
+FAKE_TOKEN = '123456:FAKE-TOKEN-FOR-LOAD-TESTS'
+
+METHODS = (
+    'getMe', 'sendMessage', 'sendVideo', 'sendVideoNote', 'sendDocument', 'editMessageText',
+    'editMessageCaption', 'editMessageReplyMarkup', 'answerCallbackQuery', 'setWebhook',
+    'deleteWebhook', 'getUpdates', 'close', 'logOut',
+)
+
+_MULTIPART_FIELD = re.compile(rb'name="(\w+)"\r\n\r\n([^\r]*)\r\n')
+
+
+def _parse_params(request):
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        # Файлы не разбираем, нужны только простые поля
+        return {name.decode(): value.decode() for name, value in _MULTIPART_FIELD.findall(request.body)}
+    if content_type.startswith('application/json'):
+        return json.loads(request.body or b'{}')
+    return {key: values[0] for key, values in parse_qs(request.body.decode()).items()}
+
+
+class FakeBotApi:
+    """HTTP сервер, имитирующий Bot API"""
+
+    def __init__(self, token=FAKE_TOKEN, latency=0.02, jitter=0.01, flood_rate=0.0,
+                 failure_rate=0.0, retry_after=1, seed=None, host='127.0.0.1', port=0,
+                 blocked_chats=()):
+        self.token = token
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        # Чаты, где пользователь заблокировал бота: отправка отвечает 403
+        self.blocked_chats = set(blocked_chats)
+        self.rng = random.Random(seed)
+        self.server = HttpServer(host, port, max_body_size=64 * 1024 * 1024)
+        for method in METHODS:
+            self.server.route('POST', f'/bot{token}/{method}', self._handler(method))
+            self.server.route('GET', f'/bot{token}/{method}', self._handler(method))
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        # Статистика
+        self.calls = {}
+        self.flooded = 0
+        self.failed = 0
+        self.forbidden = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.sent_by_chat = {}
+
+    @property
+    def base_url(self):
+        return f'http://{self.server.host}:{self.server.port}/bot'
+
+    async def start(self):
+        await self.server.start()
+
+    async def stop(self):
+        await self.server.stop()
+
+    def _handler(self, method):
+        async def handle(request):
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                delay = self.latency + self.rng.uniform(0, self.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                return self._respond(method, _parse_params(request))
+            finally:
+                self.in_flight -= 1
+        return handle
+
+    def _error(self, status, description, **parameters):
+        body = {'ok': False, 'error_code': status, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+        return Response(status, json.dumps(body), 'application/json')
+
+    def _respond(self, method, params):
+        if method not in ('getMe', 'getUpdates', 'setWebhook', 'deleteWebhook', 'close', 'logOut'):
+            if self.rng.random() < self.flood_rate:
+                self.flooded += 1
+                return self._error(
+                    429, f'Too Many Requests: retry after {self.retry_after}',
+                    retry_after=self.retry_after
+                )
+            if self.rng.random() < self.failure_rate:
+                self.failed += 1
+                return self._error(500, 'Internal Server Error')
+            if self.blocked_chats and int(params.get('chat_id') or 0) in self.blocked_chats:
+                self.forbidden += 1
+                return self._error(403, 'Forbidden: bot was blocked by the user')
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot',
+                      'can_join_groups': False, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': False}
+        elif method in ('answerCallbackQuery', 'setWebhook', 'deleteWebhook', 'close', 'logOut'):
+            result = True
+        elif method == 'getUpdates':
+            result = []
+        else:
+            result = self._message(method, params)
+        return Response(200, json.dumps({'ok': True, 'result': result}), 'application/json')
+
+    def _message(self, method, params):
+        chat_id = int(params.get('chat_id') or 0)
+        chat_times = self.sent_by_chat.setdefault(chat_id, [])
+        chat_times.append(time.monotonic())
+        message = {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if params.get('caption'):
+            message['caption'] = params['caption']
+        if method == 'sendVideo':
+            message['video'] = {'file_id': f'video-{next(self._file_ids)}', 'file_unique_id': 'v',
+                                'width': 640, 'height': 640, 'duration': 1}
+        elif method == 'sendVideoNote':
+            message['video_note'] = {'file_id': f'note-{next(self._file_ids)}', 'file_unique_id': 'n',
+                                     'length': 640, 'duration': 1}
+        elif method == 'sendDocument':
+            message['document'] = {'file_id': f'doc-{next(self._file_ids)}', 'file_unique_id': 'd'}
+        if params.get('reply_markup'):
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        return message
+
+    def max_chat_burst(self, window=1.0):
+        """Наибольшее число сообщений в один чат за окно window секунд"""
+        worst = 0
+        for times in self.sent_by_chat.values():
+            start = 0
+            for end, moment in enumerate(times):
+                while moment - times[start] > window:
+                    start += 1
+                worst = max(worst, end - start + 1)
+        return worst
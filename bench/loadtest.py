@@ -0,0 +1,271 @@
+"""Нагрузочный тест воронки без настоящего токена.
+
+Запуск: python -m bench.loadtest --users 2000 --arrival 20 --auto-next 2
+
+Поднимает FakeBotApi, собирает приложение бота с base_url на него и прогоняет
+пользователей через /start и кнопки «Я посмотрел видео» с укороченными таймерами.
+Печатает пропускную способность, p50/p95/p99 времени обработчиков, память на
+активного пользователя и задержку цикла событий.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import time
+import tracemalloc
+
+from bench.fake_api import FAKE_TOKEN, FakeBotApi
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', FAKE_TOKEN)
+os.environ.setdefault('STATE_BACKEND', 'memory')
+
+import bot  # noqa: E402  (после настройки окружения)
+from sender import OutboundDispatcher  # noqa: E402
+from telegram import Update  # noqa: E402
+
+TIMED_HANDLERS = ('start', 'button_handler', 'send_video', 'send_final_video')
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values) * 1000 if values else 0.0,
+    }
+
+
+def instrument(latencies):
+    """Оборачивает обработчики бота замером времени (до build_application)"""
+    for name in TIMED_HANDLERS:
+        original = getattr(bot, name)
+        samples = latencies.setdefault(name, [])
+
+        async def timed(*args, _original=original, _samples=samples, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await _original(*args, **kwargs)
+            finally:
+                _samples.append(time.perf_counter() - started)
+
+        timed.__name__ = original.__name__
+        setattr(bot, name, timed)
+
+
+async def monitor_loop_lag(samples, stop_event, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while not stop_event.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+def start_update(update_id, user_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'}, 'from': user, 'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+def click_update(update_id, user_id, lesson, message_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': str(user_id),
+            'data': f'watched_{lesson}',
+            'message': {'message_id': message_id, 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'}, 'text': 'button'},
+        },
+    }
+
+
+async def simulate_user(application, user_id, args, rng, counter, done):
+    """Один пользователь: /start, затем по каждому уроку либо клик, либо ожидание авто-перехода"""
+    def put(data):
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+    put(start_update(next(counter), user_id))
+    for lesson in range(1, bot.course.last):
+        # Ждём, пока придёт кнопка урока
+        while True:
+            session = bot.user_states.get(user_id)
+            if session is not None and session.button_lesson >= lesson:
+                break
+            await asyncio.sleep(0.05)
+        if rng.random() < args.click_rate:
+            await asyncio.sleep(rng.uniform(0, args.think))
+            session = bot.user_states.get(user_id)
+            if session is not None and session.current_video == lesson and session.button_lesson == lesson:
+                put(click_update(next(counter), user_id, lesson, session.button_msg))
+    while True:
+        session = bot.user_states.get(user_id)
+        if session is not None and session.completed:
+            break
+        await asyncio.sleep(0.1)
+    done.append(user_id)
+
+
+async def run(args):
+    latencies = {}
+    lag = []
+    instrument(latencies)
+    bot.AUTO_NEXT_DELAY = args.auto_next
+    bot.DISCOUNT_REMINDER_DELAY = args.discount
+    bot.outbound = OutboundDispatcher(global_rate=args.global_rate, workers=args.send_workers)
+
+    api = FakeBotApi(latency=args.latency, jitter=args.jitter, flood_rate=args.flood_rate,
+                     failure_rate=args.failure_rate, seed=args.seed)
+    await api.start()
+
+    options = {'base_url': api.base_url, 'updater': None}
+    if args.concurrent_updates is not None:
+        options['concurrent_updates'] = args.concurrent_updates
+    application = bot.build_application(**options)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    stop_event = asyncio.Event()
+    lag_task = asyncio.create_task(monitor_loop_lag(lag, stop_event))
+    if args.tracemalloc:
+        tracemalloc.start()
+    gc.collect()
+    baseline_traced = tracemalloc.get_traced_memory()[0] if args.tracemalloc else 0
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    rng = random.Random(args.seed)
+    counter = iter(range(1, 10 ** 9))
+    done = []
+    started = time.perf_counter()
+    users = []
+    peak_active = 0
+    peak_traced = 0
+    for index in range(args.users):
+        users.append(asyncio.create_task(
+            simulate_user(application, 10 ** 6 + index, args, rng, counter, done)
+        ))
+        await asyncio.sleep(1 / args.arrival)
+        active = len(bot.user_states)
+        if active > peak_active:
+            peak_active = active
+            if args.tracemalloc:
+                peak_traced = max(peak_traced, tracemalloc.get_traced_memory()[0])
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*users), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+    if args.tracemalloc:
+        peak_traced = max(peak_traced, tracemalloc.get_traced_memory()[1])
+    peak_active = max(peak_active, len(bot.user_states))
+    rss_delta_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss
+
+    stop_event.set()
+    await lag_task
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await api.stop()
+
+    api_calls = sum(api.calls.values())
+    report = {
+        'users': args.users,
+        'completed': len(done),
+        'elapsed_s': elapsed,
+        'funnels_per_s': len(done) / elapsed,
+        'api_calls': api.calls,
+        'api_calls_per_s': api_calls / elapsed,
+        'api_flooded': api.flooded,
+        'api_failed': api.failed,
+        'max_chat_burst_1s': api.max_chat_burst(),
+        'handlers': {name: summarize(values) for name, values in latencies.items()},
+        'peak_active_users': peak_active,
+        'rss_growth_per_user_kb': rss_delta_kb / max(1, peak_active),
+        'loop_lag': summarize(lag),
+        'outbound': bot.outbound.stats(),
+    }
+    if args.tracemalloc:
+        report['traced_bytes_per_user'] = (peak_traced - baseline_traced) / max(1, peak_active)
+    return report
+
+
+def print_report(report):
+    print(f"пользователей: {report['users']}, завершили воронку: {report['completed']} "
+          f"за {report['elapsed_s']:.1f} с ({report['funnels_per_s']:.1f}/с)")
+    print(f"вызовов Bot API: {sum(report['api_calls'].values())} "
+          f"({report['api_calls_per_s']:.1f}/с), 429: {report['api_flooded']}, "
+          f"ошибок: {report['api_failed']}, макс. сообщений в чат за 1 с: {report['max_chat_burst_1s']}")
+    for method, count in sorted(report['api_calls'].items()):
+        print(f"  {method:<24}{count}")
+    outbound = report['outbound']
+    print(f"очередь отправки: повторов {outbound['retries']}, исчерпали повторы {outbound['gave_up']}, "
+          f"макс. запросов в ожидании ответа {outbound['in_request_max']} (пул {bot.API_POOL_SIZE}), "
+          f"размыкатель {outbound['breaker']}, отклонено {outbound['breaker_rejected']}")
+    print("обработчики (мс):")
+    for name, stats in report['handlers'].items():
+        print(f"  {name:<18} n={stats['count']:<6} p50={stats['p50_ms']:8.1f} "
+              f"p95={stats['p95_ms']:8.1f} p99={stats['p99_ms']:8.1f} max={stats['max_ms']:8.1f}")
+    lag = report['loop_lag']
+    print(f"задержка цикла событий (мс): p50={lag['p50_ms']:.1f} p99={lag['p99_ms']:.1f} max={lag['max_ms']:.1f}")
+    print(f"активных пользователей на пике: {report['peak_active_users']}, "
+          f"рост RSS на пользователя: {report['rss_growth_per_user_kb']:.2f} КБ")
+    if 'traced_bytes_per_user' in report:
+        print(f"память Python на пользователя (tracemalloc): {report['traced_bytes_per_user']:.0f} байт")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--arrival', type=float, default=50, help='новых пользователей в секунду')
+    parser.add_argument('--click-rate', type=float, default=0.7, help='доля уроков, где нажимают кнопку')
+    parser.add_argument('--think', type=float, default=1.0, help='макс. пауза перед нажатием, с')
+    parser.add_argument('--auto-next', type=float, default=2.0, help='вместо 600 с авто-перехода')
+    parser.add_argument('--discount', type=float, default=5.0, help='вместо 21 ч до напоминания')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа Bot API, с')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--global-rate', type=float, default=1000,
+                        help='глобальный лимит отправки (в Telegram 30/с; фейковый API не ограничен)')
+    parser.add_argument('--send-workers', type=int, default=64)
+    parser.add_argument('--concurrent-updates', type=int, default=None,
+                        help='параллельная обработка апдейтов (по умолчанию как в боте)')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--tracemalloc', action='store_true', help='точный замер памяти (медленнее)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='вывести отчёт в JSON')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Пропускная способность логов и их цена для цикла событий.
+
+Запуск: python -m bench.logging_throughput [--records N]
+
+Сравнивает синхронный StreamHandler (как было с basicConfig) и очередь из
+logs.setup_logging: сколько стоит вызов logger.info в потоке цикла событий и
+сколько записей в секунду успевает вывести поток записи. Вывод идёт в
+os.devnull, чтобы мерить форматирование, а не терминал.
+"""
+import argparse
+import logging
+import os
+import time
+
+import logs
+
+logger = logging.getLogger('bench.logging')
+
+
+class SlowStream:
+    """Вывод, который блокируется на каждой записи (переполненный pipe stderr у хостинга)"""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+
+def _emit(count, error_every=0):
+    started = time.perf_counter()
+    for index in range(count):
+        if error_every and index % error_every == 0:
+            # Повторяющаяся ошибка, как у заблокировавших бота пользователей
+            logger.error("Forbidden: bot was blocked by the user (чат %s)", index, extra={'event': 'blocked'})
+        else:
+            logger.info("Видео %s отправлено по file_id", index % 3 + 1,
+                        extra={'event': 'video_sent', 'user_id': index, 'lesson': index % 3 + 1})
+    return time.perf_counter() - started
+
+
+def _reset_root():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for key in logs.stats:
+        logs.stats[key] = 0
+
+
+def _report(name, count, caller, total):
+    print(f"{name:<28} вызов: {caller / count * 1e6:6.2f} мкс, "
+          f"всего до вывода последней записи: {count / total:9.0f} записей/с, "
+          f"выведено {logs.stats['written'] or count}, отсеяно "
+          f"{logs.stats['sampled_out'] + logs.stats['rate_limited']}, отброшено {logs.stats['dropped']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=100_000)
+    args = parser.parse_args()
+    count = args.records
+
+    with open(os.devnull, 'w') as devnull:
+        _reset_root()
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+        logging.getLogger().addHandler(handler)
+        logging.getLogger().setLevel(logging.INFO)
+        elapsed = _emit(count)
+        _report('синхронно, текст', count, elapsed, elapsed)
+
+        for name, kwargs in (
+            ('очередь, текст', {'json_format': False, 'rate': 0}),
+            ('очередь, JSON', {'json_format': True, 'rate': 0}),
+            ('очередь, JSON, выборка 10%', {'json_format': True, 'rate': 0, 'sample': {'video_sent': 0.1}}),
+        ):
+            _reset_root()
+            started = time.perf_counter()
+            listener = logs.setup_logging(logging.INFO, stream=devnull, queue_size=count + 1, **kwargs)
+            elapsed = _emit(count)
+            listener.stop()
+            _report(name, count, elapsed, time.perf_counter() - started)
+
+        # Ограничение частоты: каждая десятая запись — одна и та же ошибка
+        _reset_root()
+        started = time.perf_counter()
+        listener = logs.setup_logging(logging.INFO, json_format=True, stream=devnull, queue_size=count + 1,
+                                      sample={'video_sent': 0.1}, rate=5, burst=20)
+        elapsed = _emit(count, error_every=10)
+        listener.stop()
+        _report('JSON, выборка, лимит ошибок', count, elapsed, time.perf_counter() - started)
+
+    # Медленный вывод: синхронный обработчик держит цикл событий на каждой записи
+    slow = SlowStream(0.0002)
+    burst = min(count, 2000)
+    _reset_root()
+    handler = logging.StreamHandler(slow)
+    logging.getLogger().addHandler(handler)
+    elapsed = _emit(burst)
+    _report('медленный вывод, синхронно', burst, elapsed, elapsed)
+    _reset_root()
+    started = time.perf_counter()
+    listener = logs.setup_logging(logging.INFO, json_format=True, stream=slow, rate=0)
+    elapsed = _emit(burst)
+    listener.stop()
+    _report('медленный вывод, очередь', burst, elapsed, time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Цена инструментации на горячем пути.
+
+Запуск: python -m bench.metrics_overhead
+
+Сравнивает пустую корутину с обёрнутой в metrics.instrument и меряет отдельные
+операции (inc, observe, render), чтобы накладные расходы оставались в пределах
+долей микросекунды на вызов обработчика.
+"""
+import asyncio
+import time
+import timeit
+
+from metrics import Counter, Histogram, Registry, instrument
+
+
+async def _noop():
+    return None
+
+
+def _per_call_ns(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e9
+
+
+def main():
+    registry = Registry()
+    counter = Counter('bench_total', 'bench', ('handler',), registry=registry).labels('x')
+    histogram = Histogram('bench_seconds', 'bench', ('handler',), registry=registry).labels('x')
+    wrapped = instrument('bench_handler')(_noop)
+    number = 200_000
+
+    print(f"counter.inc:           {_per_call_ns(counter.inc, number):7.1f} нс")
+    print(f"histogram.observe:     {_per_call_ns(lambda: histogram.observe(0.042), number):7.1f} нс")
+    print(f"time.perf_counter:     {_per_call_ns(time.perf_counter, number):7.1f} нс")
+
+    async def drive(coro_func, count):
+        started = time.perf_counter()
+        for _ in range(count):
+            await coro_func()
+        return time.perf_counter() - started
+
+    loop = asyncio.new_event_loop()
+    try:
+        plain = min(loop.run_until_complete(drive(_noop, number)) for _ in range(5))
+        timed = min(loop.run_until_complete(drive(wrapped, number)) for _ in range(5))
+    finally:
+        loop.close()
+    print(f"корутина без метрик:   {plain / number * 1e9:7.1f} нс")
+    print(f"корутина с instrument: {timed / number * 1e9:7.1f} нс "
+          f"(+{(timed - plain) / number * 1e9:.1f} нс на вызов)")
+
+    for index in range(50):
+        Counter(f'bench_extra_{index}_total', 'bench', ('lesson',), registry=registry).labels(1).inc()
+    print(f"render (52 метрики):   {_per_call_ns(registry.render, 2_000) / 1000:7.1f} мкс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""Воспроизведение записанных апдейтов (recorder.py) против FakeBotApi.
+
+Запуск: python -m bench.replay UPDATES_RECORD_DIR [--speed 1] [--profile replay.prof]
+
+Апдейты подаются в очередь приложения в записанном порядке и с записанными
+интервалами, ускоренными в --speed раз. Таймеры бота (авто-переход через 600 с,
+напоминание о скидке через 21 ч) идут по виртуальным часам: планировщик не
+запускается, его таймеры срабатывают через fire_due, а простой дольше
+--skip-idle виртуальных секунд, когда бот ничего не делает, пропускается.
+Лимиты очереди отправки и задержки Bot API остаются в реальном времени, поэтому
+ускоренное воспроизведение — это нагрузка в --speed раз выше записанной, а
+нажатия могут прийти раньше, чем бот успел отправить урок (в записи они шли
+после него). Для сравнения с продакшеном — --speed 1.
+
+После апдейтов воспроизведение продолжается ещё --tail виртуальных секунд,
+чтобы сработали отложенные таймеры. Отчёт — как у bench.loadtest; --profile
+сохраняет профиль cProfile для snakeviz или pstats.
+"""
+import argparse
+import asyncio
+import cProfile
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+# Задаётся до импорта бота: воспроизведение не пишет журналы и не записывает само себя
+os.environ.setdefault('ANALYTICS_DIR', '')
+os.environ['UPDATES_RECORD_DIR'] = ''
+# Перечитывание курса раз в 10 с не даёт пропускать простои
+os.environ.setdefault('COURSE_RELOAD_INTERVAL', '3600')
+
+from bench.fake_api import FakeBotApi  # noqa: E402
+from bench.loadtest import bot, instrument, monitor_loop_lag, print_report, summarize  # noqa: E402
+from recorder import read_recording, recording_files  # noqa: E402
+from scheduler import TimerScheduler  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+
+
+class VirtualClock:
+    """Время записи: идёт в speed раз быстрее реального, простои можно перескочить"""
+
+    def __init__(self, start, speed):
+        self.start = start
+        self.speed = speed
+        self.skipped = 0.0
+        self._real_start = time.monotonic()
+
+    def __call__(self):
+        return self.start + (time.monotonic() - self._real_start) * self.speed + self.skipped
+
+    def advance(self, seconds):
+        self.skipped += seconds
+
+
+class ReplayScheduler(TimerScheduler):
+    """Планировщик без своего цикла: таймеры запускает воспроизведение через fire_due"""
+
+    def start(self):
+        pass
+
+
+async def replay(args, records):
+    latencies = {}
+    lag = []
+    instrument(latencies)
+    if args.auto_next is not None:
+        bot.AUTO_NEXT_DELAY = args.auto_next
+    else:
+        # Как в продакшене, а не 30 с локального режима
+        bot.AUTO_NEXT_DELAY = 600
+
+    first = next(records, None)
+    if first is None:
+        raise SystemExit('в записи нет апдейтов')
+    clock = VirtualClock(first[0], args.speed)
+    bot.scheduler = ReplayScheduler(clock=clock)
+    bot.retention.clock = clock
+    bot.events.clock = clock
+
+    api = FakeBotApi(latency=args.latency, jitter=args.jitter, seed=1)
+    await api.start()
+    application = bot.build_application(base_url=api.base_url, updater=None)
+    # Сколько апдейтов сейчас в обработке: простой пропускается, только когда их нет
+    processing = [0]
+
+    async def begin(update, context):
+        processing[0] += 1
+
+    async def end(update, context):
+        processing[0] -= 1
+
+    application.add_handler(TypeHandler(Update, begin), group=-100)
+    application.add_handler(TypeHandler(Update, end), group=100)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    def idle():
+        return (not processing[0] and application.update_queue.empty()
+                and not bot.outbound.pending and not bot.scheduler.in_flight)
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    stop_event = asyncio.Event()
+    lag_task = asyncio.create_task(monitor_loop_lag(lag, stop_event))
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+
+    pending = first
+    delivered = 0
+    last_t = first[0]
+    end_t = None
+    started = time.perf_counter()
+    while True:
+        now = clock()
+        while pending is not None and pending[0] <= now:
+            application.update_queue.put_nowait(Update.de_json(pending[1], application.bot))
+            delivered += 1
+            last_t = pending[0]
+            pending = next(records, None)
+        if pending is None and end_t is None:
+            end_t = last_t + args.tail
+        bot.scheduler.fire_due(now)
+        if end_t is not None and now >= end_t:
+            break
+
+        timer_delay = bot.scheduler._next_delay()
+        next_at = min(pending[0] if pending is not None else end_t,
+                      now + timer_delay if timer_delay is not None else float('inf'))
+        gap = next_at - now
+        if gap > args.skip_idle and idle():
+            clock.advance(gap)
+            continue
+        # Ждём следующего события, но не дольше 50 мс: обработчики могут поставить новые таймеры.
+        # Перед пропуском простоя ждём лишь окончания текущей работы — опрашиваем чаще
+        poll = 0.005 if gap > args.skip_idle else 0.05
+        await asyncio.sleep(max(0.0, min(gap / args.speed, poll)))
+
+    if profiler is not None:
+        profiler.disable()
+    elapsed = time.perf_counter() - started
+    virtual = clock() - first[0]
+    users = len(bot.user_states)
+    completed = sum(1 for session in bot.user_states.values() if session.completed)
+    rss_delta_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss
+    stop_event.set()
+    await lag_task
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await api.stop()
+    if profiler is not None:
+        profiler.dump_stats(args.profile)
+
+    api_calls = sum(api.calls.values())
+    return {
+        'users': users,
+        'updates': delivered,
+        'completed': completed,
+        'elapsed_s': elapsed,
+        'virtual_s': virtual,
+        'skipped_s': clock.skipped,
+        'funnels_per_s': completed / elapsed,
+        'timers_fired': bot.scheduler.fired_total,
+        'api_calls': api.calls,
+        'api_calls_per_s': api_calls / elapsed,
+        'api_flooded': api.flooded,
+        'api_failed': api.failed,
+        'max_chat_burst_1s': api.max_chat_burst(),
+        'handlers': {name: summarize(values) for name, values in latencies.items()},
+        'peak_active_users': users,
+        'rss_growth_per_user_kb': rss_delta_kb / max(1, users),
+        'loop_lag': summarize(lag),
+        'outbound': bot.outbound.stats(),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='+', help='каталог записи или файлы updates-*.jsonl.gz')
+    parser.add_argument('--speed', type=float, default=1.0, help='ускорение относительно записи')
+    parser.add_argument('--skip-idle', type=float, default=60.0,
+                        help='пропускать простои длиннее стольких виртуальных секунд')
+    parser.add_argument('--tail', type=float, default=22 * 3600,
+                        help='сколько виртуальных секунд ждать таймеры после последнего апдейта')
+    parser.add_argument('--auto-next', type=float, default=None, help='вместо 600 с авто-перехода')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа Bot API, с')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--profile', help='файл для профиля cProfile')
+    parser.add_argument('--json', action='store_true', help='вывести отчёт в JSON')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    paths = []
+    for path in args.paths:
+        paths.extend(recording_files(path) if os.path.isdir(path) else [path])
+    if not paths:
+        sys.exit('нет файлов записи')
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(replay(args, iter(read_recording(paths))))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"апдейтов: {report['updates']}, виртуального времени {report['virtual_s'] / 3600:.1f} ч "
+          f"(пропущено простоя {report['skipped_s'] / 3600:.1f} ч) за {report['elapsed_s']:.1f} с, "
+          f"таймеров сработало {report['timers_fired']}")
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Локальная проверка шардирования: синтетические апдейты через ShardSupervisor.
+
+Запуск: python -m bench.shard_harness --workers 4 --users 2000 --updates 50000
+
+Воркеры здесь не поднимают бота, а только записывают, что получили, поэтому
+токен не нужен. Проверяется, что все апдейты пользователя попали в один воркер
+и пришли в том порядке, в котором были отправлены.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import threading
+import time
+
+from sharding import ShardSupervisor, update_user_id
+
+
+def recording_worker(shard_id, conn, env, results):
+    """Воркер-заглушка: читает канал до закрытия и возвращает (user_id, update_id)"""
+    received = []
+    try:
+        while True:
+            data = json.loads(conn.recv_bytes())
+            received.append((update_user_id(data), data['update_id']))
+    except EOFError:
+        pass
+    results.put((shard_id, received))
+
+
+def synthetic_update(update_id, user_id, step):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+    chat = {'id': user_id, 'type': 'private'}
+    if step == 0:
+        return {
+            'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'chat': chat, 'from': user,
+                        'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]},
+        }
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': str(user_id),
+            'data': f'watched_{step}',
+            'message': {'message_id': update_id, 'date': 0, 'chat': chat, 'text': 'button'},
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--updates', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    user_ids = [rng.randrange(10 ** 6, 10 ** 10) for _ in range(args.users)]
+    steps = {}
+
+    results = multiprocessing.get_context('spawn').Queue()
+    supervisor = ShardSupervisor(args.workers, target=recording_worker, target_args=(results,))
+    supervisor.start()
+
+    started = time.perf_counter()
+    for update_id in range(1, args.updates + 1):
+        user_id = rng.choice(user_ids)
+        step = steps[user_id] = (steps.get(user_id, -1) + 1) % 3
+        supervisor.dispatch(json.dumps(synthetic_update(update_id, user_id, step)).encode())
+    dispatch_time = time.perf_counter() - started
+
+    # Воркеры отдают результаты только после закрытия каналов, поэтому stop — в отдельном потоке
+    stopper = threading.Thread(target=supervisor.stop)
+    stopper.start()
+    collected = [results.get() for _ in range(args.workers)]
+    stopper.join()
+    total_time = time.perf_counter() - started
+
+    owner = {}
+    last_seen = {}
+    violations = 0
+    received = 0
+    for shard_id, records in collected:
+        for user_id, update_id in records:
+            received += 1
+            if owner.setdefault(user_id, shard_id) != shard_id:
+                violations += 1
+            if update_id <= last_seen.get(user_id, 0):
+                violations += 1
+            last_seen[user_id] = update_id
+
+    print(f"воркеров: {args.workers}, пользователей: {len(last_seen)}, апдейтов: {received}/{args.updates}")
+    print(f"распределение по воркерам: {supervisor.dispatched}")
+    print(f"маршрутизация: {args.updates / dispatch_time:,.0f} апдейтов/с, "
+          f"доставка всех: {total_time:.2f} с")
+    print(f"нарушений порядка: {violations}")
+    if violations or received != args.updates:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Время от запуска процесса до первого обработанного апдейта.
+
+Запуск: python -m bench.startup [--runs 5]
+
+Каждый замер — новый процесс: импорт бота, сборка приложения с base_url на
+FakeBotApi, /start синтетического пользователя и ожидание конца его обработки.
+Сравниваются запуск бота в процессе main.py и прежняя схема, где main.py
+запускал bot.py вторым интерпретатором через subprocess. Отдельно — перезапуск
+в том же процессе (supervisor.py): модуль бота загружается заново, а
+python-telegram-bot и остальные зависимости уже импортированы.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.fake_api import FAKE_TOKEN, FakeBotApi
+
+USER_ID = 10 ** 6
+
+
+def start_update(update_id):
+    user = {'id': USER_ID, 'is_bot': False, 'first_name': 'startup'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': {'id': USER_ID, 'type': 'private'}, 'from': user, 'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+async def first_update(bot, api, update_id):
+    """Поднимает приложение бота, обрабатывает один /start и останавливает; возвращает момент обработки"""
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    application = bot.build_application(base_url=api.base_url, updater=None)
+    processed = asyncio.Event()
+
+    async def done(update, context):
+        processed.set()
+
+    # Группа 1 выполняется после обработчика /start из группы 0
+    application.add_handler(TypeHandler(Update, done), group=1)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    application.update_queue.put_nowait(Update.de_json(start_update(update_id), application.bot))
+    await processed.wait()
+    ready = time.time()
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    return ready
+
+
+async def child_run(spawned):
+    api = FakeBotApi(latency=0.0, jitter=0.0)
+    await api.start()
+    try:
+        import_started = time.time()
+        import bot
+        imported = time.time()
+        ready = await first_update(bot, api, 1)
+
+        # Перезапуск как в main.run_bot: прежний модуль бота выбрасывается
+        restart_started = time.time()
+        sys.modules.pop('bot', None)
+        import bot
+        restarted = await first_update(bot, api, 2)
+    finally:
+        await api.stop()
+    return {
+        'interpreter_s': import_started - spawned,
+        'import_s': imported - import_started,
+        'first_update_s': ready - spawned,
+        'restart_s': restarted - restart_started,
+    }
+
+
+def child(spawned):
+    os.environ['TELEGRAM_BOT_TOKEN'] = FAKE_TOKEN
+    os.environ['STATE_BACKEND'] = 'memory'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    print(json.dumps(asyncio.run(child_run(spawned))))
+
+
+def spawn(command):
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        child(args.child)
+        return
+
+    child_command = [sys.executable, '-m', 'bench.startup', '--child']
+    results = {'в процессе': [], 'через subprocess': []}
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['ANALYTICS_DIR'] = directory
+        for _ in range(args.runs):
+            results['в процессе'].append(spawn(child_command + [str(time.time())]))
+            # Прежний main.py: интерпретатор, который только запускает второй
+            wrapper = f'import subprocess, sys; subprocess.run({child_command + [str(time.time())]!r}, check=True)'
+            results['через subprocess'].append(spawn([sys.executable, '-c', wrapper]))
+
+    print(f"медиана {args.runs} запусков, мс")
+    for name, runs in results.items():
+        median = {key: statistics.median(run[key] for run in runs) * 1000 for key in runs[0]}
+        print(f"{name:<17} до первого апдейта {median['first_update_s']:7.1f} "
+              f"(интерпретатор {median['interpreter_s']:6.1f}, импорт бота {median['import_s']:6.1f})")
+    restart = statistics.median(run['restart_s'] for run in results['в процессе']) * 1000
+    print(f"перезапуск в том же процессе: {restart:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,46 @@
 import os
+import json
+import hmac
+import signal
 import logging
+import threading
 import asyncio
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+import functools
+from datetime import datetime
+from telegram import Update
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import Application, CallbackContext, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+
+import analytics
+import profiling
+import broadcast
+import retention as retention_policy
+import sender
+from broadcast import BroadcastEngine
+from course import (
+    AUTO_NEXT_NOTICE, BUTTON_CAPTION, BUTTON_SEPARATE, BUTTON_TEXT, WATCHED_NOTICE, CourseError, file_version,
+    load_course,
+)
+from http_server import HttpServer, Response, webhook_secret
+from logs import bind_log_context, setup_logging, stats as log_stats
+from mailboxes import UserMailboxes
+from recorder import RecordingQueue, UpdateRecorder
+from media_cache import MediaCache
+from metrics import REGISTRY, Counter, Gauge, LoopLagMonitor, instrument
+from retention import Retention
+from scheduler import TimerScheduler
+from sender import INTERACTIVE, CircuitBreaker, OutboundDispatcher, SCHEDULED, send_fail_fast, send_priority
+from session import DISCOUNT_SLOT, STEP_SLOT, UserSession, timer_key, timer_slot
+from storage import StateStore, create_backend
+from suppression import ChatSuppressed, SuppressionList
 
 # ========== НАСТРОЙКА СРЕДЫ ==========
 IS_PRODUCTION = os.getenv('PYTHONANYWHERE_SITE') is not None or os.getenv('RAILWAY_ENVIRONMENT') == 'production'
 
-log_level = logging.INFO if IS_PRODUCTION else logging.DEBUG
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=log_level
-)
+log_level = os.getenv('LOG_LEVEL', 'INFO' if IS_PRODUCTION else 'DEBUG').upper()
+# Логи пишутся из отдельного потока: цикл событий только кладёт запись в очередь.
+# На продакшене — JSON-строки с user_id/lesson/handler для сбора логов
+setup_logging(log_level, json_format=os.getenv('LOG_FORMAT', 'json' if IS_PRODUCTION else 'text') == 'json')
 logger = logging.getLogger(__name__)
 
 # ========== ПОЛУЧЕНИЕ ТОКЕНА ==========
@@ -26,513 +54,833 @@ if not TOKEN:
     else:
         TOKEN = ""
 
-logger.info(f"✅ Режим: {'ПРОДАКШЕН' if IS_PRODUCTION else 'ЛОКАЛЬНЫЙ'} ")
+logger.info("✅ Режим: %s", 'ПРОДАКШЕН' if IS_PRODUCTION else 'ЛОКАЛЬНЫЙ', extra={'event': 'startup'})
+
+# Имя бота в режиме нескольких ботов (tenants.py); попадает в поле tenant логов таймеров:
+# планировщик у ботов общий, и контекст лога его цикла ни одному из них не принадлежит
+TENANT = os.getenv('BOT_TENANT', '')
+TENANT_LOG_CONTEXT = {'tenant': TENANT} if TENANT else {}
+
+# ========== РЕЖИМ ПОЛУЧЕНИЯ ОБНОВЛЕНИЙ ==========
+# WEBHOOK_URL — публичный адрес бота; без него webhook-сервер можно поднять локально
+# через BOT_MODE=webhook и отправлять ему сохранённые Update JSON через POST
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+BOT_MODE = os.getenv('BOT_MODE', 'webhook' if WEBHOOK_URL else 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Telegram присылает секрет в заголовке X-Telegram-Bot-Api-Secret-Token. Без WEBHOOK_SECRET
+# он выводится из токена: реплики за балансировщиком должны регистрировать один и тот же
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or (webhook_secret(TOKEN) if WEBHOOK_URL and TOKEN else '')
 
 # ========== КОНСТАНТЫ БОТА ==========
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Обновленные данные для видео с вашим текстом
-VIDEOS = {
-    1: {
-        'file_id': 'BAACAgIAAxkBAAMLaX5ONyhs6dq_nFOnhgwHF_xOMP0AAmmZAALhxuhL-jTg8IIffAw4BA',
-        'url': 'https://disk.yandex.ru/d/E46C3yronk3JFQ',  # Замените на реальную ссылку
-        'text_before': """если у тебя не загружается урок — его можно 
-открыть по ссылке: https://disk.yandex.ru/d/E46C3yronk3JFQ
+# Уроки, финальное видео и тексты сообщений — в файле курса (JSON или YAML).
+# Файл перечитывается на лету: правка урока не требует перезапуска
+COURSE_FILE = os.getenv('COURSE_FILE', os.path.join(BASE_DIR, 'course.json'))
+COURSE_RELOAD_INTERVAL = float(os.getenv('COURSE_RELOAD_INTERVAL', '10'))
+# Версия файла, которая не прошла проверку (чтобы не разбирать её снова)
+rejected_course_version = None
+
+try:
+    course = load_course(COURSE_FILE)
+except (OSError, CourseError) as e:
+    logger.error("❌ Не удалось загрузить курс %s: %s", COURSE_FILE, e, extra={'event': 'course_invalid'})
+    exit(1)
+
+# Задержка авто-продолжения: на продакшене 10 минут, на локальном 30 секунд для теста
+AUTO_NEXT_DELAY = 600 if IS_PRODUCTION else 30
+# Напоминание о скидке через 21 час после финального сообщения
+DISCOUNT_REMINDER_DELAY = 21 * 3600
+
+# Порт для /metrics в формате Prometheus (если не задан — сервер метрик не запускается)
+METRICS_PORT = os.getenv('METRICS_PORT')
+
+# Как часто удалять пользователей с истёкшим сроком хранения (сроки — в retention.py)
+RETENTION_INTERVAL = 300
+
+# Сколько ждать при остановке, пока доработают таймеры и уйдёт очередь отправки
+# (Railway даёт процессу время между SIGTERM и SIGKILL)
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '20'))
+
+# Сколько апдейтов обрабатывается одновременно. Безопасно: события одного
+# пользователя всё равно идут по очереди (mailboxes), а паузы — шаги в планировщике
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Администраторы бота (через запятую): им доступны служебные команды вроде /broadcast
+ADMIN_USER_IDS = frozenset(int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').replace(',', ' ').split())
+
+# Число воркеров в режиме шардов (задаёт sharding.py; 1 — бот в одном процессе)
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+
+# Пул соединений HTTP с Bot API. У PTB по умолчанию одно соединение на все запросы,
+# и отправка упирается в ~150 запросов в секунду; пул должен покрывать воркеров
+# очереди отправки и прямые вызовы (set_webhook, get_me)
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', '16'))
+API_POOL_TIMEOUT = float(os.getenv('API_POOL_TIMEOUT', '5'))
+
+# Файл с состоянием воронки (бэкенд выбирается через STATE_BACKEND)
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(BASE_DIR, 'bot_state.db'))
+
+# Журнал событий воронки для analytics.py (пустое значение — не писать)
+ANALYTICS_DIR = os.getenv('ANALYTICS_DIR', os.path.join(BASE_DIR, 'analytics'))
+
+# Запись входящих апдейтов для bench/replay.py (пустое значение — не записывать)
+UPDATES_RECORD_DIR = os.getenv('UPDATES_RECORD_DIR', '')
+UPDATES_RECORD_MAX_MB = float(os.getenv('UPDATES_RECORD_MAX_MB', '64'))
+UPDATES_RECORD_KEEP = int(os.getenv('UPDATES_RECORD_KEEP', '20'))
+
+# Лимиты отправки, сроки хранения и темп рассылок этого бота. По умолчанию — значения
+# sender.py, retention.py и broadcast.py из окружения процесса; здесь они читаются
+# заново, потому что у каждого бота в tenants.py своё окружение
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', sender.GLOBAL_RATE))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', sender.CHAT_RATE))
+OUTBOUND_CHAT_BURST = float(os.getenv('OUTBOUND_CHAT_BURST', sender.CHAT_BURST))
+API_MAX_RETRIES = int(os.getenv('API_MAX_RETRIES', sender.API_MAX_RETRIES))
+API_BREAKER_THRESHOLD = int(os.getenv('API_BREAKER_THRESHOLD', sender.BREAKER_THRESHOLD))
+API_BREAKER_COOLDOWN = float(os.getenv('API_BREAKER_COOLDOWN', sender.BREAKER_COOLDOWN))
+RETENTION_ABANDONED_TTL = float(os.getenv('RETENTION_ABANDONED_TTL', retention_policy.ABANDONED_TTL))
+RETENTION_COMPLETED_GRACE = float(os.getenv('RETENTION_COMPLETED_GRACE', retention_policy.COMPLETED_GRACE))
+RETENTION_MAX_USERS = int(os.getenv('RETENTION_MAX_USERS', retention_policy.MAX_TRACKED_USERS))
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', broadcast.BROADCAST_CHUNK_SIZE))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', broadcast.BROADCAST_CONCURRENCY))
 
-урок 1. Основы Photoshop
+# ========== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ==========
+# user_id -> UserSession
+user_states = {}
+shutting_down = False
 
-скачать фотошоп (https://t.me/+v_vSoBd1p6o4NjUy)
+# Все таймеры (авто-продолжение и скидка) живут в одном планировщике
+scheduler = TimerScheduler()
 
-Обещанный подарок
-⠀
-Пак шрифтов, которым я делюсь на своем полноценном обучении.
-⠀
-1. подпишись на меня в инсте instagram.com/brezdenuk_/
+# Все исходящие сообщения идут через общую очередь с лимитами Telegram
+outbound = OutboundDispatcher(
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, max_retries=API_MAX_RETRIES,
+    breaker=CircuitBreaker(API_BREAKER_THRESHOLD, API_BREAKER_COOLDOWN),
+)
 
-2/ выложи свой список желаний <b>с отметкой меня</b> и любым отзывом в сторис
+# События одного пользователя (команды, кнопки, таймеры) выполняются по очереди
+mailboxes = UserMailboxes()
 
-3/ напиши мне в личку тг 
 
-вот ссылка на инсту ↓
-instagram.com/brezdenuk_/
-<a>https://t.me/brezdenuk</a>""",
-        'conclusions': '📌 Отлично! Первый урок пройден!'
-    },
-    2: {
-        'file_id': 'BAACAgIAAxkBAAMNaX5OUKzcpLpJPRCVTAiBU3CMedAAAoyZAALhxuhLHm-BSEgmn6g4BA',
-        'url': 'https://disk.yandex.ru/d/E46C3yronk3JFQ',  # Замените на реальную ссылку
-        'text_before': """если у тебя не загружается урок — его можно 
-открыть по ссылке: https://disk.yandex.ru/d/E46C3yronk3JFQ
+# ========== ХРАНЕНИЕ СОСТОЯНИЯ ==========
+def serialize_state(user_id):
+    """Снимок состояния пользователя для хранилища (None — пользователь удалён)"""
+    session = user_states.get(user_id)
+    return session.to_dict() if session is not None else None
 
-урок 2. Создаем карточку для WB
 
-Все материалы к уроку (https://t.me/+v_vSoBd1p6o4NjUy)
+state_store = StateStore(serialize_state)
 
-(повторяйте карточку за мной)""",
-        'conclusions': '📌 Отлично! Второй урок пройден!'
-    },
-    3: {
-        'file_id': 'BAACAgIAAxkBAAMPaX5OY0OBR2MyvqqjER2gQJBtPmgAArCZAALhxuhLPtIub_pC0mE4BA',
-        'url': 'https://disk.yandex.ru/d/E46C3yronk3JFQ',  # Замените на реальную ссылку
-        'text_before': """если у тебя не загружается урок — его можно 
-открыть по ссылке: https://disk.yandex.ru/d/E46C3yronk3JFQ
+# События воронки пишутся пачками в файлы ANALYTICS_DIR; шарды пишут каждый в свой файл
+events = analytics.EventLog(ANALYTICS_DIR, shard=os.getenv('SHARD_ID', '0'))
 
-урок 3. Как найти клиентов и начать зарабатывать.
+# Входящие апдейты для воспроизведения (только при UPDATES_RECORD_DIR)
+updates_recorder = UpdateRecorder(
+    UPDATES_RECORD_DIR, shard=os.getenv('SHARD_ID', '0'),
+    max_bytes=int(UPDATES_RECORD_MAX_MB * 2**20), keep=UPDATES_RECORD_KEEP,
+)
 
-В конце видео отдам подарок""",
-        'conclusions': '📌 Все уроки пройдены!'
-    }
-}
+# Сроки хранения пользователей в памяти и в хранилище
+retention = Retention(RETENTION_ABANDONED_TTL, RETENTION_COMPLETED_GRACE, RETENTION_MAX_USERS)
 
-FINAL_VIDEO = {
-    'file_path': os.path.join(BASE_DIR, 'final_video.mp4'),
-    'url': 'https://disk.yandex.ru/d/E46C3yronk3JFQ',  # Замените на реальную ссылку
-    'caption': '🎯 Видео-сообщение от автора курса'
-}
 
-# ========== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ==========
-user_states = {}
-active_timers = {}
-shutting_down = False
+def save_user(user_id):
+    """Отмечает изменение состояния: запись в хранилище и продление срока хранения"""
+    state_store.mark_dirty(user_id)
+    session = user_states.get(user_id)
+    if session is None:
+        retention.discard(user_id)
+    else:
+        retention.touch(user_id, session.completed, session.discount_reminder_time)
+
+
+def drop_user(user_id):
+    """Удаляет пользователя из памяти и хранилища.
+
+    От прошедших курс в хранилище остаётся компактная запись: рассылки по
+    выборке completed должны доходить до всех, кто когда-либо прошёл курс.
+    """
+    session = user_states.pop(user_id, None)
+    save_user(user_id)
+    if session is not None and session.completed:
+        state_store.archive_user(user_id, {'chat_id': session.chat_id, 'completed': True, 'archived': True})
+
+
+def evict_user(user_id, reason):
+    """Вытеснение по сроку хранения или лимиту пользователей"""
+    drop_user(user_id)
+    retention.evicted[reason] += 1
+
+# file_id загруженного финального видео переиспользуется для всех пользователей
+media_cache = MediaCache(state_store)
+
+
+def pending_timers():
+    """Ожидающие таймеры этого бота"""
+    if not TENANT:
+        return scheduler.pending
+    # Планировщик в tenants.py общий: считаем только таймеры своих пользователей
+    return sum(len(session.pending_timers()) for session in user_states.values())
+
+
+# ========== МЕТРИКИ ==========
+FUNNEL_STARTS = Counter('bot_funnel_starts_total', 'Команды /start')
+FUNNEL_LESSONS = Counter('bot_funnel_lesson_sent_total', 'Отправленные уроки', ('lesson',))
+FUNNEL_WATCHED = Counter(
+    'bot_funnel_lesson_watched_total', 'Пройденные уроки (кнопкой или по таймеру)', ('lesson', 'via')
+)
+FUNNEL_COMPLETED = Counter('bot_funnel_completed_total', 'Пользователи, прошедшие все уроки')
+DISCOUNT_SENT = Counter('bot_discount_reminders_total', 'Отправленные напоминания о скидке')
+Gauge('bot_user_states', 'Пользователей в памяти', lambda: len(user_states))
+
+Gauge('bot_timers_pending', 'Ожидающих таймеров в планировщике', pending_timers)
+Gauge('bot_timers_running', 'Сработавших таймеров в работе', lambda: scheduler.in_flight)
+Gauge('bot_outbound_queue_depth', 'Запросов в очереди отправки', lambda: outbound.queue_depth)
+Gauge('bot_state_pending_writes', 'Несохранённых изменений состояния', lambda: state_store.pending_writes)
+Gauge('bot_retention_indexed', 'Пользователей в индексе сроков хранения', lambda: len(retention.index))
+Gauge('bot_user_mailboxes', 'Пользователей с событиями в обработке', lambda: len(mailboxes))
+Gauge('bot_user_mailbox_contended', 'Событий, ждавших предыдущее событие пользователя', lambda: mailboxes.contended)
+Gauge('bot_log_records_written', 'Записей лога выведено', lambda: log_stats['written'])
+Gauge('bot_log_records_dropped', 'Записей лога отброшено (очередь переполнена)', lambda: log_stats['dropped'])
+Gauge(
+    'bot_log_records_suppressed', 'Записей лога отсеяно выборкой и ограничением частоты',
+    lambda: log_stats['sampled_out'] + log_stats['rate_limited']
+)
+DUPLICATE_CLICKS = Counter('bot_duplicate_clicks_total', 'Повторные и устаревшие нажатия кнопок', ('lesson',))
+SEND_FALLBACKS = Counter(
+    'bot_send_fallbacks_total', 'Шаги урока, отправленные по запасному плану (больше запросов)', ('step',)
+)
+Gauge('bot_analytics_events_written', 'Событий аналитики записано', lambda: events.written)
+Gauge('bot_analytics_events_dropped', 'Событий аналитики отброшено', lambda: events.dropped)
+Gauge('bot_updates_recorded', 'Апдейтов записано для воспроизведения', lambda: updates_recorder.written)
+Gauge('bot_updates_record_dropped', 'Апдейтов не записано (диск не успевает)', lambda: updates_recorder.dropped)
+Gauge('bot_api_in_request', 'Запросов к Bot API в ожидании ответа', lambda: outbound.in_request)
+Gauge('bot_api_pool_utilization', 'Доля занятых соединений пула HTTP', lambda: outbound.in_request / API_POOL_SIZE)
+Gauge('bot_api_breaker_open', 'Размыкатель Bot API разомкнут (1) или замкнут (0)',
+      lambda: float(outbound.breaker.state != 'closed'))
+Gauge('bot_suppressed_chats', 'Чатов в списке подавления', lambda: len(suppressions))
+Gauge('bot_suppressed_sends', 'Отправок, пропущенных из-за списка подавления', lambda: suppressions.skipped)
+Gauge('bot_retention_evicted', 'Вытеснено пользователей с момента запуска', lambda: sum(retention.evicted.values()))
+loop_lag = LoopLagMonitor()
+metrics_server = None
+
+
+def set_timer(user_id, slot, when, callback, args, context):
+    """Ставит таймер пользователя в планировщик и записывает его в хранилище.
+
+    slot — DISCOUNT_SLOT, STEP_SLOT или номер урока; у пользователя один таймер
+    урока, поэтому новый таймер урока заменяет прежний.
+    """
+    session = user_states[user_id]
+    if slot > DISCOUNT_SLOT and session.lesson_timer is not None and session.lesson_timer_slot != slot:
+        cancel_timer(user_id, session.lesson_timer_slot)
+    old_timer = session.get_timer(slot)
+    if old_timer is not None:
+        old_timer.cancel()
+    session.set_timer(slot, scheduler.call_at(when, fire_timer, user_id, slot, callback, args, context))
+    state_store.save_timer(user_id, timer_key(slot), callback.__name__, args, when)
+
+
+def schedule_step(user_id, delay, step, args, context):
+    """Следующий шаг воронки через delay секунд — вместо asyncio.sleep в обработчике.
+
+    Шаг — обычный таймер пользователя: выполняется в его очереди событий,
+    сохраняется в хранилище и переживает перезапуск.
+    """
+    set_timer(user_id, STEP_SLOT, scheduler.clock() + delay, step, args, context)
+
+
+def cancel_timer(user_id, slot):
+    """Отменяет таймер пользователя и удаляет его из хранилища"""
+    session = user_states.get(user_id)
+    timer = session.pop_timer(slot) if session is not None else None
+    if timer is not None:
+        timer.cancel()
+        state_store.delete_timer(user_id, timer_key(slot))
+
+
+def timer_replaced(user_id, slot):
+    """В слоте пользователя уже стоит новый ожидающий таймер"""
+    session = user_states.get(user_id)
+    current = session.get_timer(slot) if session is not None else None
+    return current is not None and not current.done()
+
+
+async def fire_timer(user_id, slot, callback, args, context):
+    """Срабатывание таймера: вызываем колбэк и после него убираем таймер из хранилища.
+
+    Пока колбэк не выполнен, строка таймера остаётся в хранилище: таймер,
+    сработавший во время остановки или прерванный по SHUTDOWN_TIMEOUT,
+    выполнит следующий процесс (restore_state).
+    """
+    # Сообщения по таймерам уступают очередь ответам на действия пользователей;
+    # шаг воронки — продолжение ответа, он остаётся в интерактивной очереди
+    send_priority.set(INTERACTIVE if slot == STEP_SLOT else SCHEDULED)
+    # Шаг, упавший на разомкнутом размыкателе, потерялся бы, поэтому по таймеру
+    # ждём восстановления API, как рассылки
+    send_fail_fast.set(False)
+    bind_log_context(**TENANT_LOG_CONTEXT, user_id=user_id, handler=callback.__name__)
+    async with mailboxes.hold(user_id):
+        if timer_replaced(user_id, slot):
+            # Пока таймер ждал очереди, его заменили новым (например, повторный /start);
+            # строка в хранилище уже принадлежит новому таймеру
+            return
+        if shutting_down:
+            # Бот останавливается: строка остаётся, таймер сработает после перезапуска
+            return
+        session = user_states.get(user_id)
+        if session is not None and session.chat_id not in suppressions:
+            try:
+                await callback(user_id, *args, context)
+            except ChatSuppressed:
+                # Пользователь заблокировал бота посреди цепочки шагов — её просто обрываем
+                pass
+        # Колбэк мог поставить в тот же слот следующий таймер (например, следующий шаг)
+        if not timer_replaced(user_id, slot):
+            state_store.delete_timer(user_id, timer_key(slot))
+
+
+def suppress_user(chat_id):
+    """Чат заблокировал бота: отменяем все таймеры его пользователя"""
+    # В личном чате chat_id совпадает с user_id
+    session = user_states.get(chat_id)
+    if session is None or session.chat_id != chat_id:
+        return
+    if session.lesson_timer is not None:
+        cancel_timer(chat_id, session.lesson_timer_slot)
+    cancel_timer(chat_id, STEP_SLOT)
+    cancel_timer(chat_id, DISCOUNT_SLOT)
+    save_user(chat_id)
+
+
+# Чаты, куда отправка падает с Forbidden или chat not found; снимаются новым /start
+suppressions = SuppressionList(state_store, suppress_user)
 
 
 # ========== НОВАЯ ФУНКЦИЯ ДЛЯ ОТПРАВКИ СООБЩЕНИЯ ПОСЛЕ 21 ЧАСА ==========
 async def send_discount_reminder(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    """Отправляет сообщение о скидке через 21 час"""
-    message_text = (
-        "<b><u>У тебя осталось 3 часа до конца скидки</u></b>\n\n"
-        "<a href='https://t.me/Alexander_brez'>Занять место по выгодной цене:</a>\n"
-        "<a href='https://t.me/Alexander_brez'>Занять место</a>\n"
-        "t.me/brezdenuk"
-    )
-
+    """Отправляет сообщение о скидке через 21 час; возвращает True, если отправлено"""
     try:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=message_text,
-            parse_mode='HTML',
-            disable_web_page_preview=True
+        await outbound.call(
+            context.bot.send_message, chat_id=chat_id, **course.messages['discount_reminder']
         )
-        logger.info(f"Сообщение о скидке отправлено пользователю {chat_id}")
+        DISCOUNT_SENT.inc()
+        logger.info("Сообщение о скидке отправлено в чат %s", chat_id, extra={'event': 'discount_sent'})
+        return True
     except Exception as e:
-        logger.error(f"Ошибка при отправке сообщения о скидке: {e}")
+        logger.error(
+            "Ошибка при отправке сообщения о скидке: %s", e,
+            extra={'event': 'discount_failed', 'chat_id': chat_id}
+        )
+        return False
 
 
 async def cleanup_user(user_id):
     """Очистка данных пользователя, но только если нет активных таймеров"""
-    # Проверяем, есть ли активные таймеры
-    has_active_timers = False
-    if user_id in active_timers:
-        for timer in active_timers[user_id]:
-            if not timer.done():
-                has_active_timers = True
-                break
+    session = user_states.get(user_id)
+    if session is None:
+        logger.info("Данные пользователя %s полностью очищены", user_id, extra={'event': 'user_cleaned'})
+        return
+
+    # Таймер авто-продолжения и следующий шаг прошлого прохождения больше не нужны
+    if session.lesson_timer is not None:
+        cancel_timer(user_id, session.lesson_timer_slot)
+    cancel_timer(user_id, STEP_SLOT)
 
     # Если есть активные таймеры, не удаляем пользователя полностью
-    if has_active_timers:
+    if session.pending_timers():
         # Просто отмечаем как завершенного, но оставляем данные
-        if user_id in user_states:
-            user_states[user_id]['cleanup_pending'] = True
-        logger.info(f"Пользователь {user_id} имеет активные таймеры, откладываем очистку")
+        session.cleanup_pending = True
+        logger.info(
+            "Пользователь %s имеет активные таймеры, откладываем очистку", user_id,
+            extra={'event': 'cleanup_postponed'}
+        )
     else:
         # Если таймеров нет, удаляем полностью
-        if user_id in active_timers:
-            active_timers.pop(user_id, None)
-        if user_id in user_states:
-            user_states.pop(user_id, None)
-        logger.info(f"Данные пользователя {user_id} полностью очищены")
+        drop_user(user_id)
+        logger.info("Данные пользователя %s полностью очищены", user_id, extra={'event': 'user_cleaned'})
 
 
 # Добавляем новую функцию для проверки и удаления старых пользователей
 async def cleanup_completed_users():
-    """Периодически очищает данные завершенных пользователей"""
-    while not shutting_down:
-        await asyncio.sleep(300)  # Проверяем каждые 5 минут
-
-        current_time = datetime.now()
-        users_to_remove = []
-
-        for user_id, user_data in user_states.items():
-            if user_data.get('completed', False):
-                # Проверяем, был ли отправлен discount_reminder
-                reminder_time = user_data.get('discount_reminder_time')
-
-                if reminder_time:
-                    # Если таймер скидки прошел (21 час + 1 час на всякий случай)
-                    if current_time > reminder_time + timedelta(hours=1):
-                        # Проверяем активные таймеры
-                        has_active_timers = False
-                        if user_id in active_timers:
-                            for timer in active_timers[user_id]:
-                                if not timer.done():
-                                    has_active_timers = True
-                                    break
-
-                        if not has_active_timers:
-                            users_to_remove.append(user_id)
-
-        # Удаляем старых пользователей
-        for user_id in users_to_remove:
-            if user_id in active_timers:
-                active_timers.pop(user_id, None)
-            if user_id in user_states:
-                user_states.pop(user_id, None)
-            logger.info(f"Автоматически очищены данные пользователя {user_id}")
+    """Периодически удаляет пользователей с истёкшим сроком хранения.
 
+    Срок берётся из индекса retention, поэтому обход стоит O(истёкших),
+    а не O(всех пользователей). Перезапускает себя через планировщик.
+    """
+    bind_log_context(**TENANT_LOG_CONTEXT)
+    try:
+        evicted = 0
+        for user_id in retention.expired():
+            session = user_states.get(user_id)
+            if session is None:
+                continue
+            # Пока есть таймеры (например, напоминание о скидке), пользователя не трогаем
+            timers = session.pending_timers()
+            if timers:
+                retention.postpone(user_id, max(timer.when for timer in timers))
+                continue
+            evict_user(user_id, 'completed' if session.completed else 'abandoned')
+            evicted += 1
+        evicted += enforce_user_limit()
+        if evicted:
+            logger.info("Автоматически очищены данные пользователей: %s", evicted, extra={'event': 'retention_cleanup'})
+    finally:
+        if not shutting_down:
+            scheduler.call_later(RETENTION_INTERVAL, cleanup_completed_users)
+
+
+def enforce_user_limit():
+    """Вытесняет пользователей с самым ранним сроком, если их больше RETENTION_MAX_USERS"""
+    evicted = 0
+    for user_id in retention.overflow(len(user_states)):
+        session = user_states.get(user_id)
+        if session is None:
+            continue
+        timers = session.pending_timers()
+        if timers:
+            retention.postpone(user_id, max(timer.when for timer in timers))
+            continue
+        evict_user(user_id, 'overflow')
+        evicted += 1
+    return evicted
+
+
+def reload_course():
+    """Перечитывает файл курса, если он изменился.
+
+    Сессии хранят только номер урока, поэтому подмена курса их не сбрасывает;
+    при ошибке в файле остаётся прежняя версия.
+    """
+    global course, rejected_course_version
+    version = None
+    try:
+        version = file_version(COURSE_FILE)
+        if version != course.version and version != rejected_course_version:
+            course = load_course(COURSE_FILE)
+            logger.info(
+                "Курс перезагружен из %s: уроков %s", COURSE_FILE, course.last,
+                extra={**TENANT_LOG_CONTEXT, 'event': 'course_reloaded'}
+            )
+    except Exception as e:
+        # Любая ошибка разбора (не только CourseError) оставляет прежний курс.
+        # Ошибку по одной и той же версии файла пишем в лог один раз
+        rejected_course_version = version
+        # Синхронный колбэк работает в контексте цикла планировщика — поле tenant через extra
+        logger.error(
+            "Курс не перезагружен, остаётся прежняя версия: %s", e,
+            extra={**TENANT_LOG_CONTEXT, 'event': 'course_reload_failed'}
+        )
+    finally:
+        if not shutting_down:
+            scheduler.call_later(COURSE_RELOAD_INTERVAL, reload_course)
 
+
+@instrument('start')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     if shutting_down:
         return
 
+    FUNNEL_STARTS.inc()
+
     user = update.effective_user
     user_id = user.id
+    events.record(analytics.START, user_id)
+    bind_log_context(user_id=user_id, handler='start')
 
-    await cleanup_user(user_id)
-
-    user_states[user_id] = {
-        'current_video': 1,
-        'chat_id': update.message.chat_id,
-        'start_time': datetime.now()
-    }
-    active_timers[user_id] = []
+    # Новый /start — пользователь снова на связи
+    suppressions.clear(update.message.chat_id)
 
-    # Ваше первое сообщение без изменений
-    await update.message.reply_text(
-        """<b>привет!</b> искренне рад тебя видеть на моем мини-курсе
+    # Пока идёт /start, кнопки и таймеры этого пользователя ждут своей очереди
+    async with mailboxes.hold(user_id):
+        await cleanup_user(user_id)
 
-За 3 видео, ты узнаешь:
+        user_states[user_id] = UserSession(update.message.chat_id)
+        save_user(user_id)
+        enforce_user_limit()
 
-1. Основы дизайна, как скачать и работать в Photoshop
+        await outbound.call(update.message.reply_text, **course.messages['welcome'])
 
-2. Сделаешь дизайн своего списка желаний
+        # Небольшая пауза перед отправкой первого видео
+        schedule_step(user_id, 1, send_video, (1,), context)
 
-3. Создашь карточку товара для WB
 
-4. Разберешься как искать клиентов и зарабатывать
+@instrument('send_video')
+async def send_video(user_id, video_num, context):
+    """Отправляет видео и кнопку"""
+    # shutting_down здесь не проверяем: начатую цепочку сообщений при остановке
+    # доводим до конца, чтобы пользователь не застрял между уроками
+    session = user_states.get(user_id)
+    if session is None:
+        return
 
-<b>Я разработал лучший способ поиска заказов, мои ученики уже применили его и зарабатывают.</b>
+    lesson = course.lesson(video_num)
+    if lesson is None:
+        # Курс укоротили, пока пользователь его проходил
+        await send_final_video(user_id, context)
+        return
 
-Для тебя это точно будет полезный навык""",
-        parse_mode="HTML"
-    )
+    FUNNEL_LESSONS.labels(video_num).inc()
+    events.record(analytics.LESSON_SENT, user_id, video_num)
 
-    # Небольшая пауза перед отправкой первого видео
-    await asyncio.sleep(1)
-    await send_video(user_id, 1, context)
+    chat_id = session.chat_id
+    button_msg = None
 
+    # Урок одним запросом: текст в подписи к видео, кнопка под видео
+    if lesson.captioned is not None:
+        try:
+            button_msg = await outbound.call(context.bot.send_video, chat_id=chat_id, **lesson.captioned)
+            button_kind = BUTTON_CAPTION
+            logger.info("Видео %s отправлено по file_id", video_num, extra={'event': 'video_sent', 'lesson': video_num})
+        except BadRequest as e:
+            # Telegram не принял подпись (лимит считается иначе) или видео — отправляем по частям.
+            # Сетевые ошибки не ловим: сообщение могло дойти, повтор по частям его продублирует
+            SEND_FALLBACKS.labels('lesson').inc()
+            logger.warning(
+                "Урок %s не отправлен одним сообщением: %s", video_num, e,
+                extra={'event': 'lesson_fallback', 'lesson': video_num}
+            )
+        except (NetworkError, RetryAfter) as e:
+            # Урок мог дойти (таймаут) или нет (исчерпаны повторы): по частям не дублируем,
+            # но воронку не останавливаем — авто-переход продолжит курс без нажатия
+            logger.error(
+                "Ошибка отправки урока %s: %s", video_num, e,
+                extra={'event': 'video_send_failed', 'lesson': video_num}
+            )
+            if lesson.button is None:
+                schedule_step(user_id, 3, send_final_video, (), context)
+                return
+            # Номер сообщения с кнопкой неизвестен: нажатие засчитается, снимать нечего
+            session.button_msg = 0
+            session.button_lesson = video_num
+            session.button_kind = BUTTON_CAPTION
+            session.lesson_sent_at = scheduler.clock()
+            save_user(user_id)
+            set_timer(
+                user_id, video_num, scheduler.clock() + AUTO_NEXT_DELAY,
+                auto_next_video, (video_num,), context
+            )
+            return
+    if button_msg is None:
+        button_msg, button_kind = await send_lesson_parts(chat_id, lesson, context)
+
+    # Кнопка подтверждения (у последнего урока её нет)
+    if lesson.button is not None:
+        session.button_msg = button_msg.message_id
+        session.button_lesson = video_num
+        session.button_kind = button_kind
+        session.lesson_sent_at = scheduler.clock()
+        save_user(user_id)
+
+        # 4. Запускаем таймер авто-продолжения. Во время остановки таймер тоже ставим:
+        # он сохранится в хранилище и сработает уже в следующем процессе
+        set_timer(
+            user_id, video_num, scheduler.clock() + AUTO_NEXT_DELAY,
+            auto_next_video, (video_num,), context
+        )
+    else:
+        # После последнего урока - финальное сообщение через 3 секунды
+        schedule_step(user_id, 3, send_final_video, (), context)
 
-async def send_video(user_id, video_num, context):
-    """Отправляет видео и кнопку"""
-    if user_id not in user_states or shutting_down:
-        return
 
-    chat_id = user_states[user_id]['chat_id']
-    video_data = VIDEOS[video_num]
+async def send_lesson_parts(chat_id, lesson, context):
+    """Запасной план урока: видео (или ссылка) и текст с кнопкой отдельными сообщениями.
 
-    # 2. Отправляем само видео (ссылка или файл)
+    Возвращает сообщение с кнопкой и его вид (course.BUTTON_*).
+    """
+    video_num = lesson.number
     try:
-        await context.bot.send_video(
-            chat_id=chat_id,
-            video=video_data['file_id'],
-            supports_streaming=True,
-            disable_notification=True
-        )
-        logger.info(f"Видео {video_num} отправлено по file_id")
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=video_data['text_before'],
-            parse_mode='HTML',
-            disable_web_page_preview=True
-        )
+        if lesson.video is None:
+            raise FileNotFoundError(f"у урока {video_num} нет file_id")
+        await outbound.call(context.bot.send_video, chat_id=chat_id, **lesson.video)
+        logger.info("Видео %s отправлено по file_id", video_num, extra={'event': 'video_sent', 'lesson': video_num})
 
     except (FileNotFoundError, Exception) as e:
-        logger.error(f"Ошибка отправки видео {video_num} по file_id: {e}")
-        # Резервный вариант - отправляем ссылку
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"📺 Смотрите видео по ссылке:\n{video_data['url']}",
-            parse_mode='HTML',
-            disable_web_page_preview=False
-        )
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=video_data['text_before'],
-            parse_mode='HTML',
-            disable_web_page_preview=True
-        )
-
-    # 3. Отправляем кнопку подтверждения
-    if video_num < 3:
-        keyboard = [[
-            InlineKeyboardButton(
-                f"✅ Я посмотрел видео {video_num}",
-                callback_data=f'watched_{video_num}'
-            )
-        ]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        button_msg = await context.bot.send_message(
-            chat_id=chat_id,
-            text="После просмотра видео нажмите кнопку ниже:",
-            reply_markup=reply_markup
+        logger.error(
+            "Ошибка отправки видео %s по file_id: %s", video_num, e,
+            extra={'event': 'video_send_failed', 'lesson': video_num}
         )
-        user_states[user_id][f'button_msg_{video_num}'] = button_msg.message_id
+        # Резервный вариант - отправляем ссылку
+        if lesson.link is not None:
+            await outbound.call(context.bot.send_message, chat_id=chat_id, **lesson.link)
 
-        # 4. Запускаем таймер авто-продолжения (только для видео 1 и 2)
-        if not shutting_down:
-            # Отменяем предыдущий таймер, если есть
-            timer_key = f'timer_{video_num}'
-            if timer_key in user_states[user_id]:
-                old_timer = user_states[user_id][timer_key]
-                if old_timer and not old_timer.done():
-                    old_timer.cancel()
-
-            # Создаем новый таймер
-            timer = asyncio.create_task(
-                auto_next_video(user_id, video_num, context)
-            )
-            active_timers[user_id].append(timer)
-            user_states[user_id][timer_key] = timer
-    else:
-        # Для третьего видео - сразу запускаем таймер для финального сообщения
-        await asyncio.sleep(3)  # Пауза 3 секунды после отправки 3го видео
-        await send_final_video(user_id, context)
+    if lesson.prompt is not None:
+        try:
+            return await outbound.call(context.bot.send_message, chat_id=chat_id, **lesson.prompt), BUTTON_TEXT
+        except BadRequest as e:
+            SEND_FALLBACKS.labels('prompt').inc()
+            logger.warning("Текст урока %s не отправлен вместе с кнопкой: %s", video_num, e)
+    await outbound.call(context.bot.send_message, chat_id=chat_id, **lesson.text)
+    if lesson.button is None:
+        return None, BUTTON_SEPARATE
+    return await outbound.call(context.bot.send_message, chat_id=chat_id, **lesson.button), BUTTON_SEPARATE
+
+
+async def close_lesson_button(session, lesson_num, notice, context):
+    """Убирает кнопку урока: отметка о просмотре и выводы одним редактированием сообщения с кнопкой.
+
+    Если редактирование не удалось (текст не влезает в лимит, сообщение удалено),
+    кнопка снимается отдельно, а выводы приходят новым сообщением — эти два запроса
+    независимы и идут параллельно.
+    """
+    chat_id = session.chat_id
+    lesson = course.lesson(lesson_num)
+    # Кнопка этого урока ещё на экране (после перезапуска её может не быть)
+    message_id = session.button_msg if session.button_msg and session.button_lesson == lesson_num else None
+    kind = session.button_kind
+    closing = lesson.closing(kind, notice) if lesson is not None and message_id else None
+    if closing is not None:
+        edit = context.bot.edit_message_caption if kind == BUTTON_CAPTION else context.bot.edit_message_text
+        try:
+            await outbound.call(edit, chat_id=chat_id, message_id=message_id, **closing)
+            return
+        except ChatSuppressed:
+            raise
+        except Exception as e:
+            logger.warning("Не удалось дописать выводы к кнопке: %s", e, extra={'event': 'edit_failed'})
+    if message_id:
+        SEND_FALLBACKS.labels('closing').inc()
+
+    calls = []
+    if message_id:
+        if kind == BUTTON_SEPARATE:
+            calls.append(outbound.call(context.bot.edit_message_text, chat_id=chat_id, message_id=message_id,
+                                       text=notice))
+        else:
+            # Текст урока остаётся, пропадает только кнопка
+            calls.append(outbound.call(context.bot.edit_message_reply_markup, chat_id=chat_id,
+                                       message_id=message_id, reply_markup=None))
+    if lesson is not None:
+        calls.append(outbound.call(context.bot.send_message, chat_id=chat_id, **lesson.conclusions))
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    if message_id and isinstance(results[0], Exception):
+        logger.error("Ошибка при редактировании кнопки: %s", results[0], extra={'event': 'edit_failed'})
+    if lesson is not None and isinstance(results[-1], BaseException):
+        raise results[-1]
+
+
+async def answer_callback(query):
+    # Мимо очереди отправки: ответ на нажатие не занимает лимиты чата и не ждёт рассылок
+    try:
+        await query.answer()
+    except Exception as e:
+        # Ответ только убирает «часики» с кнопки: из-за сбоя сети нажатие не теряем
+        logger.warning("Не удалось ответить на нажатие: %s", e, extra={'event': 'answer_failed'})
 
 
 async def auto_next_video(user_id, current_video_num, context):
-    """Автоматически переходит к следующему видео через 10 минут"""
+    """Автоматически переходит к следующему видео (срабатывает через AUTO_NEXT_DELAY)"""
     try:
-        # На продакшене: 600 секунд (10 минут), на локальном: 30 секунд для теста
-        wait_time = 600 if IS_PRODUCTION else 30
-        await asyncio.sleep(wait_time)
-
-        if (shutting_down or
-                user_id not in user_states or
-                user_states[user_id].get('current_video') != current_video_num):
+        session = user_states.get(user_id)
+        if session is None or session.current_video != current_video_num:
             return
 
         # Обновляем состояние
-        user_states[user_id]['current_video'] = current_video_num + 1
+        session.current_video = current_video_num + 1
+        FUNNEL_WATCHED.labels(current_video_num, 'auto').inc()
+        events.record(analytics.WATCHED_AUTO, user_id, current_video_num)
+        save_user(user_id)
 
-        # Редактируем сообщение с кнопкой
-        if f'button_msg_{current_video_num}' in user_states[user_id]:
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=user_states[user_id]['chat_id'],
-                    message_id=user_states[user_id][f'button_msg_{current_video_num}'],
-                    text="⏰ Уже посмотрел урок? Отправляю следующий..."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка при редактировании сообщения: {e}")
-
-        # Удаляем таймер
-        user_states[user_id].pop(f'timer_{current_video_num}', None)
+        # Удаляем сработавший таймер
+        session.pop_timer(current_video_num)
 
-        # Отправляем выводы по уроку
-        await context.bot.send_message(
-            chat_id=user_states[user_id]['chat_id'],
-            text=VIDEOS[current_video_num]['conclusions'],
-            parse_mode='HTML'
-        )
+        # Вместо кнопки — отметка об авто-переходе и выводы по уроку
+        await close_lesson_button(session, current_video_num, AUTO_NEXT_NOTICE, context)
 
         # Пауза и отправка следующего видео
-        await asyncio.sleep(2)
-        if current_video_num < 3:
-            await send_video(user_id, current_video_num + 1, context)
+        if current_video_num < course.last:
+            schedule_step(user_id, 2, send_video, (current_video_num + 1,), context)
 
-    except asyncio.CancelledError:
-        logger.info(f"Таймер отменен")
+    except ChatSuppressed:
+        raise
     except Exception as e:
-        logger.error(f"Ошибка в auto_next_video: {e}")
+        logger.error("Ошибка в auto_next_video: %s", e, extra={'event': 'auto_next_failed'})
 
 
+@instrument('button_handler')
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на кнопки"""
     if shutting_down:
         return
 
     query = update.callback_query
-    await query.answer()
+    # Ответ на нажатие не зависит от остальных запросов и идёт параллельно с ними
+    answering = asyncio.ensure_future(answer_callback(query))
+    try:
+        await handle_click(update, context, query)
+    finally:
+        await answering
+
 
+async def handle_click(update, context, query):
     user_id = update.effective_user.id
+    bind_log_context(user_id=user_id, handler='button_handler')
     data = query.data
 
     if data.startswith('watched_'):
         video_num = int(data.split('_')[1])
 
-        if user_id not in user_states:
-            await query.message.reply_text("Пожалуйста, начните с команды /start")
-            return
+        # Нажатие обрабатывается в очереди пользователя: авто-переход по таймеру
+        # не может выполниться одновременно с ним
+        async with mailboxes.hold(user_id):
+            session = user_states.get(user_id)
+            if session is None:
+                await outbound.call(query.message.reply_text, "Пожалуйста, начните с команды /start")
+                return
 
-        # Отменяем таймер для этого видео (только для видео 1 и 2)
-        if video_num < 3:
-            timer_key = f'timer_{video_num}'
-            if timer_key in user_states[user_id]:
-                timer = user_states[user_id][timer_key]
-                if not timer.done():
-                    timer.cancel()
-                user_states[user_id].pop(timer_key, None)
+            # Идемпотентность по ключу watched_N: засчитываем только кнопку текущего урока.
+            # Повторное нажатие, устаревшая кнопка (например, урока 1 до повторного /start)
+            # или клик после авто-перехода ничего не отправляют заново
+            message_id = query.message.message_id if query.message is not None else None
+            if (session.current_video != video_num or session.button_lesson != video_num
+                    or (session.button_msg and message_id != session.button_msg)):
+                DUPLICATE_CLICKS.labels(video_num).inc()
+                logger.info(
+                    "Повторное нажатие watched_%s (текущий урок %s)", video_num, session.current_video,
+                    extra={'event': 'duplicate_click', 'lesson': video_num}
+                )
+                return
 
-        # Обновляем состояние
-        user_states[user_id]['current_video'] = video_num + 1
+            # Отменяем таймер авто-продолжения для этого видео
+            cancel_timer(user_id, video_num)
 
-        # Редактируем сообщение с кнопкой
-        try:
-            await query.edit_message_text(
-                text="✅ Вы подтвердили просмотр видео!"
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при редактировании кнопки: {e}")
+            # Обновляем состояние
+            session.current_video = video_num + 1
+            FUNNEL_WATCHED.labels(video_num, 'button').inc()
+            # Время от отправки кнопки до нажатия
+            waited = scheduler.clock() - session.lesson_sent_at if session.lesson_sent_at else 0.0
+            events.record(analytics.WATCHED_BUTTON, user_id, video_num, waited)
+            save_user(user_id)
 
-        # Отправляем выводы по уроку
-        await query.message.reply_text(
-            VIDEOS[video_num]['conclusions'],
-            parse_mode='HTML'
-        )
+            # Вместо кнопки — подтверждение просмотра и выводы по уроку
+            await close_lesson_button(session, video_num, WATCHED_NOTICE, context)
 
-        # Пауза и отправка следующего видео
-        await asyncio.sleep(1)
-
-        if video_num < 2:
-            await send_video(user_id, video_num + 1, context)
-        elif video_num == 2:
-            # Для второго видео сразу отправляем третье видео
-            await send_video(user_id, 3, context)
+            # Пауза и отправка следующего видео
+            if video_num < course.last:
+                schedule_step(user_id, 1, send_video, (video_num + 1,), context)
 
 
+@instrument('send_final_video')
 async def send_final_video(user_id, context):
     """Отправляет финальное видео (без изменений)"""
-    if user_id not in user_states:
+    session = user_states.get(user_id)
+    if session is None:
         return
 
-    chat_id = user_states[user_id]['chat_id']
+    chat_id = session.chat_id
+    final_video = course.final_video
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text="🎉 **Поздравляю! Вы завершили все видео-уроки!**\n\n"
-             "Теперь вас ждёт специальное видео-сообщение от автора.",
-        parse_mode='Markdown'
-    )
+    await outbound.call(context.bot.send_message, chat_id=chat_id, **course.messages['completed'])
 
     video_sent = False
 
-    if os.path.exists(FINAL_VIDEO['file_path']):
+    if final_video.file_path and os.path.exists(final_video.file_path):
         try:
-            # Пробуем отправить как Video Note (кружок)
+            # Пробуем отправить как Video Note (кружок); файл загружается один раз,
+            # дальше отправляется по сохранённому file_id
             try:
-                with open(FINAL_VIDEO['file_path'], 'rb') as video_file:
-                    await context.bot.send_video_note(
+                await media_cache.send(
+                    'video_note', final_video.file_path,
+                    lambda media: outbound.call(
+                        context.bot.send_video_note,
                         chat_id=chat_id,
-                        video_note=video_file,
-                        duration=38,
-                        length=640
-                    )
-                    video_sent = True
-
-            except Exception as note_error:
-                logger.warning(f"Не удалось отправить как Video Note: {note_error}")
+                        video_note=media,
+                        duration=final_video.duration,
+                        length=final_video.length
+                    ),
+                    lambda message: message.video_note.file_id if message.video_note else None
+                )
+                video_sent = True
+
+            except BadRequest as note_error:
+                # Telegram не принял файл как кружок — пробуем обычным видео. Сетевые
+                # ошибки сюда не попадают: их уже повторила очередь отправки, и вторая
+                # загрузка того же файла не поможет — сразу отправим ссылку
+                logger.warning(
+                    "Не удалось отправить как Video Note: %s", note_error, extra={'event': 'final_video_fallback'}
+                )
 
-                with open(FINAL_VIDEO['file_path'], 'rb') as video_file:
-                    await context.bot.send_video(
+                await media_cache.send(
+                    'video', final_video.file_path,
+                    lambda media: outbound.call(
+                        context.bot.send_video,
                         chat_id=chat_id,
-                        video=video_file,
+                        video=media,
                         supports_streaming=False
-                    )
-                    video_sent = True
+                    ),
+                    lambda message: message.video.file_id if message.video else None
+                )
+                video_sent = True
 
         except Exception as e:
-            logger.error(f"Ошибка при отправке финального видео: {e}")
+            logger.error("Ошибка при отправке финального видео: %s", e, extra={'event': 'final_video_failed'})
             video_sent = False
 
     if not video_sent:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"{FINAL_VIDEO['url']}\n\n",
-            disable_web_page_preview=False
-        )
-    await asyncio.sleep(2)
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text="<b>Поздравляю</b> тебя <b>с прохождением</b> Миникурса!\n\n"
-"Ты проделал(а) классную работу!\n"
-"Надеюсь теперь, ты полюбил(а) дизайн также сильно, как и я\n\n"
-"Буду искренне рад видеть тебя на своем предобучение -\n\n"
-"предобучение - это часть моего <b>основного курса</b>,\n" 
-"где в течении 5 дней ты сможешь побыть на нем в роли студента\n\n"
-"Что ты получишь:\n\n"
-"<b>+ 20 актульных способов поиска клиентов</b>\n"
-"- Освоешь первостепенные навыки дизайна\n"
-"- Научишься работать в Photoshop\n"
-"- Cделашь первые качественные карточки\n"
-"- Получишь от меня обратную связь на все вопросы\n\n\n"
-"<b><u>Те кто прошел миникурс могут занять место на предобучении со\n"
-"СКИДКОЙ 50% на 24 ЧАСА</u></b>\n\n"
-"↓ ↓ ↓ ↓\n"
-"https://t.me/Alexander_brez\n"
-"https://t.me/Alexander_brez\n"
-"https://t.me/Alexander_brez\n\n"
-"напиши мне: 'дизайн' - и я покажу всю программу предобучения\n"
-"Telegram (https://t.me/Alexander_brez)\n"
-"Брезденюк | Дизайнер\n"
-"Канал про дизайн: https://t.me/brezdenuk", parse_mode="HTML",
-        disable_web_page_preview=True
-    )
+        await outbound.call(context.bot.send_message, chat_id=chat_id, **final_video.link)
+    schedule_step(user_id, 2, send_final_offer, (), context)
 
-    user_states[user_id]['completed'] = True
+
+async def send_final_offer(user_id, context):
+    """Итоговое сообщение с предложением и таймер скидки (шаг после финального видео)"""
+    session = user_states.get(user_id)
+    if session is None:
+        return
+
+    await outbound.call(context.bot.send_message, chat_id=session.chat_id, **course.messages['final'])
+
+    session.completed = True
+    FUNNEL_COMPLETED.inc()
+    events.record(analytics.COMPLETED, user_id)
+    save_user(user_id)
 
     # Устанавливаем таймер для отправки напоминания о скидке через 21 час
-    if not user_states[user_id].get('discount_timer_set', False):
+    if not session.discount_timer_set:
         # Рассчитываем время отправки (21 час с момента финального сообщения)
-        reminder_time = datetime.now() + timedelta(hours=21)
+        reminder_time = scheduler.clock() + DISCOUNT_REMINDER_DELAY
 
-        # Создаем отложенную задачу
-        reminder_timer = asyncio.create_task(
-            delayed_discount_reminder(user_id, context)
-        )
+        # Ставим таймер в общий планировщик
+        set_timer(user_id, DISCOUNT_SLOT, reminder_time, delayed_discount_reminder, (), context)
 
-        # ВАЖНО: добавляем таймер в active_timers
-        if user_id not in active_timers:
-            active_timers[user_id] = []
-        active_timers[user_id].append(reminder_timer)
+        session.discount_timer_set = True
+        session.discount_reminder_time = reminder_time
+        save_user(user_id)
 
-        user_states[user_id]['discount_timer_set'] = True
-        user_states[user_id]['discount_reminder_time'] = reminder_time
-
-        logger.info(f"Таймер скидки установлен для пользователя {user_id} на {reminder_time}")
+        logger.info(
+            "Таймер скидки установлен на %s", datetime.fromtimestamp(reminder_time),
+            extra={'event': 'discount_scheduled'}
+        )
 
 
 async def delayed_discount_reminder(user_id, context):
-    """Отправляет напоминание о скидке через 21 час"""
+    """Отправляет напоминание о скидке (срабатывает через 21 час)"""
+    # Во время остановки сюда не попадаем: fire_timer оставляет таймер следующему процессу
     try:
-        # Ждем 3 секунды для теста (или 21 час для продакшена)
-        await asyncio.sleep(21 * 3600)
+        # ЗДЕСЬ ВАЖНО: проверяем chat_id без использования user_states
+        chat_id = None
 
-        # Проверяем, не завершается ли бот
-        if not shutting_down:
-            # ЗДЕСЬ ВАЖНО: проверяем chat_id без использования user_states
-            chat_id = None
-
-            # Если пользователь все еще в user_states, берем оттуда
-            if user_id in user_states:
-                chat_id = user_states[user_id]['chat_id']
-            else:
-                # Пользователь уже удален, нужно сохранить chat_id заранее
-                # Но мы это сделаем по-другому
-                return
+        # Если пользователь все еще в user_states, берем оттуда
+        if user_id in user_states:
+            chat_id = user_states[user_id].chat_id
+        else:
+            # Пользователь уже удален, нужно сохранить chat_id заранее
+            # Но мы это сделаем по-другому
+            return
 
-            if chat_id:
-                await send_discount_reminder(context, chat_id)
+        if chat_id and await send_discount_reminder(context, chat_id):
+            events.record(analytics.DISCOUNT_SENT, user_id)
 
-    except asyncio.CancelledError:
-        logger.info(f"Таймер скидки отменен для пользователя {user_id}")
     except Exception as e:
-        logger.error(f"Ошибка в delayed_discount_reminder: {e}")
+        logger.error("Ошибка в delayed_discount_reminder: %s", e, extra={'event': 'discount_failed'})
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /help"""
-    await update.message.reply_text(
+    await outbound.call(
+        update.message.reply_text,
         "ℹ️ <b>Помощь:</b>\n\n"
         "/start - Начать обучение\n"
         "/help - Эта справка\n\n"
@@ -543,6 +891,477 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+# ========== РАССЫЛКИ ==========
+# Выборки получателей — по сохранённому состоянию пользователя (UserSession.to_dict).
+# Прошедшие курс и выгруженные по сроку хранения остаются в хранилище записью
+# {chat_id, completed, archived} (drop_user) и попадают в all и completed
+BROADCAST_TARGETS = {
+    'all': lambda data: True,
+    'completed': lambda data: data.get('completed', False),
+    'in_progress': lambda data: not data.get('completed', False),
+}
+
+
+async def send_broadcast_message(bot, chat_id, message):
+    # Рассылка идёт в очереди плановых сообщений и не тормозит ответы пользователям
+    await outbound.call(bot.send_message, chat_id=chat_id, priority=SCHEDULED, **message)
+
+
+def format_broadcast(record):
+    return (
+        f"<b>{record['id']}</b> [{record['target']}] {record['status']}: "
+        f"выбрано {record['selected']}, доставлено {record['delivered']}, "
+        f"заблокировали {record['blocked']}, ошибок {record['failed']}"
+    )
+
+
+async def report_broadcast(bot, record):
+    """Отчёт администратору, запустившему рассылку"""
+    if record['notify_chat_id']:
+        await outbound.call(
+            bot.send_message, chat_id=record['notify_chat_id'],
+            text="📣 Рассылка завершена\n" + format_broadcast(record), parse_mode='HTML'
+        )
+
+
+broadcasts = BroadcastEngine(
+    state_store, send_broadcast_message, BROADCAST_TARGETS, report_broadcast,
+    chunk_size=BROADCAST_CHUNK_SIZE, concurrency=BROADCAST_CONCURRENCY,
+)
+Gauge('bot_broadcasts_running', 'Выполняющихся рассылок', lambda: broadcasts.running)
+
+
+def whole_bot_command(handler):
+    """Служебная команда, которой нужны все пользователи бота, а не доля одного воркера.
+
+    В режиме шардов апдейт администратора попадает в один воркер из SHARD_COUNT:
+    рассылка дошла бы примерно до 1/N пользователей, профиль и задачи показали бы
+    один процесс. Такие команды в этом режиме отклоняются.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        if SHARD_COUNT > 1:
+            await outbound.call(
+                update.message.reply_text,
+                f"Команда недоступна в режиме шардов: этот воркер видит 1/{SHARD_COUNT} пользователей. "
+                "Запустите бота с BOT_WORKERS=1"
+            )
+            return
+        return await handler(update, context)
+    return wrapper
+
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /broadcast (только для ADMIN_USER_IDS).
+
+    /broadcast — состояние рассылок
+    /broadcast <выборка> <текст в HTML> — запустить рассылку
+    /broadcast cancel <id> — отменить
+    """
+    parts = update.message.text.split(maxsplit=2)
+    if len(parts) == 1:
+        records = broadcasts.records()[:10]
+        text = "\n".join(format_broadcast(record) for record in records) or "Рассылок ещё не было"
+        await outbound.call(update.message.reply_text, text, parse_mode='HTML')
+        return
+
+    if parts[1] == 'cancel' and len(parts) == 3:
+        cancelled = broadcasts.cancel(parts[2].strip())
+        await outbound.call(
+            update.message.reply_text, "Рассылка отменена" if cancelled else "Нет такой активной рассылки"
+        )
+        return
+
+    if parts[1] not in BROADCAST_TARGETS or len(parts) < 3:
+        await outbound.call(
+            update.message.reply_text,
+            "Использование: /broadcast &lt;выборка&gt; &lt;текст&gt;\n"
+            f"Выборки: {', '.join(BROADCAST_TARGETS)}\n"
+            "/broadcast cancel &lt;id&gt; — отменить",
+            parse_mode='HTML'
+        )
+        return
+
+    message = {'text': parts[2], 'parse_mode': 'HTML', 'disable_web_page_preview': True}
+    record = broadcasts.start(parts[1], message, notify_chat_id=update.message.chat_id)
+    await outbound.call(update.message.reply_text, f"📣 Рассылка {record['id']} запущена")
+
+
+# ========== ПРОФИЛИРОВАНИЕ ==========
+# Идущее окно профилирования (одно на процесс) и задача, которая пришлёт результат
+profile_session = None
+profile_task = None
+
+
+def timer_counts():
+    """Ожидающие таймеры пользователей по колбэку (auto_next_video, send_video, ...)"""
+    counts = {}
+    for session in user_states.values():
+        for timer in session.pending_timers():
+            name = timer.args[2].__name__ if timer.callback is fire_timer else timer.callback.__name__
+            counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def format_tasks(limit=15):
+    lines = ["Живые задачи asyncio:"]
+    tasks = profiling.task_counts()
+    lines.extend(f"{count:6}  {label}" for label, count in tasks.most_common(limit))
+    if len(tasks) > limit:
+        lines.append(f"… и ещё {len(tasks) - limit} видов")
+    lines.append("\nОжидающие таймеры пользователей:")
+    timers = sorted(timer_counts().items(), key=lambda item: item[1], reverse=True)
+    lines.extend(f"{count:6}  {name}" for name, count in timers)
+    lines.append(f"всего в планировщике: {scheduler.pending}, выполняются: {scheduler.in_flight}")
+    return '\n'.join(lines)
+
+
+def _clip(text):
+    limit = 4096
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+async def run_profile(session, bot, chat_id):
+    """Снимает профиль и присылает администратору файл стеков и сводку"""
+    global profile_session, profile_task
+    try:
+        await session.run()
+        await outbound.call(
+            bot.send_document,
+            chat_id=chat_id,
+            document=session.sampler.collapsed().encode(),
+            filename=f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded",
+            caption="Collapsed stacks: flamegraph.pl, speedscope.app или inferno-flamegraph",
+        )
+        await outbound.call(bot.send_message, chat_id=chat_id, text=_clip(session.summary() + '\n\n' + format_tasks()))
+    except Exception as e:
+        logger.error("Ошибка профилирования: %s", e, extra={'event': 'profile_failed'})
+    finally:
+        profile_session = None
+        profile_task = None
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /profile (только для ADMIN_USER_IDS).
+
+    /profile [секунды] — снять профиль (по умолчанию 30 с) и прислать стеки и сводку
+    /profile stop — закончить раньше
+    """
+    global profile_session, profile_task
+    parts = update.message.text.split()
+    if len(parts) > 1 and parts[1] == 'stop':
+        if profile_session is None:
+            await outbound.call(update.message.reply_text, "Профилирование не запущено")
+        else:
+            profile_session.stop()
+        return
+    if profile_session is not None:
+        await outbound.call(update.message.reply_text, "Профилирование уже идёт: /profile stop — закончить")
+        return
+    try:
+        seconds = float(parts[1]) if len(parts) > 1 else 30.0
+    except ValueError:
+        seconds = 0.0
+    if seconds <= 0:
+        await outbound.call(update.message.reply_text, "Использование: /profile [секунды] | /profile stop")
+        return
+
+    profile_session = profiling.ProfileSession(seconds)
+    # Окно идёт в отдельной задаче: обработчик не занимает слот обработки апдейтов
+    profile_task = asyncio.create_task(run_profile(profile_session, context.bot, update.message.chat_id))
+    await outbound.call(
+        update.message.reply_text, f"⏱ Профилирую {profile_session.seconds:.0f} с, результат пришлю сюда"
+    )
+
+
+async def tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /tasks (только для ADMIN_USER_IDS): задачи asyncio и таймеры прямо сейчас"""
+    await outbound.call(update.message.reply_text, _clip(format_tasks()))
+
+
+async def restore_state(application):
+    """Поднимает пользователей и отложенные таймеры из хранилища"""
+    users, timers = await state_store.open(create_backend(path=STATE_DB_PATH))
+    suppressions.load()
+    # Архивные записи выгруженных пользователей нужны только рассылкам
+    users = {user_id: data for user_id, data in users.items() if not data.get('archived')}
+    for user_id, data in users.items():
+        session = user_states[user_id] = UserSession.from_dict(data)
+        retention.touch(user_id, session.completed, session.discount_reminder_time)
+
+    # Таймерам нужен контекст с ботом, но не привязанный к конкретному апдейту
+    context = CallbackContext(application)
+    callbacks = {
+        callback.__name__: callback
+        for callback in (auto_next_video, delayed_discount_reminder, send_video, send_final_video, send_final_offer)
+    }
+    restored = overdue = 0
+    now = scheduler.clock()
+    for user_id, key, callback_name, args, due in timers:
+        if (user_id not in user_states or callback_name not in callbacks
+                or user_states[user_id].chat_id in suppressions):
+            state_store.delete_timer(user_id, key)
+            continue
+        # Просроченные за время простоя таймеры сработают сразу
+        slot = timer_slot(key)
+        user_states[user_id].set_timer(
+            slot, scheduler.call_at(due, fire_timer, user_id, slot, callbacks[callback_name], args, context)
+        )
+        restored += 1
+        overdue += due <= now
+
+    logger.info(
+        "Восстановлено пользователей: %s, таймеров: %s (просрочено и сработает сразу: %s)",
+        len(users), restored, overdue, extra={'event': 'state_restored'}
+    )
+
+
+def snapshot_timers():
+    """Заново записывает в хранилище все ожидающие таймеры с их сроками.
+
+    Таймеры пишутся и при постановке, но снимок при остановке гарантирует, что
+    следующий процесс увидит ровно то, что ждало в планировщике.
+    """
+    saved = 0
+    for session in user_states.values():
+        for timer in session.pending_timers():
+            user_id, slot, callback, args, _ = timer.args
+            state_store.save_timer(user_id, timer_key(slot), callback.__name__, args, timer.when)
+            saved += 1
+    return saved
+
+
+async def metrics_handler(request):
+    return Response(200, REGISTRY.render(), 'text/plain; version=0.0.4; charset=utf-8')
+
+
+async def start_metrics_server():
+    """Отдельный HTTP сервер для /metrics, чтобы не светить метрики на порту webhook"""
+    global metrics_server
+    if METRICS_PORT and metrics_server is None:
+        metrics_server = HttpServer('0.0.0.0', int(METRICS_PORT))
+        metrics_server.route('GET', '/metrics', metrics_handler)
+        await metrics_server.start()
+
+
+async def post_init(application):
+    """Запуск фоновых сервисов после инициализации приложения"""
+    await restore_state(application)
+    state_store.start()
+    events.start()
+    updates_recorder.start()
+    outbound.suppression = suppressions
+    outbound.start()
+    scheduler.start()
+    loop_lag.start()
+    await start_metrics_server()
+    # Прерванные остановкой рассылки продолжаются с сохранённого курсора
+    broadcasts.resume(application.bot)
+    # Первая очистка — сразу после старта: за время простоя сроки могли истечь
+    scheduler.call_later(0, cleanup_completed_users)
+    if COURSE_RELOAD_INTERVAL > 0:
+        scheduler.call_later(COURSE_RELOAD_INTERVAL, reload_course)
+
+
+async def post_stop(application):
+    """Плавная остановка: приложение уже не принимает апдейты, но бот ещё может отправлять.
+
+    Ждём сработавшие таймеры, отправляем очередь исходящих сообщений и сохраняем
+    ожидающие таймеры — следующий процесс поднимет их в restore_state.
+    """
+    global shutting_down
+    shutting_down = True
+    logger.info(
+        "Остановка: таймеров в работе %s, ожидают %s, в очереди отправки %s",
+        scheduler.in_flight, scheduler.pending, outbound.queue_depth, extra={'event': 'shutdown_started'}
+    )
+    await broadcasts.stop()
+    if profile_task is not None:
+        # Недоснятый профиль отправляем сейчас, пока очередь отправки работает
+        profile_session.stop()
+        await asyncio.wait({profile_task}, timeout=SHUTDOWN_TIMEOUT)
+    await scheduler.stop(SHUTDOWN_TIMEOUT)
+    await outbound.stop(SHUTDOWN_TIMEOUT)
+    saved = snapshot_timers()
+    # Сохранённые таймеры в этом процессе больше не срабатывают: общий планировщик
+    # нескольких ботов (tenants.py) продолжает работать после остановки этого бота
+    for session in user_states.values():
+        for timer in session.pending_timers():
+            timer.cancel()
+    await state_store.flush()
+    await events.stop()
+    await updates_recorder.stop()
+    logger.info(
+        "Остановка: сохранено таймеров %s, несохранённых изменений %s", saved, state_store.pending_writes,
+        extra={'event': 'shutdown_finished'}
+    )
+
+
+async def post_shutdown(application):
+    """Остановка фоновых сервисов"""
+    loop_lag.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    await state_store.stop()
+
+
+def build_application(request=None, **builder_options):
+    """Собирает приложение с обработчиками (request — общий HTTP клиент нескольких ботов)"""
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(CONCURRENT_UPDATES)
+    )
+    if updates_recorder.enabled:
+        # Апдейты записываются в момент поступления в очередь приложения
+        builder = builder.update_queue(RecordingQueue(updates_recorder))
+    if request is not None:
+        builder = builder.request(request)
+    else:
+        builder = builder.connection_pool_size(API_POOL_SIZE).pool_timeout(API_POOL_TIMEOUT)
+    for option, value in builder_options.items():
+        builder = getattr(builder, option)(value)
+    application = builder.build()
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler(
+        "broadcast", whole_bot_command(broadcast_command), filters=filters.User(user_id=ADMIN_USER_IDS)
+    ))
+    application.add_handler(CommandHandler(
+        "profile", whole_bot_command(profile_command), filters=filters.User(user_id=ADMIN_USER_IDS)
+    ))
+    application.add_handler(CommandHandler(
+        "tasks", whole_bot_command(tasks_command), filters=filters.User(user_id=ADMIN_USER_IDS)
+    ))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    return application
+
+
+def webhook_handler(application):
+    """Принимает Update от Telegram, сразу отвечает и кладёт его в очередь приложения"""
+    async def handle(request):
+        if WEBHOOK_SECRET:
+            token = request.headers.get('x-telegram-bot-api-secret-token', '')
+            if not hmac.compare_digest(token, WEBHOOK_SECRET):
+                return Response(403, 'forbidden')
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error("Некорректный Update в webhook: %s", e, extra={'event': 'webhook_bad_update'})
+            return Response(400, 'bad update')
+        application.update_queue.put_nowait(update)
+        return Response(200, 'ok')
+    return handle
+
+
+async def run_application(application, source, stop_signals=(signal.SIGINT, signal.SIGTERM), stop_event=None):
+    """Запускает приложение без run_polling: source(application, stop_event) подаёт апдейты.
+
+    Цикл событий остаётся за вызывающим: после ошибки приложение можно собрать
+    и запустить заново в том же процессе.
+    """
+    if stop_event is None:
+        stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in stop_signals:
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    try:
+        await application.post_init(application)
+        await application.start()
+        try:
+            await source(application, stop_event)
+        finally:
+            await application.stop()
+            await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+
+async def polling_source(application, stop_event):
+    """Long polling через Updater приложения"""
+    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        await stop_event.wait()
+    finally:
+        await application.updater.stop()
+
+
+async def webhook_source(application, stop_event, server=None):
+    """Работа через webhook: свой HTTP сервер вместо long polling.
+
+    server — уже запущенный общий сервер (несколько ботов в одном процессе,
+    у каждого свой WEBHOOK_PATH).
+    """
+    own_server = server is None
+    if own_server:
+        server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    server.route('POST', WEBHOOK_PATH, webhook_handler(application))
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info("Webhook установлен: %s", WEBHOOK_URL + WEBHOOK_PATH, extra={'event': 'webhook_set'})
+        if own_server:
+            await server.start()
+        await stop_event.wait()
+    finally:
+        if own_server:
+            await server.stop()
+
+
+async def run(stop_event=None, stop_signals=(signal.SIGINT, signal.SIGTERM), request=None, server=None, setup=None):
+    """Запускает бота в текущем цикле событий; ошибки не глушит — решение о перезапуске за вызывающим.
+
+    setup(application) — дополнительная настройка собранного приложения перед запуском.
+    """
+    if BOT_MODE == 'webhook':
+        # Обновления приходят по HTTP, Updater для long polling не нужен
+        application = build_application(request, updater=None)
+
+        async def source(application, stop_event):
+            await webhook_source(application, stop_event, server)
+    else:
+        application = build_application(request)
+        source = polling_source
+    if setup is not None:
+        setup(application)
+    await run_application(application, source, stop_signals, stop_event)
+
+
+async def run_worker(conn):
+    """Процесс-воркер шардированного режима: апдейты приходят от супервизора по каналу"""
+    application = build_application(updater=None)
+
+    async def pipe_source(application, stop_event):
+        loop = asyncio.get_running_loop()
+
+        def reader():
+            # Разбор JSON и сборка Update — в потоке чтения, а не в цикле событий
+            try:
+                while True:
+                    update = Update.de_json(json.loads(conn.recv_bytes()), application.bot)
+                    loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
+            except (EOFError, OSError):
+                pass
+            finally:
+                loop.call_soon_threadsafe(stop_event.set)
+
+        threading.Thread(target=reader, name='shard-reader', daemon=True).start()
+        await stop_event.wait()
+
+    await run_application(application, pipe_source, stop_signals=(signal.SIGTERM,))
+
+
 def main():
     """Запуск бота"""
     logger.info("🚀 Запуск Telegram бота...")
@@ -561,18 +1380,11 @@ def main():
         print("=" * 50)
 
     try:
-        application = Application.builder().token(TOKEN).build()
-
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CallbackQueryHandler(button_handler))
-
-        application.run_polling()
-
+        asyncio.run(run())
     except KeyboardInterrupt:
         logger.info("Бот остановлен")
     except Exception as e:
-        logger.error(f"Ошибка: {e}")
+        logger.error("Ошибка: %s", e, extra={'event': 'fatal'})
 
 
 if __name__ == '__main__':
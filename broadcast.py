@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+
+from suppression import is_unreachable
+
+logger = logging.getLogger(__name__)
+
+# Сколько пользователей читать из хранилища за раз
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '500'))
+# Сколько сообщений рассылки одновременно ждут очереди отправки; сам темп задаёт
+# OutboundDispatcher, здесь только ограничение на число висящих запросов
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '32'))
+
+# Прогресс рассылок хранится в meta хранилища под ключами broadcast:<id>
+META_PREFIX = 'broadcast:'
+
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+
+
+def classify_error(error):
+    """Пользователь заблокировал бота или удалил чат — 'blocked', остальное — 'failed'"""
+    return 'blocked' if is_unreachable(error) else 'failed'
+
+
+class BroadcastEngine:
+    """Рассылки по выборке пользователей из хранилища.
+
+    Получатели читаются страницами по user_id, после каждой страницы курсор и
+    счётчики пишутся в meta: прерванная рассылка продолжается с курсора.
+    """
+
+    def __init__(self, store, send, targets, report=None,
+                 chunk_size=BROADCAST_CHUNK_SIZE, concurrency=BROADCAST_CONCURRENCY):
+        # send(bot, chat_id, message) — отправка одного сообщения
+        # targets: {имя: predicate(data)} — по сохранённому состоянию пользователя
+        # report(bot, record) — вызывается по завершении рассылки
+        self.store = store
+        self.send = send
+        self.targets = targets
+        self.report = report
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.bot = None
+        self._tasks = {}
+
+    # ---------- управление ----------
+
+    def records(self):
+        """Все рассылки из хранилища, новые первыми"""
+        records = [
+            value for key, value in self.store.meta.items() if key.startswith(META_PREFIX)
+        ]
+        return sorted(records, key=lambda record: record['started'], reverse=True)
+
+    @property
+    def running(self):
+        return len(self._tasks)
+
+    def get(self, broadcast_id):
+        return self.store.meta.get(META_PREFIX + broadcast_id)
+
+    def start(self, target, message, notify_chat_id=None):
+        """Запускает рассылку message (kwargs для send_message) по выборке target"""
+        if target not in self.targets:
+            raise ValueError(f"Неизвестная выборка: {target}")
+        record = {
+            'id': secrets.token_hex(4),
+            'target': target,
+            'message': dict(message),
+            'notify_chat_id': notify_chat_id,
+            'status': RUNNING,
+            'cursor': 0,
+            'selected': 0,
+            'delivered': 0,
+            'blocked': 0,
+            'failed': 0,
+            'started': time.time(),
+            'finished': None,
+        }
+        self._checkpoint(record)
+        self._spawn(record)
+        return record
+
+    def resume(self, bot):
+        """Продолжает прерванные рассылки (вызывается при старте)"""
+        self.bot = bot
+        resumed = 0
+        for record in self.records():
+            if record['status'] == RUNNING and record['id'] not in self._tasks:
+                self._spawn(dict(record))
+                resumed += 1
+        if resumed:
+            logger.info(f"Продолжены прерванные рассылки: {resumed}")
+        return resumed
+
+    def cancel(self, broadcast_id):
+        record = self.get(broadcast_id)
+        if record is None or record['status'] != RUNNING:
+            return False
+        task = self._tasks.get(broadcast_id)
+        if task is not None:
+            task.cancel()
+        self.store.set_meta(META_PREFIX + broadcast_id, dict(record, status=CANCELLED, finished=time.time()))
+        return True
+
+    async def stop(self):
+        """Прерывает рассылки при остановке; курсор сохранён, продолжатся после перезапуска"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # ---------- выполнение ----------
+
+    def _spawn(self, record):
+        task = asyncio.get_running_loop().create_task(self._run(record))
+        self._tasks[record['id']] = task
+        task.add_done_callback(lambda _: self._tasks.pop(record['id'], None))
+
+    def _checkpoint(self, record):
+        stored = self.get(record['id'])
+        if stored is not None and stored['status'] == CANCELLED:
+            # Отменённую рассылку не перезаписываем прогрессом из её задачи
+            return
+        # Копия: журнал хранилища не должен видеть последующих изменений
+        self.store.set_meta(META_PREFIX + record['id'], dict(record))
+
+    async def _run(self, record):
+        select = self.targets[record['target']]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # Свежие изменения состояния должны попасть в выборку
+        await self.store.flush()
+        try:
+            while True:
+                rows = await self.store.users_page(record['cursor'], self.chunk_size)
+                if not rows:
+                    break
+                recipients = [(user_id, data['chat_id']) for user_id, data in rows if select(data)]
+                record['selected'] += len(recipients)
+                await self._send_chunk(record, recipients, semaphore)
+                record['cursor'] = rows[-1][0]
+                if record.get('sent_ahead'):
+                    record['sent_ahead'] = [user_id for user_id in record['sent_ahead'] if user_id > record['cursor']]
+                self._checkpoint(record)
+        except Exception as e:
+            logger.error(f"Рассылка {record['id']} остановлена из-за ошибки: {e}")
+            self._checkpoint(record)
+            return
+
+        current = self.get(record['id'])
+        if current is not None and current['status'] == CANCELLED:
+            return
+        record['status'] = DONE
+        record['finished'] = time.time()
+        self._checkpoint(record)
+        logger.info(
+            f"Рассылка {record['id']} завершена: доставлено {record['delivered']}, "
+            f"заблокировали {record['blocked']}, ошибок {record['failed']}"
+        )
+        if self.report is not None:
+            try:
+                await self.report(self.bot, record)
+            except Exception as e:
+                logger.error(f"Не удалось отправить отчёт о рассылке: {e}")
+
+    async def _send_chunk(self, record, recipients, semaphore):
+        # Получатели после курсора, которым сообщение ушло до прерывания рассылки
+        ahead = set(record.get('sent_ahead', ()))
+        finished = [user_id in ahead for user_id, _ in recipients]
+
+        async def deliver(index, chat_id):
+            async with semaphore:
+                try:
+                    await self.send(self.bot, chat_id, record['message'])
+                    record['delivered'] += 1
+                except Exception as e:
+                    record[classify_error(e)] += 1
+            finished[index] = True
+
+        try:
+            await asyncio.gather(*(
+                deliver(index, chat_id) for index, (_, chat_id) in enumerate(recipients) if not finished[index]
+            ))
+        except asyncio.CancelledError:
+            # Курсор — до первого получателя, которому отправка не завершилась:
+            # после перезапуска страница продолжится с него, а не с начала.
+            # Тех, кто после курсора уже получил сообщение, запоминаем и пропускаем —
+            # иначе они получат его второй раз и попадут в delivered дважды
+            if False in finished:
+                first = finished.index(False)
+                record['cursor'] = recipients[first][0] - 1
+                record['selected'] -= len(recipients) - first
+                ahead.update(user_id for (user_id, _), done in zip(recipients, finished) if done)
+                record['sent_ahead'] = sorted(user_id for user_id in ahead if user_id > record['cursor'])
+                self._checkpoint(record)
+            raise
@@ -0,0 +1,85 @@
+"""Буферизованная запись на диск: горячий путь только дописывает в память,
+пачка уходит в файл раз в flush_interval в потоке вне цикла событий.
+
+Общая часть журнала аналитики (analytics.EventLog) и записи апдейтов
+(recorder.UpdateRecorder).
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedWriter:
+    """Буфер записей в памяти со сбросом пачками.
+
+    Наследник задаёт пустой буфер (_new_buffer), число записей в пачке (_count)
+    и запись пачки (_write — выполняется в потоке). len(буфера) сравнивается с
+    max_buffer в тех же единицах: элементы списка или байты.
+    """
+
+    # Сообщение в лог, если пачку не удалось записать
+    write_error = "Не удалось записать на диск: %s"
+
+    def __init__(self, directory, flush_interval=1.0, max_buffer=10_000, clock=time.time):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.clock = clock
+        self._buffer = self._new_buffer()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.written = 0
+        self.dropped = 0
+
+    def _new_buffer(self):
+        return []
+
+    def _count(self, batch):
+        return len(batch)
+
+    def _write(self, batch):
+        raise NotImplementedError
+
+    def _accept(self):
+        """Есть ли в буфере место ещё для одной записи; если нет, запись считается потерянной"""
+        if len(self._buffer) >= self.max_buffer * 16:
+            # Диск не успевает — запись не должна съесть память бота
+            self.dropped += 1
+            return False
+        return True
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, self._new_buffer()
+            try:
+                await asyncio.to_thread(self._write, batch)
+                self.written += self._count(batch)
+            except OSError as e:
+                logger.error(self.write_error, e)
+                self.dropped += self._count(batch)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            # Буфер большой — сбрасываем чаще, не дожидаясь интервала
+            while len(self._buffer) >= self.max_buffer:
+                await self.flush()
+
+    def start(self):
+        if self.directory and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
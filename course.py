@@ -0,0 +1,266 @@
+import json
+import os
+from html.parser import HTMLParser
+from types import MappingProxyType
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MessageLimit
+
+# Теги, которые Telegram понимает в parse_mode=HTML
+ALLOWED_TAGS = frozenset((
+    'b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del', 'a', 'code', 'pre',
+    'span', 'tg-spoiler', 'tg-emoji', 'blockquote',
+))
+MESSAGES = ('welcome', 'completed', 'final', 'discount_reminder')
+
+BUTTON_PROMPT = "После просмотра видео нажмите кнопку ниже:"
+# Отметки, которыми заменяется кнопка урока: пользователь нажал её или сработал авто-переход
+WATCHED_NOTICE = "✅ Вы подтвердили просмотр видео!"
+AUTO_NEXT_NOTICE = "⏰ Уже посмотрел урок? Отправляю следующий..."
+
+# Где стоит кнопка урока (UserSession.button_kind)
+BUTTON_SEPARATE = 0  # отдельное сообщение BUTTON_PROMPT (так отправлялись уроки раньше)
+BUTTON_TEXT = 1      # под текстом урока
+BUTTON_CAPTION = 2   # под видео, текст урока — в подписи
+
+
+class CourseError(ValueError):
+    """Описание курса не прошло проверку"""
+
+
+class _HtmlChecker(HTMLParser):
+    """Проверяет разметку и считает длину текста без тегов"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.length = 0
+        self.errors = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ALLOWED_TAGS:
+            self.errors.append(f'тег <{tag}> не поддерживается')
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            self.errors.append(f'непарный </{tag}>')
+        else:
+            self.stack.pop()
+
+    def handle_data(self, data):
+        self.length += len(data)
+
+
+def _check_text(where, text, parse_mode, limit=MessageLimit.MAX_TEXT_LENGTH):
+    if not isinstance(text, str) or not text.strip():
+        raise CourseError(f'{where}: нужен непустой текст')
+    length = len(text)
+    if parse_mode == 'HTML':
+        checker = _HtmlChecker()
+        checker.feed(text)
+        checker.close()
+        if checker.stack:
+            checker.errors.append(f'не закрыт <{checker.stack[-1]}>')
+        if checker.errors:
+            raise CourseError(f'{where}: ' + '; '.join(checker.errors))
+        length = checker.length
+    if length > limit:
+        raise CourseError(f'{where}: {length} символов, Telegram допускает {limit}')
+
+
+def _fits(text, limit):
+    """Проходит ли уже проверенный HTML текст в лимит Telegram"""
+    try:
+        _check_text('', text, 'HTML', limit)
+    except CourseError:
+        return False
+    return True
+
+
+def _int(where, value):
+    """Неотрицательное целое из описания курса (числа в YAML/JSON или строки из цифр)"""
+    if isinstance(value, bool):
+        raise CourseError(f'{where}: ожидается целое число')
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise CourseError(f'{where}: ожидается целое число') from None
+    if number < 0 or number != value and not isinstance(value, str):
+        raise CourseError(f'{where}: ожидается неотрицательное целое число')
+    return number
+
+
+def _str(where, value, default=''):
+    """Необязательная строка из описания курса"""
+    if value is None:
+        return default
+    if not isinstance(value, str):
+        raise CourseError(f'{where}: ожидается строка')
+    return value
+
+
+def _payload(**kwargs):
+    """Готовые аргументы вызова Bot API: собираются один раз и не меняются"""
+    return MappingProxyType(kwargs)
+
+
+def _text_payload(where, text, parse_mode='HTML', disable_web_page_preview=None):
+    if parse_mode not in (None, '', 'HTML', 'Markdown', 'MarkdownV2'):
+        raise CourseError(f'{where}: parse_mode {parse_mode!r} не поддерживается')
+    if disable_web_page_preview is not None and not isinstance(disable_web_page_preview, bool):
+        raise CourseError(f'{where}: disable_web_page_preview — true или false')
+    _check_text(where, text, parse_mode)
+    payload = {'text': text}
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+    if disable_web_page_preview is not None:
+        payload['disable_web_page_preview'] = disable_web_page_preview
+    return _payload(**payload)
+
+
+class Lesson:
+    """Урок курса с заранее собранными сообщениями.
+
+    Основной план отправки — как можно меньше запросов: видео с текстом урока в
+    подписи и кнопкой (captioned), а после просмотра — одно редактирование
+    сообщения с кнопкой, куда дописаны отметка и выводы (closing). Если текст
+    не влезает в лимит подписи, текст и кнопка идут одним сообщением (prompt).
+    Отдельные text, button и conclusions — запасной план.
+    """
+
+    __slots__ = ('number', 'url', 'video', 'link', 'text', 'conclusions', 'button', 'captioned', 'prompt',
+                 'closings')
+
+    def __init__(self, number, data, is_last):
+        where = f'урок {number}'
+        if not isinstance(data, dict):
+            raise CourseError(f'{where}: ожидается объект')
+        file_id, url = _str(f'{where}.file_id', data.get('file_id')), _str(f'{where}.url', data.get('url'))
+        if not file_id and not url:
+            raise CourseError(f'{where}: нужен file_id или url')
+        self.number = number
+        self.url = url
+        self.video = _payload(video=file_id, supports_streaming=True, disable_notification=True) if file_id else None
+        self.link = _text_payload(
+            f'{where}.url', f"📺 Смотрите видео по ссылке:\n{url}", disable_web_page_preview=False
+        ) if url else None
+        self.text = _text_payload(f'{where}.text_before', data.get('text_before'), disable_web_page_preview=True)
+        self.conclusions = _text_payload(f'{where}.conclusions', data.get('conclusions'))
+        # У последнего урока нет кнопки: после него сразу идёт финал
+        keyboard = None if is_last else InlineKeyboardMarkup([[
+            InlineKeyboardButton(f"✅ Я посмотрел видео {number}", callback_data=f'watched_{number}')
+        ]])
+        self.button = None if is_last else _payload(text=BUTTON_PROMPT, reply_markup=keyboard)
+
+        text = self.text['text']
+        body = text if is_last else f'{text}\n\n{BUTTON_PROMPT}'
+        markup = {} if is_last else {'reply_markup': keyboard}
+        self.captioned = _payload(
+            **self.video, caption=body, parse_mode='HTML', **markup
+        ) if file_id and _fits(body, MessageLimit.CAPTION_LENGTH) else None
+        self.prompt = _payload(
+            text=body, parse_mode='HTML', disable_web_page_preview=True, **markup
+        ) if not is_last and _fits(body, MessageLimit.MAX_TEXT_LENGTH) else None
+
+        # Кнопку заменяет отметка о просмотре и выводы; редактирование без reply_markup убирает кнопку
+        conclusions = self.conclusions['text']
+        self.closings = {}
+        if not is_last:
+            for notice in (WATCHED_NOTICE, AUTO_NEXT_NOTICE):
+                closing = f'{notice}\n\n{conclusions}'
+                self.closings[BUTTON_SEPARATE, notice] = _payload(text=closing, parse_mode='HTML')
+                closing = f'{text}\n\n{closing}'
+                if _fits(closing, MessageLimit.MAX_TEXT_LENGTH):
+                    self.closings[BUTTON_TEXT, notice] = _payload(
+                        text=closing, parse_mode='HTML', disable_web_page_preview=True
+                    )
+                if _fits(closing, MessageLimit.CAPTION_LENGTH):
+                    self.closings[BUTTON_CAPTION, notice] = _payload(caption=closing, parse_mode='HTML')
+
+    def closing(self, kind, notice):
+        """Аргументы редактирования сообщения с кнопкой или None, если текст не влезает в лимит"""
+        return self.closings.get((kind, notice))
+
+
+class FinalVideo:
+    __slots__ = ('file_path', 'caption', 'duration', 'length', 'link')
+
+    def __init__(self, data, base_dir):
+        if not isinstance(data, dict) or not _str('final_video.url', data.get('url')):
+            raise CourseError('final_video: нужен url')
+        file_path = _str('final_video.file_path', data.get('file_path'))
+        self.file_path = os.path.join(base_dir, file_path) if file_path else ''
+        self.caption = _str('final_video.caption', data.get('caption'), None)
+        self.duration = _int('final_video.duration', data.get('duration', 0)) or None
+        self.length = _int('final_video.length', data.get('length', 0)) or None
+        self.link = _payload(text=f"{data['url']}\n\n", disable_web_page_preview=False)
+
+
+class Course:
+    """Проверенный и собранный курс; после загрузки не меняется, при правке файла заменяется целиком"""
+
+    __slots__ = ('path', 'version', 'lessons', 'final_video', 'messages')
+
+    def __init__(self, data, path='', version=None):
+        if not isinstance(data, dict):
+            raise CourseError('курс: ожидается объект')
+        lessons = data.get('lessons')
+        if not isinstance(lessons, list) or not lessons:
+            raise CourseError('lessons: нужен хотя бы один урок')
+        self.path = path
+        self.version = version
+        self.lessons = tuple(
+            Lesson(number, lesson, number == len(lessons))
+            for number, lesson in enumerate(lessons, start=1)
+        )
+        self.final_video = FinalVideo(data.get('final_video'), os.path.dirname(os.path.abspath(path)))
+        messages = data.get('messages') or {}
+        if not isinstance(messages, dict):
+            raise CourseError('messages: ожидается объект')
+        compiled = {}
+        for name in MESSAGES:
+            message = messages.get(name)
+            if not isinstance(message, dict):
+                raise CourseError(f'messages.{name}: нужен объект с text')
+            compiled[name] = _text_payload(
+                f'messages.{name}', message.get('text'),
+                message.get('parse_mode', 'HTML'), message.get('disable_web_page_preview'),
+            )
+        self.messages = MappingProxyType(compiled)
+
+    @property
+    def last(self):
+        """Номер последнего урока"""
+        return len(self.lessons)
+
+    def lesson(self, number):
+        return self.lessons[number - 1] if 1 <= number <= len(self.lessons) else None
+
+
+def file_version(path):
+    """Метка версии файла курса: меняется при любой правке"""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_course(path):
+    """Читает, проверяет и собирает курс из JSON или YAML"""
+    version = file_version(path)
+    with open(path, encoding='utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            # PyYAML импортируем только для YAML-курсов: JSON не должен платить за него при старте
+            try:
+                import yaml
+            except ImportError:
+                raise CourseError(f'{path}: для YAML нужен пакет PyYAML') from None
+            try:
+                data = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise CourseError(f'{path}: {e}') from e
+        else:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError as e:
+                raise CourseError(f'{path}: {e}') from e
+    return Course(data, path, version)
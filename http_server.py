@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+# Сколько ждём строку запроса, заголовок или тело: порт публичный, простаивающие соединения закрываем
+READ_TIMEOUT = 30.0
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large', 429: 'Too Many Requests',
+    500: 'Internal Server Error', 502: 'Bad Gateway',
+}
+
+
+def webhook_secret(token):
+    """Секрет webhook, выведенный из токена бота.
+
+    Все реплики и воркеры с одним токеном получают один и тот же секрет, поэтому
+    set_webhook последней запущенной реплики не отменяет секрет остальных.
+    """
+    return hmac.new(token.encode(), b'telegram-webhook-secret', hashlib.sha256).hexdigest()
+
+
+class Request:
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+
+class Response:
+    __slots__ = ('status', 'body', 'content_type')
+
+    def __init__(self, status=200, body=b'', content_type='text/plain; charset=utf-8'):
+        self.status = status
+        self.body = body.encode() if isinstance(body, str) else body
+        self.content_type = content_type
+
+
+class HttpServer:
+    """Минимальный асинхронный HTTP/1.1 сервер на asyncio без внешних зависимостей"""
+
+    def __init__(self, host='0.0.0.0', port=8080, max_body_size=MAX_BODY_SIZE, read_timeout=READ_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.max_body_size = max_body_size
+        self.read_timeout = read_timeout
+        self._routes = {}
+        self._server = None
+
+    def route(self, method, path, handler):
+        """Регистрирует async handler(request) -> Response"""
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # При port=0 система выбирает свободный порт
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                if isinstance(request, Response):
+                    await self._write_response(writer, request, keep_alive=False)
+                    break
+                response = await self._dispatch(request)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                await self._write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except ValueError:
+            # Строка длиннее лимита StreamReader
+            pass
+        finally:
+            writer.close()
+
+    async def _read(self, read):
+        return await asyncio.wait_for(read, self.read_timeout)
+
+    async def _read_request(self, reader):
+        request_line = await self._read(reader.readline())
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            return Response(400, 'bad request line')
+
+        headers = {}
+        while True:
+            line = await self._read(reader.readline())
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            return Response(400, 'bad content-length')
+        if length < 0:
+            return Response(400, 'bad content-length')
+        if length > self.max_body_size:
+            return Response(413, 'payload too large')
+        body = await self._read(reader.readexactly(length)) if length else b''
+
+        url = urlsplit(target)
+        return Request(method, url.path, parse_qs(url.query), headers, body)
+
+    async def _dispatch(self, request):
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            known_path = any(path == request.path for _, path in self._routes)
+            return Response(405 if known_path else 404, REASONS[405 if known_path else 404])
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"Ошибка обработки {request.method} {request.path}: {e}")
+            return Response(500, REASONS[500])
+
+    async def _write_response(self, writer, response, keep_alive):
+        head = (
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + response.body)
+        await writer.drain()
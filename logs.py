@@ -0,0 +1,202 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from contextvars import ContextVar
+
+# Поля, которые пишутся в JSON помимо стандартных (берутся из extra= и контекста)
+STRUCTURED_FIELDS = ('event', 'user_id', 'lesson', 'handler', 'chat_id', 'suppressed', 'tenant')
+
+# Контекст текущего апдейта или таймера: user_id, handler и т.п.
+log_context = ContextVar('log_context', default=None)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Статистика конвейера логов (для /metrics и bench/logging_throughput.py)
+stats = {'enqueued': 0, 'dropped': 0, 'sampled_out': 0, 'rate_limited': 0, 'written': 0}
+
+# Поток записи, запущенный последним вызовом setup_logging
+_listener = None
+
+
+def bind_log_context(**fields):
+    """Добавляет поля ко всем записям лога текущей задачи asyncio"""
+    current = log_context.get()
+    log_context.set({**current, **fields} if current else fields)
+
+
+class ContextFilter(logging.Filter):
+    """Переносит поля контекста в запись; работает в вызывающем потоке, пока контекст доступен"""
+
+    def filter(self, record):
+        fields = log_context.get()
+        if fields:
+            for key, value in fields.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Выборка и ограничение частоты повторяющихся записей.
+
+    sample: {event: доля записей, которую оставляем} — для частых событий вроде video_sent.
+    Ограничение частоты действует на предупреждения и ошибки — по event или по
+    месту вызова: не больше burst записей подряд и rate в секунду. Число
+    пропущенных выводится полем suppressed в следующей записи.
+    """
+
+    def __init__(self, sample=None, rate=5.0, burst=20, clock=time.monotonic):
+        super().__init__()
+        self.sample = sample or {}
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._buckets = {}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        share = self.sample.get(event) if event is not None else None
+        if share is not None and random.random() >= share:
+            stats['sampled_out'] += 1
+            return False
+        if not self.rate or record.levelno < logging.WARNING:
+            return True
+        key = event or (record.name, record.pathname, record.lineno)
+        now = self.clock()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.burst), now, 0]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            stats['rate_limited'] += 1
+            return False
+        bucket[0] = tokens - 1
+        if bucket[2]:
+            record.suppressed = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись"""
+
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь, не форматируя её; сверх max_size записей — отбрасывает"""
+
+    def __init__(self, max_size=10000):
+        # SimpleQueue дешевле queue.Queue: без Condition на каждый put
+        super().__init__(queue.SimpleQueue())
+        self.max_size = max_size
+
+    def prepare(self, record):
+        # Форматирование (getMessage, JSON, traceback) делает поток QueueListener
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.max_size:
+            stats['dropped'] += 1
+            return
+        self.queue.put_nowait(record)
+        stats['enqueued'] += 1
+
+
+class _CountingHandler(logging.StreamHandler):
+    def emit(self, record):
+        super().emit(record)
+        stats['written'] += 1
+
+
+def parse_sample(spec):
+    """'video_sent=0.1,timer_fired=0.01' -> {'video_sent': 0.1, 'timer_fired': 0.01}"""
+    sample = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        event, _, share = item.partition('=')
+        sample[event.strip()] = float(share)
+    return sample
+
+
+def setup_logging(level=logging.INFO, json_format=None, stream=None, queue_size=10000,
+                  sample=None, rate=None, burst=None):
+    """Настраивает корневой логгер: очередь в памяти и отдельный поток записи.
+
+    Настройки по умолчанию берутся из окружения: LOG_FORMAT (json|text),
+    LOG_SAMPLE (event=доля,...), LOG_RATE и LOG_BURST (ограничение повторов).
+    Повторный вызов (перезапуск бота в том же процессе) заменяет прежнюю очередь.
+    Возвращает запущенный QueueListener.
+    """
+    global _listener
+    if json_format is None:
+        json_format = os.getenv('LOG_FORMAT', 'text') == 'json'
+    if sample is None:
+        sample = parse_sample(os.getenv('LOG_SAMPLE', ''))
+    if rate is None:
+        rate = float(os.getenv('LOG_RATE', '5'))
+    if burst is None:
+        burst = int(os.getenv('LOG_BURST', '20'))
+
+    output = _CountingHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    handler = NonBlockingQueueHandler(queue_size)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(sample, rate, burst))
+
+    # Поля записи, которые не выводятся, не собираем: так дешевле создание LogRecord
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    if _listener is not None:
+        # Дописываем то, что уже в очереди прежнего обработчика
+        _stop_listener(_listener)
+    root.addHandler(handler)
+    root.setLevel(level)
+    # Отладочные логи HTTP клиента на каждый запрос к Bot API не нужны даже в DEBUG
+    for name in ('httpx', 'httpcore'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    if _listener is None:
+        # Дописываем очередь при выходе из процесса
+        atexit.register(_stop_current_listener)
+    _listener = listener
+    return listener
+
+
+def _stop_listener(listener):
+    if listener._thread is not None:
+        listener.stop()
+
+
+def _stop_current_listener():
+    if _listener is not None:
+        _stop_listener(_listener)
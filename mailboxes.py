@@ -0,0 +1,65 @@
+import asyncio
+
+
+class _Mailbox:
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # Сколько событий держат или ждут этот ящик
+        self.users = 0
+
+
+class _Hold:
+    __slots__ = ('mailboxes', 'user_id', 'mailbox')
+
+    def __init__(self, mailboxes, user_id):
+        self.mailboxes = mailboxes
+        self.user_id = user_id
+        self.mailbox = None
+
+    async def __aenter__(self):
+        mailboxes = self.mailboxes
+        mailbox = mailboxes._boxes.get(self.user_id)
+        if mailbox is None:
+            mailbox = mailboxes._boxes[self.user_id] = _Mailbox()
+        elif mailbox.lock.locked():
+            mailboxes.contended += 1
+        mailbox.users += 1
+        self.mailbox = mailbox
+        try:
+            await mailbox.lock.acquire()
+        except BaseException:
+            self._release_slot()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self.mailbox.lock.release()
+        self._release_slot()
+
+    def _release_slot(self):
+        self.mailbox.users -= 1
+        if not self.mailbox.users:
+            # Ящик никому не нужен — убираем, чтобы память не росла с числом пользователей
+            del self.mailboxes._boxes[self.user_id]
+
+
+class UserMailboxes:
+    """Последовательная обработка событий одного пользователя.
+
+    Нажатия кнопок, команды и сработавшие таймеры одного пользователя выполняются
+    по очереди, разные пользователи обрабатываются параллельно. Ящик создаётся
+    при первом событии и удаляется, когда очередь пуста.
+    """
+
+    def __init__(self):
+        self._boxes = {}
+        # Сколько раз событию пришлось ждать предыдущее событие того же пользователя
+        self.contended = 0
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def hold(self, user_id):
+        """async with mailboxes.hold(user_id): ... — эксклюзивный доступ к пользователю"""
+        return _Hold(self, user_id)
@@ -1,24 +1,92 @@
 import os
-import subprocess
-import time
-
-print("🚀 Starting Telegram Bot...")
-
-# Проверяем переменные окружения
-token = os.getenv('TELEGRAM_BOT_TOKEN')
-if not token:
-    print("❌ ERROR: TELEGRAM_BOT_TOKEN not set!")
-    print("💡 Add it in Railway → Variables")
-    exit(1)
-
-print(f"✅ Token found: {token[:10]}...")
-
-# Запускаем бота
-try:
-    print("🤖 Launching bot process...")
-    subprocess.run(["python", "bot.py"])
-except KeyboardInterrupt:
-    print("🛑 Bot stopped")
-except Exception as e:
-    print(f"💥 Error: {e}")
-    time.sleep(5)  # Пауза перед перезапуском
\ No newline at end of file
+import sys
+
+
+def run_bot():
+    """Один запуск бота в этом процессе (без второго интерпретатора)"""
+    import asyncio
+
+    # При перезапуске модуль бота загружается заново: состояние упавшего запуска
+    # не переживает падение, а python-telegram-bot и остальные зависимости уже импортированы
+    sys.modules.pop('bot', None)
+    import bot
+
+    asyncio.run(bot.run())
+
+
+def run_tenants(specs):
+    """Несколько ботов в одном процессе (BOT_TENANTS)"""
+    import asyncio
+    from tenants import run_tenants
+
+    asyncio.run(run_tenants(specs))
+
+
+def main():
+    print("🚀 Starting Telegram Bot...")
+
+    # Файл со списком ботов: несколько токенов и курсов в одном процессе
+    tenants_file = os.getenv('BOT_TENANTS')
+
+    # Проверяем переменные окружения
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not token and not tenants_file:
+        print("❌ ERROR: TELEGRAM_BOT_TOKEN not set!")
+        print("💡 Add it in Railway → Variables")
+        exit(1)
+
+    if token:
+        print(f"✅ Token found: {token[:10]}...")
+
+    # Количество процессов-воркеров; больше одного — режим супервизора с шардированием по user_id
+    workers = int(os.getenv('BOT_WORKERS', '1'))
+
+    # Тяжёлые модули (python-telegram-bot, бот) импортируются только в выбранном режиме
+    from logs import setup_logging
+    from supervisor import CrashLoop, supervise
+
+    # Базы состояния разложены по user_id % BOT_WORKERS: с другим числом воркеров
+    # пользователи потеряли бы прогресс
+    if not tenants_file or workers > 1:
+        from sharding import ShardLayoutError, check_state_layout
+
+        try:
+            check_state_layout(workers)
+        except ShardLayoutError as e:
+            print(f"❌ ERROR: {e}")
+            exit(1)
+
+    try:
+        if workers > 1:
+            import asyncio
+            from sharding import run_supervisor
+
+            setup_logging('INFO')
+            print(f"🧩 Supervisor mode: {workers} workers")
+            asyncio.run(run_supervisor(workers, token))
+        elif tenants_file:
+            from tenants import TenantError, load_tenants_config
+
+            setup_logging(os.getenv('LOG_LEVEL', 'INFO').upper())
+            try:
+                specs = load_tenants_config(tenants_file)
+            except (OSError, TenantError) as e:
+                print(f"❌ ERROR: {e}")
+                exit(1)
+            print(f"🏢 Multi-tenant mode: {len(specs)} bots")
+            supervise(lambda: run_tenants(specs))
+        else:
+            # Логи перезапусков до импорта бота; bot.py затем настроит их по-своему
+            setup_logging(os.getenv('LOG_LEVEL', 'INFO').upper())
+            print("🤖 Launching bot...")
+            supervise(run_bot)
+    except KeyboardInterrupt:
+        print("🛑 Bot stopped")
+    except CrashLoop as e:
+        print(f"💥 Crash loop: {e}")
+        exit(1)
+
+
+# Воркеры супервизора запускаются через spawn и заново импортируют этот модуль
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# Фрагменты ответов Telegram о file_id, который больше не принимается
+# (Wrong file identifier/http url specified, Wrong remote file identifier specified, ...)
+STALE_FILE_ID_ERRORS = ('file identifier', 'file_id', 'file reference', 'file_reference')
+
+
+def is_stale_file_id(error):
+    """Telegram отверг сам file_id (а не чат или параметры запроса)"""
+    text = str(error).lower()
+    return isinstance(error, BadRequest) and any(fragment in text for fragment in STALE_FILE_ID_ERRORS)
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+class MediaCache:
+    """Загружает локальный файл в Telegram один раз и дальше отправляет его по file_id"""
+
+    def __init__(self, store):
+        # store — StateStore, file_id хранятся в его служебных значениях
+        self.store = store
+        self._digests = {}
+        self._locks = {}
+        self.uploads = 0
+        self.hits = 0
+
+    async def _cache_key(self, kind, path):
+        # Хэш пересчитываем только при изменении размера или времени модификации файла
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self._digests.get(path)
+        if cached is None or cached[0] != signature:
+            cached = (signature, await asyncio.to_thread(_file_digest, path))
+            self._digests[path] = cached
+        return f'media:{kind}:{cached[1]}'
+
+    async def send(self, kind, path, send, extract_file_id):
+        """Отправляет файл: send(media) -> Message, extract_file_id(message) -> file_id"""
+        key = await self._cache_key(kind, path)
+
+        file_id = self.store.meta.get(key)
+        if file_id is not None:
+            try:
+                message = await send(file_id)
+                self.hits += 1
+                return message
+            except BadRequest as e:
+                # Ошибки чата (chat not found и т.п.) к file_id отношения не имеют —
+                # ключ не сбрасываем, иначе один удалённый чат вызовет повторную загрузку
+                if not is_stale_file_id(e):
+                    raise
+                # Telegram больше не принимает этот file_id — загрузим файл заново
+                logger.warning(f"Кэшированный file_id отклонён ({kind}): {e}")
+                if self.store.meta.get(key) == file_id:
+                    self.store.set_meta(key, None)
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # Пока ждали, файл мог загрузить другой пользователь
+            file_id = self.store.meta.get(key)
+            if file_id is not None:
+                message = await send(file_id)
+                self.hits += 1
+                return message
+
+            with open(path, 'rb') as media_file:
+                message = await send(media_file)
+            self.uploads += 1
+
+            file_id = extract_file_id(message)
+            if file_id:
+                self.store.set_meta(key, file_id)
+                logger.info(f"Файл {os.path.basename(path)} загружен, file_id сохранён ({kind})")
+            return message
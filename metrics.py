@@ -0,0 +1,246 @@
+import asyncio
+import contextlib
+import functools
+import time
+from bisect import bisect_left
+
+# Границы гистограмм времени, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _add_labels(sample, labels):
+    """Дописывает метки реестра к строке сэмпла: name{a="1"} 5 -> name{a="1",tenant="x"} 5"""
+    name, value = sample.rsplit(' ', 1)
+    if name.endswith('}'):
+        return f'{name[:-1]},{labels}}} {value}'
+    return f'{name}{{{labels}}} {value}'
+
+
+class Registry:
+    """Набор метрик, отдаваемый в текстовом формате Prometheus.
+
+    labels — метки, которые добавляются ко всем метрикам реестра (например,
+    tenant); вложенные реестры (include) выводятся вместе с этим.
+    """
+
+    def __init__(self, labels=()):
+        self._metrics = {}
+        self._children = []
+        self.labels = _format_labels((), (), labels)[1:-1]
+
+    def register(self, metric):
+        # Повторный импорт модуля (перезапуск бота в том же процессе) заменяет метрику, а не дублирует
+        self._metrics[metric.name] = metric
+        return metric
+
+    def include(self, registry):
+        self._children.append(registry)
+
+    def exclude(self, registry):
+        self._children.remove(registry)
+
+    def _collect(self, families):
+        for metric in self._metrics.values():
+            family = families.get(metric.name)
+            if family is None:
+                family = families[metric.name] = (metric, [])
+            if self.labels:
+                family[1].extend(_add_labels(sample, self.labels) for sample in metric.samples())
+            else:
+                family[1].extend(metric.samples())
+        for child in self._children:
+            child._collect(families)
+
+    def render(self):
+        # Одноимённые метрики вложенных реестров выводятся одним семейством
+        families = {}
+        self._collect(families)
+        lines = []
+        for name, (metric, samples) in families.items():
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+# Реестр, в который попадают метрики, созданные без явного registry
+_current_registry = REGISTRY
+
+
+@contextlib.contextmanager
+def use_registry(registry):
+    """Метрики, созданные внутри блока (например, при импорте модуля бота), регистрируются в registry"""
+    global _current_registry
+    previous, _current_registry = _current_registry, registry
+    try:
+        yield registry
+    finally:
+        _current_registry = previous
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._children = {}
+        if not labelnames:
+            self._default = self.labels()
+        (registry if registry is not None else _current_registry).register(self)
+
+    def labels(self, *values):
+        """Дочерняя метрика для значений меток (стоит кэшировать на горячем пути)"""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = _CounterChild()
+        return child
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def samples(self):
+        for values, child in self._children.items():
+            yield f'{self.name}{_format_labels(self.labelnames, values)} {child.value}'
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._children = {}
+        if not labelnames:
+            self._default = self.labels()
+        (registry if registry is not None else _current_registry).register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = _HistogramChild(self.buckets)
+        return child
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, (('le', bound),))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, values)
+            yield f'{self.name}_sum{labels} {child.sum}'
+            yield f'{self.name}_count{labels} {child.count}'
+
+
+class Gauge:
+    """Значение, вычисляемое в момент сбора метрик (ничего не стоит на горячем пути)"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, func, registry=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        (registry if registry is not None else _current_registry).register(self)
+
+    def samples(self):
+        yield f'{self.name} {self.func()}'
+
+
+# ========== ИНСТРУМЕНТАЦИЯ ==========
+HANDLER_CALLS = Counter('bot_handler_calls_total', 'Вызовы обработчиков', ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Исключения в обработчиках', ('handler',))
+HANDLER_LATENCY = Histogram('bot_handler_duration_seconds', 'Время работы обработчиков', ('handler',))
+
+
+def instrument(name):
+    """Декоратор: считает вызовы, ошибки и время работы корутины"""
+    calls = HANDLER_CALLS.labels(name)
+    errors = HANDLER_ERRORS.labels(name)
+    latency = HANDLER_LATENCY.labels(name)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            calls.value += 1
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except BaseException:
+                errors.value += 1
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+class LoopLagMonitor:
+    """Измеряет, насколько позже положенного просыпается цикл событий"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.last = 0.0
+        self.max = 0.0
+        self._task = None
+        self.histogram = Histogram(
+            'bot_event_loop_lag_seconds', 'Задержка цикла событий',
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+        )
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - expected)
+            self.max = max(self.max, self.last)
+            self.histogram.observe(self.last)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,218 @@
+"""Профилирование работающего бота по команде администратора (/profile).
+
+Два источника за одно окно в N секунд:
+
+- поток-сэмплер раз в PROFILE_INTERVAL снимает стеки всех потоков через
+  sys._current_frames() и копит их в формате collapsed stacks (строка
+  «кадр;кадр;кадр число») — файл открывается flamegraph.pl, speedscope и
+  inferno без преобразований;
+- задача в цикле событий раз в PROFILE_TASK_INTERVAL смотрит asyncio.all_tasks():
+  сколько живёт каждая задача и чего она ждёт.
+
+Сэмплер только читает кадры и не трогает объекты бота. Обход стеков глубиной
+около 60 кадров занимает ~30 мкс под GIL, то есть при 100 сэмплах в секунду
+цикл событий теряет порядка 0,3% времени.
+"""
+import asyncio
+import collections
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+PROFILE_TASK_INTERVAL = float(os.getenv('PROFILE_TASK_INTERVAL', '0.25'))
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '300'))
+# Столько разных стеков храним; остальные сэмплы считаются одной строкой [other]
+PROFILE_MAX_STACKS = 50_000
+
+
+def _label(code):
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Поток, который снимает стеки остальных потоков с заданным интервалом"""
+
+    def __init__(self, interval=PROFILE_INTERVAL, max_stacks=PROFILE_MAX_STACKS):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = collections.Counter()
+        # Сэмплы потока цикла событий, в которых выполнялась корутина бота (включительно)
+        self.on_loop = collections.Counter()
+        self.samples = 0
+        self.loop_thread = threading.get_ident()
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _frame_label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = _label(code)
+        return label
+
+    def _sample(self):
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            labels = []
+            coroutines = set()
+            while frame is not None:
+                code = frame.f_code
+                label = self._frame_label(code)
+                labels.append(label)
+                if (ident == self.loop_thread and code.co_flags & inspect.CO_COROUTINE
+                        and code.co_filename.startswith(BASE_DIR)):
+                    coroutines.add(label)
+                frame = frame.f_back
+            labels.append(names.get(ident, str(ident)))
+            stack = ';'.join(reversed(labels))
+            if stack in self.stacks or len(self.stacks) < self.max_stacks:
+                self.stacks[stack] += 1
+            else:
+                self.stacks['[other]'] += 1
+            self.on_loop.update(coroutines)
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._sample()
+            except Exception as e:
+                # Профилировщик не должен ронять бота
+                logger.error(f"Сэмплер стеков остановлен: {e}")
+                return
+
+    def start(self):
+        # Вызывается из цикла событий: его поток и есть интересующий поток
+        self.loop_thread = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self):
+        """Стеки в формате collapsed stacks"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def await_chain(task, depth=None):
+    """Цепочка корутин задачи от внешней к той, что сейчас ждёт: только код бота (не глубже depth)"""
+    chain = []
+    coro = task.get_coro()
+    while coro is not None and (depth is None or len(chain) < depth):
+        code = getattr(coro, 'cr_code', None)
+        if code is None:
+            break
+        if code.co_filename.startswith(BASE_DIR):
+            chain.append(getattr(code, 'co_qualname', code.co_name))
+        coro = getattr(coro, 'cr_await', None)
+    return ' > '.join(chain) or getattr(task.get_coro(), '__qualname__', repr(task.get_coro()))
+
+
+def task_counts(tasks=None):
+    """Живые задачи asyncio по цепочке ожидания"""
+    if tasks is None:
+        tasks = asyncio.all_tasks()
+    return collections.Counter(await_chain(task) for task in tasks if not task.done())
+
+
+class TaskSampler:
+    """Снимки asyncio.all_tasks(): сколько живут задачи с каждой точкой входа"""
+
+    def __init__(self, interval=PROFILE_TASK_INTERVAL):
+        self.interval = interval
+        self._seen = {}
+        # точка входа -> длительности завершившихся задач
+        self.finished = collections.defaultdict(list)
+        self.stopped = False
+
+    def _snapshot(self, now):
+        current = asyncio.current_task()
+        alive = set()
+        for task in asyncio.all_tasks():
+            if task is current:
+                continue
+            alive.add(task)
+            if task not in self._seen:
+                # Задачи группируются по точке входа, а не по месту, где они ждут сейчас
+                self._seen[task] = (now, await_chain(task, depth=3))
+        for task in [task for task in self._seen if task not in alive]:
+            first_seen, label = self._seen.pop(task)
+            self.finished[label].append(now - first_seen)
+
+    async def run(self, seconds):
+        deadline = time.monotonic() + seconds
+        while True:
+            now = time.monotonic()
+            self._snapshot(now)
+            if now >= deadline or self.stopped:
+                break
+            await asyncio.sleep(min(self.interval, deadline - now))
+
+    def slowest(self, limit=10):
+        """Точки входа задач по самой долгой задаче: (метка, число, макс., среднее, ещё живы)"""
+        now = time.monotonic()
+        durations = collections.defaultdict(list)
+        for label, values in self.finished.items():
+            durations[label].extend(values)
+        running = collections.Counter()
+        for first_seen, label in self._seen.values():
+            durations[label].append(now - first_seen)
+            running[label] += 1
+        rows = [
+            (label, len(values), max(values), sum(values) / len(values), running[label])
+            for label, values in durations.items()
+        ]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:limit]
+
+
+class ProfileSession:
+    """Одно окно профилирования: сэмплер стеков и снимки задач"""
+
+    def __init__(self, seconds):
+        self.seconds = min(seconds, PROFILE_MAX_SECONDS)
+        self.sampler = StackSampler()
+        self.tasks = TaskSampler()
+        self.started = None
+        self.elapsed = 0.0
+
+    def stop(self):
+        """Заканчивает окно раньше (не позже чем через PROFILE_TASK_INTERVAL)"""
+        self.tasks.stopped = True
+
+    async def run(self):
+        self.started = time.monotonic()
+        self.sampler.start()
+        try:
+            await self.tasks.run(self.seconds)
+        finally:
+            # join сэмплера занимает не дольше одного интервала
+            self.sampler.stop()
+            self.elapsed = time.monotonic() - self.started
+
+    def summary(self, limit=10):
+        """Текстовый отчёт: корутины по времени в цикле событий и по времени жизни задач"""
+        sampler = self.sampler
+        lines = [f"Профиль за {self.elapsed:.1f} с: сэмплов {sampler.samples}, разных стеков {len(sampler.stacks)}"]
+        if sampler.samples:
+            lines.append("\nКорутины бота по времени в цикле событий (с вызванным кодом):")
+            for label, count in sampler.on_loop.most_common(limit):
+                lines.append(f"{count / sampler.samples:6.1%}  {label}")
+        lines.append("\nСамые долгие задачи (n, макс., среднее, ещё живы):")
+        for label, count, longest, average, running in self.tasks.slowest(limit):
+            lines.append(f"{count:5} {longest:7.1f} с {average:7.2f} с {running:5}  {label}")
+        return '\n'.join(lines)
@@ -0,0 +1,115 @@
+"""Запись входящих апдейтов для воспроизведения (bench/replay.py).
+
+Включается UPDATES_RECORD_DIR. Каждый Update, попавший в очередь приложения
+(long polling, webhook или канал шарда), дописывается строкой JSON
+
+    {"t": <время поступления>, "update": <Update.to_dict()>}
+
+в сжатые файлы UPDATES_RECORD_DIR/updates-YYYYMMDD-HHMMSS-<shard>.jsonl.gz.
+Файл сменяется после UPDATES_RECORD_MAX_MB несжатых данных, старые файлы
+сверх UPDATES_RECORD_KEEP удаляются. В записи — сообщения и id пользователей:
+хранить их нужно так же, как базу состояния.
+"""
+import asyncio
+import glob
+import gzip
+import heapq
+import json
+import logging
+import os
+import time
+
+from telegram import Update
+
+from buffered import BufferedWriter
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateRecorder(BufferedWriter):
+    """Буфер апдейтов в памяти; сериализация, сжатие и запись — в потоке вне цикла событий"""
+
+    write_error = "Не удалось записать апдейты: %s"
+
+    def __init__(self, directory, shard='0', max_bytes=64 * 2**20, keep=20, flush_interval=1.0,
+                 max_buffer=10_000, clock=time.time):
+        super().__init__(directory, flush_interval, max_buffer, clock)
+        self.shard = shard
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self._path = None
+        self._size = 0
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def record(self, update):
+        """Запоминает апдейт и время поступления (горячий путь: только append)"""
+        if self._accept():
+            self._buffer.append((self.clock(), update))
+
+    def _rotate(self, now):
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(now))
+        path = os.path.join(self.directory, f'updates-{stamp}-{self.shard}.jsonl.gz')
+        suffix = 1
+        while os.path.exists(path):
+            path = os.path.join(self.directory, f'updates-{stamp}.{suffix}-{self.shard}.jsonl.gz')
+            suffix += 1
+        self._path, self._size = path, 0
+        if self.keep:
+            old = recording_files(self.directory, self.shard)
+            for stale in old[:max(0, len(old) - self.keep + 1)]:
+                os.remove(stale)
+
+    def _write(self, batch):
+        lines = ''.join(
+            json.dumps({'t': round(ts, 3), 'update': update.to_dict()}, ensure_ascii=False,
+                       separators=(',', ':')) + '\n'
+            for ts, update in batch
+        ).encode()
+        os.makedirs(self.directory, exist_ok=True)
+        if self._path is None or self._size >= self.max_bytes:
+            self._rotate(batch[0][0])
+        # Каждый сброс — отдельный член gzip: файл читается целиком даже после падения процесса
+        with gzip.open(self._path, 'ab', compresslevel=6) as f:
+            f.write(lines)
+        self._size += len(lines)
+
+
+class RecordingQueue(asyncio.Queue):
+    """Очередь апдейтов приложения, которая передаёт каждый Update в UpdateRecorder.
+
+    Updater, webhook и канал шарда кладут апдейты через put/put_nowait, поэтому
+    время записи — момент поступления, а не начала обработки.
+    """
+
+    def __init__(self, recorder):
+        super().__init__()
+        self.recorder = recorder
+
+    def put_nowait(self, item):
+        if isinstance(item, Update):
+            self.recorder.record(item)
+        super().put_nowait(item)
+
+
+# ========== ЧТЕНИЕ ==========
+def recording_files(directory, shard='*'):
+    return sorted(glob.glob(os.path.join(directory, f'updates-*-{shard}.jsonl.gz')))
+
+
+def _read_file(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                record = json.loads(line)
+                yield record['t'], record['update']
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError):
+            # Последний член файла не дописан (процесс упал во время записи)
+            logger.warning(f"{path}: запись обрывается, прочитано до обрыва")
+
+
+def read_recording(paths):
+    """Апдейты из файлов (в том числе разных шардов) в порядке поступления: (время, dict)"""
+    return heapq.merge(*(_read_file(path) for path in paths), key=lambda record: record[0])
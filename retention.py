@@ -0,0 +1,102 @@
+import heapq
+import os
+import time
+
+# Сколько хранить пользователя, который начал курс и пропал (по последней активности)
+ABANDONED_TTL = float(os.getenv('RETENTION_ABANDONED_TTL', str(3 * 24 * 3600)))
+# Сколько хранить завершившего курс после напоминания о скидке
+COMPLETED_GRACE = float(os.getenv('RETENTION_COMPLETED_GRACE', str(3600)))
+# Верхняя граница числа пользователей в памяти (0 — без ограничения)
+MAX_TRACKED_USERS = int(os.getenv('RETENTION_MAX_USERS', '0'))
+
+
+class ExpiryIndex:
+    """Мин-куча сроков хранения: обход стоит O(истёкших), а не O(всех пользователей)"""
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def set(self, key, deadline):
+        if self._deadlines.get(key) == deadline:
+            return
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        # Старые записи удаляются лениво; чистим кучу, когда их стало слишком много
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._heap = [(d, k) for k, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def discard(self, key):
+        self._deadlines.pop(key, None)
+
+    def deadline(self, key):
+        return self._deadlines.get(key)
+
+    def pop_expired(self, now, limit=None):
+        """Извлекает ключи, срок которых наступил (не больше limit)"""
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now and (limit is None or len(expired) < limit):
+            deadline, key = heapq.heappop(heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                expired.append(key)
+        return expired
+
+    def pop_oldest(self, count):
+        """Извлекает count ключей с самым ранним сроком (для ограничения памяти)"""
+        return self.pop_expired(float('inf'), limit=count)
+
+
+class Retention:
+    """Политика хранения пользователей воронки и статистика вытеснения"""
+
+    def __init__(self, abandoned_ttl=ABANDONED_TTL, completed_grace=COMPLETED_GRACE,
+                 max_users=MAX_TRACKED_USERS, clock=time.time):
+        self.abandoned_ttl = abandoned_ttl
+        self.completed_grace = completed_grace
+        self.max_users = max_users
+        self.clock = clock
+        self.index = ExpiryIndex()
+        self.evicted = {'completed': 0, 'abandoned': 0, 'overflow': 0}
+        self.postponed = 0
+
+    def touch(self, user_id, completed=False, reminder_time=None):
+        """Пересчитывает срок хранения после активности пользователя"""
+        if completed and reminder_time is not None:
+            deadline = reminder_time + self.completed_grace
+        else:
+            deadline = self.clock() + self.abandoned_ttl
+        self.index.set(user_id, deadline)
+
+    def postpone(self, user_id, until):
+        """Откладывает вытеснение (например, пока у пользователя есть таймеры)"""
+        self.postponed += 1
+        self.index.set(user_id, until + self.completed_grace)
+
+    def discard(self, user_id):
+        self.index.discard(user_id)
+
+    def expired(self, limit=None):
+        return self.index.pop_expired(self.clock(), limit)
+
+    def overflow(self, tracked):
+        """Сколько пользователей нужно вытеснить сверх лимита"""
+        if not self.max_users or tracked <= self.max_users:
+            return []
+        return self.index.pop_oldest(tracked - self.max_users)
+
+    def stats(self):
+        return {
+            'indexed': len(self.index),
+            'evicted': dict(self.evicted),
+            'postponed': self.postponed,
+            'max_users': self.max_users,
+        }
@@ -0,0 +1,177 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Состояния таймера
+PENDING = 0
+FIRED = 1
+CANCELLED = 2
+
+
+class TimerHandle:
+    """Компактная запись таймера: время срабатывания, колбэк и аргументы"""
+
+    __slots__ = ('when', 'callback', 'args', 'state', '_scheduler')
+
+    def __init__(self, when, callback, args, scheduler):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.state = PENDING
+        self._scheduler = scheduler
+
+    def done(self):
+        return self.state != PENDING
+
+    def cancelled(self):
+        return self.state == CANCELLED
+
+    def cancel(self):
+        """Отмена за O(1): запись остаётся в куче и выбрасывается при извлечении"""
+        if self.state != PENDING:
+            return False
+        self.state = CANCELLED
+        self.args = ()
+        self._scheduler._on_cancel()
+        return True
+
+
+class TimerScheduler:
+    """Единый планировщик таймеров на куче вместо отдельной задачи на каждый таймер"""
+
+    def __init__(self, clock=time.time, max_batch=500):
+        # clock — часы в секундах эпохи, чтобы время срабатывания можно было сохранять
+        self.clock = clock
+        self.max_batch = max_batch
+        self._heap = []
+        self._seq = itertools.count()
+        self._cancelled = 0
+        self._running = set()
+        self._task = None
+        self._wakeup = None
+        self.fired_total = 0
+
+    # ---------- планирование ----------
+
+    def call_at(self, when, callback, *args):
+        """Планирует callback(*args) на момент when (по часам self.clock)"""
+        handle = TimerHandle(when, callback, args, self)
+        heapq.heappush(self._heap, (when, next(self._seq), handle))
+        # Будим цикл, только если новый таймер стал ближайшим
+        if self._wakeup is not None and self._heap[0][2] is handle:
+            self._wakeup.set()
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def _on_cancel(self):
+        self._cancelled += 1
+        # Чистим кучу, когда отменённых записей стало больше половины
+        if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if entry[2].state == PENDING]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    @property
+    def pending(self):
+        """Количество ожидающих таймеров"""
+        return len(self._heap) - self._cancelled
+
+    @property
+    def in_flight(self):
+        """Количество сработавших таймеров, колбэки которых ещё выполняются"""
+        return len(self._running)
+
+    # ---------- срабатывание ----------
+
+    def fire_due(self, now=None):
+        """Запускает пачку наступивших таймеров, возвращает их количество"""
+        if now is None:
+            now = self.clock()
+        fired = 0
+        # self._heap читаем заново на каждом шаге: колбэк может вызвать чистку кучи
+        while self._heap and self._heap[0][0] <= now and fired < self.max_batch:
+            handle = heapq.heappop(self._heap)[2]
+            if handle.state == CANCELLED:
+                self._cancelled -= 1
+                continue
+            handle.state = FIRED
+            callback, args = handle.callback, handle.args
+            handle.args = ()
+            fired += 1
+            try:
+                result = callback(*args)
+            except Exception as e:
+                # Как и в _guard: упавший колбэк не должен останавливать цикл планировщика
+                logger.error(f"Ошибка в колбэке таймера: {e}")
+                continue
+            if asyncio.iscoroutine(result):
+                task = asyncio.ensure_future(self._guard(result))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+        self.fired_total += fired
+        return fired
+
+    async def _guard(self, coro):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка в колбэке таймера: {e}")
+
+    def _next_delay(self):
+        heap = self._heap
+        while heap and heap[0][2].state == CANCELLED:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        if not heap:
+            return None
+        return max(0.0, heap[0][0] - self.clock())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.fire_due()
+            delay = self._next_delay()
+            if delay == 0.0:
+                # Остались наступившие таймеры сверх max_batch — отдаём управление циклу
+                await asyncio.sleep(0)
+                continue
+            self._wakeup.clear()
+            timer = loop.call_later(delay, self._wakeup.set) if delay is not None else None
+            try:
+                await self._wakeup.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    # ---------- жизненный цикл ----------
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout=10):
+        """Останавливает цикл и дожидается выполняющихся колбэков"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+        if self._running:
+            _, unfinished = await asyncio.wait(set(self._running), timeout=timeout)
+            if unfinished:
+                logger.warning(f"Колбэки таймеров не завершились за {timeout} с: {len(unfinished)}")
+                for task in unfinished:
+                    task.cancel()
+                await asyncio.gather(*unfinished, return_exceptions=True)
@@ -0,0 +1,472 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import os
+import random
+import time
+
+import httpx
+from telegram.error import BadRequest, ChatMigrated, Conflict, Forbidden, InvalidToken, NetworkError, RetryAfter
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# ========== ПРИОРИТЕТЫ ==========
+# Ответы на действия пользователя идут раньше запланированных рассылок
+INTERACTIVE = 0
+SCHEDULED = 1
+LANE_NAMES = {INTERACTIVE: 'interactive', SCHEDULED: 'scheduled'}
+
+# Приоритет по умолчанию для текущей задачи (таймеры переключают его на SCHEDULED)
+send_priority = contextvars.ContextVar('send_priority', default=INTERACTIVE)
+# Сразу ли отдавать CircuitOpen при разомкнутом размыкателе. Да — только когда ответа
+# ждёт человек в обработчике; шаги воронки по таймеру ждут восстановления API
+send_fail_fast = contextvars.ContextVar('send_fail_fast', default=True)
+
+# ========== ЛИМИТЫ TELEGRAM ==========
+GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))  # сообщений в секунду на бота
+CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))  # сообщений в секунду на чат
+CHAT_BURST = float(os.getenv('OUTBOUND_CHAT_BURST', '3'))  # допустимая пачка в один чат
+MAX_RETRIES = 5
+
+# ========== ПОВТОРЫ И ТАЙМАУТЫ ==========
+# Сетевые сбои и 5xx повторяются с экспоненциальной паузой со случайным разбросом
+API_MAX_RETRIES = int(os.getenv('API_MAX_RETRIES', '3'))
+API_RETRY_BASE = float(os.getenv('API_RETRY_BASE', '0.5'))  # секунд перед первым повтором (в среднем вдвое меньше)
+API_RETRY_CAP = float(os.getenv('API_RETRY_CAP', '10'))
+# Размыкатель: после стольких сбоев подряд запросы сразу завершаются ошибкой
+BREAKER_THRESHOLD = int(os.getenv('API_BREAKER_THRESHOLD', '10'))
+BREAKER_COOLDOWN = float(os.getenv('API_BREAKER_COOLDOWN', '15'))
+
+# Таймауты по методам (секунды); загрузка файлов дольше текстовых сообщений
+API_READ_TIMEOUT = float(os.getenv('API_READ_TIMEOUT', '10'))
+METHOD_TIMEOUTS = {
+    'send_video': {'read_timeout': 30, 'write_timeout': 60},
+    'send_video_note': {'read_timeout': 30, 'write_timeout': 60},
+    'edit_message_text': {'read_timeout': 5},
+}
+
+# Ошибки, после которых неизвестно, выполнил ли Telegram запрос: ответ не дочитан
+_RESPONSE_LOST = (httpx.ReadTimeout, httpx.ReadError, httpx.RemoteProtocolError)
+# Ответ Telegram, который повтор не исправит
+_PERMANENT = (BadRequest, Forbidden, InvalidToken, ChatMigrated, Conflict)
+
+FLOOD = 'flood'
+TRANSIENT = 'transient'
+UNCERTAIN = 'uncertain'
+PERMANENT = 'permanent'
+
+
+class CircuitOpen(NetworkError):
+    """Bot API недоступен: запрос не отправлялся"""
+
+
+def _repeats_side_effect(method_name):
+    # Повтор отправки может продублировать сообщение; правки и ответы на кнопки — нет
+    return method_name.startswith(('send_', 'reply_', 'forward_', 'copy_'))
+
+
+def classify_failure(method_name, error):
+    """Вид ошибки запроса: flood, transient (повторяем), uncertain или permanent"""
+    if isinstance(error, RetryAfter):
+        return FLOOD
+    if isinstance(error, _PERMANENT) or isinstance(error, CircuitOpen):
+        return PERMANENT
+    if isinstance(error, NetworkError):
+        # TimedOut и ошибки httpx приходят с исходным исключением в __cause__,
+        # 5xx от Telegram — без него
+        if isinstance(error.__cause__, _RESPONSE_LOST) and _repeats_side_effect(method_name):
+            return UNCERTAIN
+        return TRANSIENT
+    return PERMANENT
+
+
+def retry_delay(attempt, base=API_RETRY_BASE, cap=API_RETRY_CAP):
+    """Пауза перед повтором: случайная в пределах экспоненциально растущего окна"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Размыкается после threshold сетевых сбоев подряд и через cooldown пропускает один пробный запрос"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        if self.state == self.CLOSED or not self.threshold:
+            return True
+        if self.state == self.OPEN and self.clock() - self.opened_at >= self.cooldown:
+            # Пробный запрос: пока он не завершился, остальные по-прежнему отклоняются
+            self.state = self.HALF_OPEN
+            return True
+        self.rejected += 1
+        return False
+
+    def retry_in(self):
+        """Через сколько секунд размыкатель пропустит следующий запрос"""
+        if self.state == self.OPEN:
+            return max(0.05, self.opened_at + self.cooldown - self.clock())
+        return min(1.0, self.cooldown) if self.state == self.HALF_OPEN else 0.0
+
+    def success(self):
+        if self.state != self.CLOSED:
+            logger.info("Bot API снова отвечает, запросы возобновлены")
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.threshold
+                                             and self.failures >= self.threshold):
+            if self.state == self.CLOSED:
+                self.opened += 1
+                logger.error(f"Bot API не отвечает ({self.failures} сбоев подряд), запросы приостановлены")
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+
+
+class TokenBucket:
+    """Ведро токенов с резервированием: долг в токенах превращается в задержку"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self, now):
+        """Забирает токен и возвращает, сколько секунд нужно подождать"""
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def block(self, seconds, now):
+        """Запрещает отправку на seconds секунд (ответ 429 от Telegram)"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('method', 'args', 'kwargs', 'bucket', 'priority', 'future',
+                 'enqueued_at', 'attempts', 'chat_reserved', 'failures', 'fail_fast')
+
+    def __init__(self, method, args, kwargs, bucket, priority, future, now, fail_fast=True):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.bucket = bucket
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = now
+        self.attempts = 0
+        self.chat_reserved = False
+        self.failures = 0
+        self.fail_fast = fail_fast
+
+
+def _bucket_for(method, kwargs):
+    """Определяет чат запроса: chat_id из аргументов или объект, к которому привязан метод"""
+    chat_id = kwargs.get('chat_id')
+    if chat_id is not None:
+        return chat_id
+    owner = getattr(method, '__self__', None)
+    # Message.reply_text и т.п.
+    chat_id = getattr(owner, 'chat_id', None)
+    if chat_id is None:
+        # CallbackQuery.edit_message_text и т.п.
+        message = getattr(owner, 'message', None)
+        chat_id = getattr(message, 'chat_id', None)
+    return chat_id
+
+
+class ApiMetrics:
+    """Метрики запросов одного диспетчера.
+
+    Создаются вместе с диспетчером, а не при импорте модуля: у каждого бота
+    процесса (tenants.py) свой реестр с меткой tenant.
+    """
+
+    def __init__(self, registry=None):
+        self.latency = Histogram(
+            'bot_api_request_duration_seconds', 'Время запросов к Bot API', ('method',), registry=registry
+        )
+        self.errors = Counter('bot_api_errors_total', 'Ошибки запросов к Bot API', ('method', 'error'), registry=registry)
+        self.retries = Counter(
+            'bot_api_retries_total', 'Повторы запросов к Bot API', ('method', 'reason'), registry=registry
+        )
+        self.wait = Histogram(
+            'bot_outbound_wait_seconds', 'Ожидание в очереди отправки до запроса к Bot API', ('lane',),
+            registry=registry,
+        )
+
+
+class OutboundDispatcher:
+    """Центральная очередь исходящих запросов к Bot API с учётом лимитов Telegram"""
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST,
+                 workers=8, clock=time.monotonic, breaker=None, max_retries=API_MAX_RETRIES, registry=None):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.clock = clock
+        self._queue = None
+        self._seq = itertools.count()
+        self._tasks = []
+        self._delayed = 0
+        self._active = 0
+        self.breaker = breaker if breaker is not None else CircuitBreaker(clock=clock)
+        # SuppressionList: чаты, заблокировавшие бота (подключается после загрузки состояния)
+        self.suppression = None
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate, clock())
+        self._chats = {}
+        self._last_prune = clock()
+        # Метрики
+        self.metrics = ApiMetrics(registry)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.retries = {FLOOD: 0, TRANSIENT: 0}
+        self.gave_up = 0
+        # Запросы, которые сейчас ждут ответа Bot API (занятые соединения пула HTTP)
+        self.in_request = 0
+        self.in_request_max = 0
+        self.wait_total = {lane: 0.0 for lane in LANE_NAMES}
+        self.wait_max = {lane: 0.0 for lane in LANE_NAMES}
+        self.sent_by_lane = {lane: 0 for lane in LANE_NAMES}
+
+    # ---------- публичный интерфейс ----------
+
+    async def call(self, method, *args, priority=None, **kwargs):
+        """Выполняет method(*args, **kwargs) через очередь и возвращает результат"""
+        for option, value in METHOD_TIMEOUTS.get(method.__name__, {'read_timeout': API_READ_TIMEOUT}).items():
+            kwargs.setdefault(option, value)
+        bucket = _bucket_for(method, kwargs)
+        if self.suppression is not None:
+            self.suppression.check(bucket)
+        if self._queue is None:
+            # Диспетчер не запущен (например, в разовых скриптах) — вызываем напрямую
+            return await method(*args, **kwargs)
+        if priority is None:
+            priority = send_priority.get()
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(method, args, kwargs, bucket, priority, future, self.clock(),
+                   fail_fast=priority == INTERACTIVE and send_fail_fast.get())
+        self._queue.put_nowait((priority, next(self._seq), job))
+        return await future
+
+    @property
+    def queue_depth(self):
+        """Запросы, ожидающие отправки (в очереди и отложенные лимитом чата)"""
+        return (self._queue.qsize() if self._queue is not None else 0) + self._delayed
+
+    @property
+    def pending(self):
+        return self.queue_depth + self._active
+
+    def stats(self):
+        """Снимок метрик очереди"""
+        return {
+            'queue_depth': self.queue_depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'retries': dict(self.retries),
+            'gave_up': self.gave_up,
+            'in_request': self.in_request,
+            'in_request_max': self.in_request_max,
+            'breaker': self.breaker.state,
+            'breaker_rejected': self.breaker.rejected,
+            'chats_tracked': len(self._chats),
+            'lanes': {
+                name: {
+                    'sent': self.sent_by_lane[lane],
+                    'wait_avg': self.wait_total[lane] / self.sent_by_lane[lane] if self.sent_by_lane[lane] else 0.0,
+                    'wait_max': self.wait_max[lane],
+                }
+                for lane, name in LANE_NAMES.items()
+            },
+        }
+
+    # ---------- обработка очереди ----------
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _requeue_later(self, delay, job):
+        self._delayed += 1
+        asyncio.get_running_loop().call_later(delay, self._requeue, job)
+
+    def _requeue(self, job):
+        self._delayed -= 1
+        if self._queue is None:
+            job.future.cancel()
+            return
+        self._queue.put_nowait((job.priority, next(self._seq), job))
+
+    def _prune(self, now):
+        # Убираем вёдра чатов, которые давно ничего не отправляли
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.idle(now)]:
+            del self._chats[chat_id]
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            self._active += 1
+            try:
+                await self._process(job)
+            finally:
+                self._active -= 1
+
+    async def _process(self, job):
+        if job.future.done():
+            return
+        now = self.clock()
+
+        # Лимит на чат: не держим воркер, а возвращаем задачу в очередь позже
+        if job.bucket is not None and not job.chat_reserved:
+            job.chat_reserved = True
+            delay = self._chat_bucket(job.bucket, now).reserve(now)
+            if delay > 0:
+                self._requeue_later(delay, job)
+                return
+
+        # Глобальный лимит: воркер ждёт своей очереди
+        delay = self._global.reserve(now)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        method_name = job.method.__name__
+        if not self.breaker.allow():
+            if not job.fail_fast:
+                # Рассылки и таймеры ждут восстановления API, а не теряют сообщения
+                self._requeue_later(self.breaker.retry_in(), job)
+                return
+            # Пользователь ждёт ответа — сразу отдаём ошибку, обработчик выберет запасной вариант
+            self.failed += 1
+            self.metrics.errors.labels(method_name, 'CircuitOpen').inc()
+            if not job.future.done():
+                job.future.set_exception(CircuitOpen("Bot API временно недоступен"))
+            return
+
+        started = self.clock()
+        waited = started - job.enqueued_at
+        self.in_request += 1
+        if self.in_request > self.in_request_max:
+            self.in_request_max = self.in_request
+        try:
+            result = await job.method(*job.args, **job.kwargs)
+        except Exception as e:
+            kind = classify_failure(method_name, e)
+            self.metrics.errors.labels(method_name, type(e).__name__).inc()
+            if kind in (TRANSIENT, UNCERTAIN):
+                self.breaker.failure()
+            else:
+                # Telegram ответил (пусть и ошибкой) — API доступен
+                self.breaker.success()
+            if self._retry(job, method_name, kind, e):
+                return
+            if self.suppression is not None:
+                self.suppression.observe(job.bucket, e)
+            self.failed += 1
+            if kind in (FLOOD, TRANSIENT):
+                self.gave_up += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.breaker.success()
+            self.metrics.latency.labels(method_name).observe(self.clock() - started)
+            self.sent += 1
+            lane = job.priority if job.priority in LANE_NAMES else SCHEDULED
+            self.metrics.wait.labels(LANE_NAMES[lane]).observe(waited)
+            self.sent_by_lane[lane] += 1
+            self.wait_total[lane] += waited
+            if waited > self.wait_max[lane]:
+                self.wait_max[lane] = waited
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self.in_request -= 1
+        self._prune(self.clock())
+
+    def _retry(self, job, method_name, kind, error):
+        """Ставит запрос на повтор, если ошибка это допускает; False — отдать ошибку вызывающему"""
+        if kind == FLOOD:
+            if job.attempts >= MAX_RETRIES:
+                return False
+            delay = float(error.retry_after)
+            logger.warning(f"Flood limit для чата {job.bucket}, повтор через {delay} сек")
+            if job.bucket is not None:
+                self._chat_bucket(job.bucket, self.clock()).block(delay, self.clock())
+        elif kind == TRANSIENT:
+            if job.failures >= self.max_retries:
+                return False
+            delay = retry_delay(job.failures)
+            job.failures += 1
+            logger.warning(f"{method_name}: {error}, повтор {job.failures} через {delay:.1f} сек")
+        else:
+            return False
+        job.attempts += 1
+        self.retried += 1
+        self.retries[kind] += 1
+        self.metrics.retries.labels(method_name, kind).inc()
+        job.chat_reserved = True
+        self._requeue_later(delay, job)
+        return True
+
+    # ---------- жизненный цикл ----------
+
+    def start(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает воркеры"""
+        if self._queue is None:
+            return
+        deadline = self.clock() + timeout
+        while self.pending and self.clock() < deadline:
+            await asyncio.sleep(0.05)
+        if self.pending:
+            logger.warning(f"Не отправлено при остановке: {self.pending} запросов")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Оставшиеся в очереди запросы отменяем, чтобы не подвесить ожидающих
+        while not self._queue.empty():
+            self._queue.get_nowait()[2].future.cancel()
+        self._queue = None
@@ -0,0 +1,131 @@
+import time
+
+# Номер слота таймера напоминания о скидке; слоты 1..N — таймеры авто-перехода уроков
+DISCOUNT_SLOT = 0
+# Слот следующего шага воронки (пауза между сообщениями)
+STEP_SLOT = -1
+
+
+def timer_key(slot):
+    """Ключ таймера в хранилище (совместим с прежними ключами состояния)"""
+    if slot == DISCOUNT_SLOT:
+        return 'discount_timer'
+    if slot == STEP_SLOT:
+        return 'step'
+    return f'timer_{slot}'
+
+
+def timer_slot(key):
+    if key == 'discount_timer':
+        return DISCOUNT_SLOT
+    if key == 'step':
+        return STEP_SLOT
+    return int(key.rsplit('_', 1)[1])
+
+
+class UserSession:
+    """Состояние пользователя в воронке с фиксированным набором полей"""
+
+    __slots__ = (
+        'chat_id', 'current_video', 'start_time', 'completed', 'cleanup_pending',
+        'button_msg', 'button_lesson', 'button_kind', 'lesson_sent_at', 'lesson_timer', 'lesson_timer_slot',
+        'discount_timer', 'discount_timer_set', 'discount_reminder_time', 'step_timer',
+    )
+
+    def __init__(self, chat_id, current_video=1, start_time=None):
+        self.chat_id = chat_id
+        self.current_video = current_video
+        # Время хранится как timestamp (float), а не datetime — так компактнее
+        self.start_time = time.time() if start_time is None else start_time
+        self.completed = False
+        self.cleanup_pending = False
+        # Кнопка «Я посмотрел видео» текущего урока
+        self.button_msg = 0
+        self.button_lesson = 0
+        # Сообщение, под которым стоит кнопка: отдельное, текст урока или видео (course.BUTTON_*)
+        self.button_kind = 0
+        # Когда отправлена кнопка текущего урока — для времени до нажатия в аналитике
+        self.lesson_sent_at = None
+        # У пользователя одновременно не больше одного таймера урока и одного таймера скидки
+        self.lesson_timer = None
+        self.lesson_timer_slot = 0
+        self.discount_timer = None
+        self.discount_timer_set = False
+        self.discount_reminder_time = None
+        # Шаги воронки идут друг за другом, поэтому ожидающий шаг всегда один
+        self.step_timer = None
+
+    # ---------- таймеры ----------
+
+    def get_timer(self, slot):
+        if slot == DISCOUNT_SLOT:
+            return self.discount_timer
+        if slot == STEP_SLOT:
+            return self.step_timer
+        return self.lesson_timer if self.lesson_timer_slot == slot else None
+
+    def set_timer(self, slot, handle):
+        if slot == DISCOUNT_SLOT:
+            self.discount_timer = handle
+        elif slot == STEP_SLOT:
+            self.step_timer = handle
+        else:
+            self.lesson_timer = handle
+            self.lesson_timer_slot = slot if handle is not None else 0
+
+    def pop_timer(self, slot):
+        handle = self.get_timer(slot)
+        if handle is not None:
+            self.set_timer(slot, None)
+        return handle
+
+    def pending_timers(self):
+        return [
+            timer for timer in (self.lesson_timer, self.discount_timer, self.step_timer)
+            if timer is not None and not timer.done()
+        ]
+
+    # ---------- сериализация ----------
+
+    def to_dict(self):
+        """Снимок для хранилища (таймеры хранятся отдельно)"""
+        data = {
+            'current_video': self.current_video,
+            'chat_id': self.chat_id,
+            'start_time': self.start_time,
+            'completed': self.completed,
+            'discount_timer_set': self.discount_timer_set,
+        }
+        if self.button_msg:
+            data['button_msg'] = self.button_msg
+            if self.button_kind:
+                data['button_kind'] = self.button_kind
+        if self.button_lesson:
+            data['button_lesson'] = self.button_lesson
+        if self.lesson_sent_at is not None:
+            data['lesson_sent_at'] = self.lesson_sent_at
+        if self.discount_reminder_time is not None:
+            data['discount_reminder_time'] = self.discount_reminder_time
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls(data['chat_id'], data.get('current_video', 1), data.get('start_time'))
+        session.completed = data.get('completed', False)
+        session.discount_timer_set = data.get('discount_timer_set', False)
+        session.discount_reminder_time = data.get('discount_reminder_time')
+        session.lesson_sent_at = data.get('lesson_sent_at')
+        if 'button_msg' in data:
+            session.button_msg = data['button_msg']
+            session.button_lesson = data.get('button_lesson', session.current_video)
+            session.button_kind = data.get('button_kind', 0)
+        elif 'button_lesson' in data:
+            # Урок отправлен, но номер сообщения с кнопкой неизвестен (сбой сети при отправке)
+            session.button_lesson = data['button_lesson']
+        else:
+            # Формат до UserSession: отдельные ключи button_msg_N
+            lesson = session.current_video
+            if f'button_msg_{lesson}' in data:
+                session.button_msg = data[f'button_msg_{lesson}']
+                session.button_lesson = lesson
+        return session
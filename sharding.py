@@ -0,0 +1,308 @@
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# ========== МАРШРУТИЗАЦИЯ ==========
+
+
+def update_user_id(data):
+    """user_id отправителя из сырого Update (from у message, callback_query и т.п.)"""
+    for value in data.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user')
+            if isinstance(user, dict):
+                return user.get('id')
+    return None
+
+
+def shard_for(user_id, shards):
+    """Номер воркера для пользователя: все апдейты одного пользователя идут в один процесс"""
+    if user_id is None:
+        return 0
+    return user_id % shards
+
+
+# ========== ФАЙЛЫ СОСТОЯНИЯ ==========
+
+
+class ShardLayoutError(ValueError):
+    """Сохранённое состояние разложено под другое число воркеров"""
+
+
+def state_db_path():
+    return os.getenv('STATE_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot_state.db'))
+
+
+def shard_db_path(shard_id, base_path=None):
+    """База состояния воркера: bot_state.db -> bot_state.shard<N>.db"""
+    root, ext = os.path.splitext(base_path or state_db_path())
+    return f'{root}.shard{shard_id}{ext}'
+
+
+def check_state_layout(shards):
+    """Проверяет, что базы состояния на диске соответствуют числу воркеров.
+
+    Пользователь хранится в базе воркера user_id % BOT_WORKERS: после смены числа
+    воркеров почти все попали бы в чужую базу — начали бы курс заново, а их таймеры
+    не сработали бы. Такой запуск останавливается с объяснением.
+    """
+    if os.getenv('STATE_BACKEND', 'sqlite') != 'sqlite':
+        return
+    base_path = state_db_path()
+    directory = os.path.dirname(os.path.abspath(base_path))
+    root, ext = os.path.splitext(os.path.basename(base_path))
+    pattern = re.compile(rf'^{re.escape(root)}\.shard(\d+){re.escape(ext)}$')
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    found = sorted(int(match.group(1)) for match in map(pattern.match, names) if match)
+    if shards == 1:
+        if found:
+            raise ShardLayoutError(
+                f"в {directory} базы состояния для BOT_WORKERS={len(found)} ({root}.shard*{ext}): "
+                f"запустите с BOT_WORKERS={len(found)} или перенесите пользователей в {base_path}"
+            )
+    elif found and found != list(range(shards)):
+        raise ShardLayoutError(
+            f"базы состояния сохранены для BOT_WORKERS={len(found)}, а сейчас BOT_WORKERS={shards}: "
+            f"верните BOT_WORKERS={len(found)} или переложите пользователей по user_id % {shards}"
+        )
+    elif not found and os.path.exists(base_path):
+        raise ShardLayoutError(
+            f"состояние сохранено без шардов в {base_path}: запустите с BOT_WORKERS=1 "
+            "или переложите пользователей по базам воркеров"
+        )
+
+
+# ========== ВОРКЕР ==========
+
+
+def worker_main(shard_id, conn, env):
+    """Точка входа процесса-воркера: поднимает бота и читает апдейты из канала"""
+    os.environ.update(env)
+    # Ctrl+C получает вся группа процессов — воркер завершается по закрытию канала
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Бот импортируем только в дочернем процессе
+    import bot
+    asyncio.run(bot.run_worker(conn))
+
+
+class _Shard:
+    __slots__ = ('shard_id', 'process', 'conn', 'queue', 'thread', 'env', 'restarts')
+
+    def __init__(self, shard_id, env):
+        self.shard_id = shard_id
+        self.process = None
+        self.conn = None
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.env = env
+        self.restarts = 0
+
+
+class ShardSupervisor:
+    """Запускает N процессов-воркеров и раскладывает по ним апдейты по user_id"""
+
+    def __init__(self, shards, target=worker_main, target_args=(), env=None):
+        self.shards = shards
+        self.target = target
+        self.target_args = target_args
+        self._ctx = multiprocessing.get_context('spawn')
+        self._shards = [_Shard(i, self._shard_env(i, env or {})) for i in range(shards)]
+        self.dispatched = [0] * shards
+        self._stopping = False
+
+    def _shard_env(self, shard_id, env):
+        # Каждому воркеру — своя база состояния и своя доля глобального лимита Telegram
+        shard_env = {
+            'SHARD_ID': str(shard_id),
+            'SHARD_COUNT': str(self.shards),
+            'STATE_DB_PATH': shard_db_path(shard_id),
+            'OUTBOUND_GLOBAL_RATE': str(float(os.getenv('OUTBOUND_GLOBAL_RATE', '30')) / self.shards),
+        }
+        shard_env.update(env)
+        return shard_env
+
+    def _spawn(self, shard):
+        if shard.conn is not None:
+            shard.conn.close()
+        reader, writer = self._ctx.Pipe(duplex=False)
+        shard.process = self._ctx.Process(
+            target=self.target,
+            args=(shard.shard_id, reader, shard.env) + tuple(self.target_args),
+            name=f'bot-shard-{shard.shard_id}',
+            daemon=True,
+        )
+        shard.process.start()
+        reader.close()
+        shard.conn = writer
+
+    def _writer(self, shard):
+        # Отдельный поток на воркер сохраняет порядок апдейтов внутри шарда
+        while True:
+            raw = shard.queue.get()
+            if raw is None:
+                shard.conn.close()
+                return
+            while True:
+                try:
+                    shard.conn.send_bytes(raw)
+                    break
+                except (BrokenPipeError, OSError):
+                    if self._stopping:
+                        break
+                    # Воркер упал — ждём, пока монитор его перезапустит
+                    time.sleep(0.5)
+
+    def start(self):
+        for shard in self._shards:
+            self._spawn(shard)
+            shard.thread = threading.Thread(target=self._writer, args=(shard,), daemon=True)
+            shard.thread.start()
+        logger.info(f"Запущено воркеров: {self.shards}")
+
+    def dispatch(self, raw, user_id=None):
+        """Отправляет сырой Update (bytes) воркеру его пользователя"""
+        if user_id is None:
+            user_id = update_user_id(json.loads(raw))
+        index = shard_for(user_id, self.shards)
+        self.dispatched[index] += 1
+        self._shards[index].queue.put(raw)
+
+    def check_workers(self):
+        """Перезапускает упавшие воркеры"""
+        for shard in self._shards:
+            if self._stopping:
+                return
+            if shard.process is not None and not shard.process.is_alive():
+                shard.restarts += 1
+                logger.error(
+                    f"Воркер {shard.shard_id} завершился с кодом {shard.process.exitcode}, "
+                    f"перезапуск #{shard.restarts}"
+                )
+                self._spawn(shard)
+
+    def stop(self, timeout=30):
+        """Закрывает каналы (воркеры завершаются сами) и ждёт процессы"""
+        self._stopping = True
+        for shard in self._shards:
+            shard.queue.put(None)
+        deadline = time.monotonic() + timeout
+        for shard in self._shards:
+            shard.thread.join(max(0.0, deadline - time.monotonic()))
+            shard.process.join(max(0.0, deadline - time.monotonic()))
+            if shard.process.is_alive():
+                logger.warning(f"Воркер {shard.shard_id} не завершился, останавливаем принудительно")
+                shard.process.terminate()
+                shard.process.join(5)
+
+
+# ========== ИСТОЧНИКИ АПДЕЙТОВ ДЛЯ СУПЕРВИЗОРА ==========
+
+
+async def poll_updates(supervisor, token, stop_event, api_url='https://api.telegram.org'):
+    """Long polling в супервизоре: апдейты не разбираются в объекты, а сразу уходят воркерам"""
+    import httpx
+
+    base = f'{api_url}/bot{token}'
+    offset = None
+    backoff = 1
+    async with httpx.AsyncClient(timeout=httpx.Timeout(60, connect=10)) as client:
+        await client.post(f'{base}/deleteWebhook')
+        while not stop_event.is_set():
+            params = {'timeout': 50}
+            if offset is not None:
+                params['offset'] = offset
+            try:
+                response = await client.get(f'{base}/getUpdates', params=params)
+                updates = response.json()['result']
+                backoff = 1
+            except Exception as e:
+                logger.error(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            for update in updates:
+                offset = update['update_id'] + 1
+                supervisor.dispatch(
+                    json.dumps(update, ensure_ascii=False).encode(), update_user_id(update)
+                )
+
+
+async def serve_webhook(supervisor, token, stop_event, url, listen, port, path, secret):
+    """Webhook в супервизоре: тело запроса пересылается воркеру как есть"""
+    import httpx
+    from http_server import HttpServer, Response
+
+    async def handle(request):
+        if secret and not hmac.compare_digest(
+                request.headers.get('x-telegram-bot-api-secret-token', ''), secret):
+            return Response(403, 'forbidden')
+        try:
+            user_id = update_user_id(json.loads(request.body))
+        except (ValueError, AttributeError):
+            return Response(400, 'bad update')
+        supervisor.dispatch(request.body, user_id)
+        return Response(200, 'ok')
+
+    server = HttpServer(listen, port)
+    server.route('POST', path, handle)
+    await server.start()
+    try:
+        if url:
+            async with httpx.AsyncClient() as client:
+                await client.post(
+                    f'https://api.telegram.org/bot{token}/setWebhook',
+                    data={'url': url + path, 'secret_token': secret},
+                )
+        await stop_event.wait()
+    finally:
+        await server.stop()
+
+
+async def run_supervisor(shards, token):
+    """Супервизор: N воркеров, апдейты из long polling или webhook (WEBHOOK_URL/BOT_MODE)"""
+    from http_server import webhook_secret
+
+    supervisor = ShardSupervisor(shards)
+    supervisor.start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async def monitor():
+        while not stop_event.is_set():
+            await asyncio.sleep(1)
+            supervisor.check_workers()
+
+    monitor_task = loop.create_task(monitor())
+    url = os.getenv('WEBHOOK_URL', '').rstrip('/')
+    try:
+        if url or os.getenv('BOT_MODE') == 'webhook':
+            await serve_webhook(
+                supervisor, token, stop_event, url,
+                os.getenv('WEBHOOK_LISTEN', '0.0.0.0'), int(os.getenv('PORT', '8080')),
+                os.getenv('WEBHOOK_PATH', '/telegram'),
+                os.getenv('WEBHOOK_SECRET') or (webhook_secret(token) if url else ''),
+            )
+        else:
+            poll_task = loop.create_task(poll_updates(supervisor, token, stop_event))
+            await stop_event.wait()
+            poll_task.cancel()
+    finally:
+        monitor_task.cancel()
+        await asyncio.to_thread(supervisor.stop)
+        logger.info(f"Супервизор остановлен, апдейтов по воркерам: {supervisor.dispatched}")
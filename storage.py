@@ -0,0 +1,295 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+# ========== БЭКЕНДЫ ХРАНЕНИЯ ==========
+class StateBackend:
+    """Интерфейс хранилища состояния воронки"""
+
+    def load_users(self):
+        """Возвращает {user_id: data}"""
+        raise NotImplementedError
+
+    def load_timers(self):
+        """Возвращает список (user_id, key, callback, args, due)"""
+        raise NotImplementedError
+
+    def load_meta(self):
+        """Возвращает служебные значения {key: value}"""
+        raise NotImplementedError
+
+    def load_users_page(self, after, limit):
+        """Возвращает до limit пар (user_id, data) с user_id > after по возрастанию"""
+        raise NotImplementedError
+
+    def apply(self, users, timers, meta):
+        """Атомарно применяет пачку изменений.
+
+        users: {user_id: data или None для удаления}
+        timers: {(user_id, key): (callback, args, due) или None для удаления}
+        meta: {key: value или None для удаления}
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """Хранилище в памяти (для локального запуска и тестов)"""
+
+    def __init__(self):
+        self.users = {}
+        self.timers = {}
+        self.meta = {}
+
+    def load_users(self):
+        return dict(self.users)
+
+    def load_timers(self):
+        return [(user_id, key) + value for (user_id, key), value in self.timers.items()]
+
+    def load_meta(self):
+        return dict(self.meta)
+
+    def load_users_page(self, after, limit):
+        user_ids = heapq.nsmallest(limit, (user_id for user_id in self.users if user_id > after))
+        return [(user_id, self.users[user_id]) for user_id in user_ids]
+
+    def apply(self, users, timers, meta):
+        for user_id, data in users.items():
+            if data is None:
+                self.users.pop(user_id, None)
+            else:
+                self.users[user_id] = data
+        for timer_key, value in timers.items():
+            if value is None:
+                self.timers.pop(timer_key, None)
+            else:
+                self.timers[timer_key] = value
+        for key, value in meta.items():
+            if value is None:
+                self.meta.pop(key, None)
+            else:
+                self.meta[key] = value
+
+
+class SQLiteBackend(StateBackend):
+    """SQLite в режиме WAL: журнал дописывается в конец, коммит — одной транзакцией на пачку"""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # В WAL-режиме NORMAL не теряет целостность при падении процесса
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS timers ('
+            'user_id INTEGER NOT NULL, key TEXT NOT NULL, callback TEXT NOT NULL, '
+            'args TEXT NOT NULL, due REAL NOT NULL, PRIMARY KEY (user_id, key))'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+        )
+
+    def load_users(self):
+        rows = self.conn.execute('SELECT user_id, data FROM users')
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def load_timers(self):
+        rows = self.conn.execute('SELECT user_id, key, callback, args, due FROM timers')
+        return [
+            (user_id, key, callback, tuple(json.loads(args)), due)
+            for user_id, key, callback, args, due in rows
+        ]
+
+    def load_meta(self):
+        return {key: json.loads(value) for key, value in self.conn.execute('SELECT key, value FROM meta')}
+
+    def load_users_page(self, after, limit):
+        # Постраничное чтение по первичному ключу: память не зависит от числа пользователей
+        rows = self.conn.execute(
+            'SELECT user_id, data FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after, limit)
+        )
+        return [(user_id, json.loads(data)) for user_id, data in rows]
+
+    def apply(self, users, timers, meta):
+        upsert_users = [
+            (user_id, json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+            for user_id, data in users.items() if data is not None
+        ]
+        delete_users = [(user_id,) for user_id, data in users.items() if data is None]
+        upsert_timers = [
+            (user_id, key, value[0], json.dumps(list(value[1])), value[2])
+            for (user_id, key), value in timers.items() if value is not None
+        ]
+        delete_timers = [timer_key for timer_key, value in timers.items() if value is None]
+        upsert_meta = [(key, json.dumps(value)) for key, value in meta.items() if value is not None]
+        delete_meta = [(key,) for key, value in meta.items() if value is None]
+
+        with self.conn:
+            self.conn.execute('BEGIN')
+            if upsert_users:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)', upsert_users
+                )
+            if delete_users:
+                self.conn.executemany('DELETE FROM users WHERE user_id = ?', delete_users)
+            if upsert_timers:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO timers (user_id, key, callback, args, due) '
+                    'VALUES (?, ?, ?, ?, ?)', upsert_timers
+                )
+            if delete_timers:
+                self.conn.executemany(
+                    'DELETE FROM timers WHERE user_id = ? AND key = ?', delete_timers
+                )
+            if upsert_meta:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', upsert_meta
+                )
+            if delete_meta:
+                self.conn.executemany('DELETE FROM meta WHERE key = ?', delete_meta)
+
+    def close(self):
+        self.conn.close()
+
+
+def create_backend(kind=None, path=None):
+    """Создаёт бэкенд по настройкам окружения (STATE_BACKEND, STATE_DB_PATH)"""
+    kind = kind or os.getenv('STATE_BACKEND', 'sqlite')
+    if kind == 'memory':
+        return MemoryBackend()
+    if kind == 'sqlite':
+        return SQLiteBackend(path or os.getenv('STATE_DB_PATH', 'bot_state.db'))
+    raise ValueError(f"Неизвестный STATE_BACKEND: {kind}")
+
+
+# ========== ХРАНИЛИЩЕ С ГРУППОВЫМИ КОММИТАМИ ==========
+class StateStore:
+    """Копит изменения в журнале в памяти и сбрасывает их пачкой вне обработчиков"""
+
+    def __init__(self, snapshot, flush_interval=0.5):
+        # snapshot(user_id) -> сериализуемый dict или None, если пользователь удалён
+        self.backend = None
+        self.snapshot = snapshot
+        self.flush_interval = flush_interval
+        self._dirty_users = set()
+        # Компактные записи выгруженных пользователей: пишутся вместо удаления
+        self._archived = {}
+        self._timer_ops = {}
+        self._meta_ops = {}
+        # Служебные значения (кэш file_id и т.п.) целиком держим в памяти
+        self.meta = {}
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.commits = 0
+
+    # ---------- горячий путь: только отметки в памяти ----------
+
+    def mark_dirty(self, user_id):
+        self._dirty_users.add(user_id)
+        # Пользователь снова изменился — архивная запись больше не актуальна
+        self._archived.pop(user_id, None)
+
+    def archive_user(self, user_id, data):
+        """Записывает вместо пользователя, которого уже нет в памяти, компактную запись data"""
+        self._dirty_users.add(user_id)
+        self._archived[user_id] = data
+
+    def save_timer(self, user_id, key, callback, args, due):
+        self._timer_ops[(user_id, key)] = (callback, args, due)
+
+    def delete_timer(self, user_id, key):
+        self._timer_ops[(user_id, key)] = None
+
+    def set_meta(self, key, value):
+        """Сохраняет служебное значение (None — удалить)"""
+        if value is None:
+            self.meta.pop(key, None)
+        else:
+            self.meta[key] = value
+        self._meta_ops[key] = value
+
+    @property
+    def pending_writes(self):
+        return len(self._dirty_users) + len(self._timer_ops) + len(self._meta_ops)
+
+    # ---------- загрузка и сброс ----------
+
+    async def open(self, backend):
+        """Подключает бэкенд и читает всех пользователей и таймеры при старте"""
+        self.backend = backend
+        users = await asyncio.to_thread(self.backend.load_users)
+        timers = await asyncio.to_thread(self.backend.load_timers)
+        self.meta = await asyncio.to_thread(self.backend.load_meta)
+        return users, timers
+
+    async def users_page(self, after, limit):
+        """Следующая страница пользователей из хранилища (для рассылок)"""
+        async with self._flush_lock:
+            if self.backend is None:
+                return []
+            return await asyncio.to_thread(self.backend.load_users_page, after, limit)
+
+    async def flush(self):
+        """Сбрасывает накопленный журнал одной транзакцией"""
+        async with self._flush_lock:
+            if self.backend is None or not self.pending_writes:
+                return
+            # Снимок берём в цикле событий, запись в БД — в отдельном потоке
+            archived = self._archived
+            users = {
+                user_id: self.snapshot(user_id) or archived.get(user_id) for user_id in self._dirty_users
+            }
+            timers = self._timer_ops
+            meta = self._meta_ops
+            self._dirty_users = set()
+            self._archived = {}
+            self._timer_ops = {}
+            self._meta_ops = {}
+            try:
+                await asyncio.to_thread(self.backend.apply, users, timers, meta)
+                self.commits += 1
+            except Exception as e:
+                logger.error(f"Ошибка записи состояния: {e}")
+                # Возвращаем изменения в журнал, более новые не перетираем
+                self._dirty_users.update(users)
+                for user_id, data in archived.items():
+                    self._archived.setdefault(user_id, data)
+                for timer_key, value in timers.items():
+                    self._timer_ops.setdefault(timer_key, value)
+                for key, value in meta.items():
+                    self._meta_ops.setdefault(key, value)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
@@ -0,0 +1,84 @@
+import collections
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед перезапуском растёт вдвое после каждого падения подряд
+RESTART_BACKOFF_BASE = float(os.getenv('RESTART_BACKOFF_BASE', '1'))
+RESTART_BACKOFF_CAP = float(os.getenv('RESTART_BACKOFF_CAP', '60'))
+# Столько падений за CRASH_LOOP_WINDOW секунд — цикл падений: перезапуск не поможет,
+# процесс завершается с ошибкой, и решение остаётся за хостингом
+CRASH_LOOP_LIMIT = int(os.getenv('CRASH_LOOP_LIMIT', '5'))
+CRASH_LOOP_WINDOW = float(os.getenv('CRASH_LOOP_WINDOW', '300'))
+# После стольких секунд работы запуск считается удачным и пауза сбрасывается
+RESTART_STABLE_AFTER = float(os.getenv('RESTART_STABLE_AFTER', '60'))
+
+
+class CrashLoop(RuntimeError):
+    """Бот падает снова и снова — перезапускать дальше бессмысленно"""
+
+
+class RestartPolicy:
+    """Экспоненциальная пауза со случайным разбросом и обнаружение цикла падений"""
+
+    def __init__(self, base=RESTART_BACKOFF_BASE, cap=RESTART_BACKOFF_CAP, limit=CRASH_LOOP_LIMIT,
+                 window=CRASH_LOOP_WINDOW, stable_after=RESTART_STABLE_AFTER, clock=time.monotonic):
+        self.base = base
+        self.cap = cap
+        self.limit = limit
+        self.window = window
+        self.stable_after = stable_after
+        self.clock = clock
+        self.attempt = 0
+        self._crashes = collections.deque()
+
+    def crashed(self, uptime):
+        """Отмечает падение после uptime секунд работы и возвращает паузу до перезапуска"""
+        now = self.clock()
+        if uptime >= self.stable_after:
+            self.attempt = 0
+        self._crashes.append(now)
+        while self._crashes and now - self._crashes[0] > self.window:
+            self._crashes.popleft()
+        if len(self._crashes) >= self.limit:
+            raise CrashLoop(f"{len(self._crashes)} падений за {self.window:.0f} с")
+        delay = min(self.cap, self.base * 2 ** self.attempt)
+        self.attempt += 1
+        # Разброс, чтобы несколько процессов не перезапускались одновременно
+        return random.uniform(delay / 2, delay)
+
+
+def supervise(run, policy=None, sleep=time.sleep):
+    """Запускает run() и перезапускает его после падения.
+
+    run() возвращается при штатной остановке (сигнал); исключение — падение.
+    Возвращает число перезапусков; при цикле падений выбрасывает CrashLoop.
+    """
+    policy = policy or RestartPolicy()
+    restarts = 0
+    while True:
+        started = time.monotonic()
+        try:
+            run()
+            return restarts
+        except SystemExit as e:
+            if not e.code:
+                return restarts
+            error = e
+        except Exception as e:
+            error = e
+        uptime = time.monotonic() - started
+        try:
+            delay = policy.crashed(uptime)
+        except CrashLoop:
+            logger.critical(f"Бот упал после {uptime:.1f} с работы: {error!r}; цикл падений, перезапуски прекращены")
+            raise
+        restarts += 1
+        logger.error(
+            f"Бот упал после {uptime:.1f} с работы: {error!r}; перезапуск #{restarts} через {delay:.1f} с",
+            exc_info=error if not isinstance(error, SystemExit) else None,
+        )
+        sleep(delay)
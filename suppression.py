@@ -0,0 +1,73 @@
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden
+
+logger = logging.getLogger(__name__)
+
+# Заблокированные чаты хранятся в meta хранилища под ключами suppressed:<chat_id>
+META_PREFIX = 'suppressed:'
+
+
+class ChatSuppressed(Forbidden):
+    """Чат в списке подавления: запрос в Bot API не отправлялся"""
+
+
+def is_unreachable(error):
+    """Пользователь заблокировал бота или чат удалён — писать в него бессмысленно"""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and 'chat not found' in str(error).lower()
+
+
+class SuppressionList:
+    """Чаты, в которые не отправляем сообщения, пока пользователь снова не нажмёт /start.
+
+    На горячем пути — только проверка по множеству в памяти; запись в хранилище
+    идёт при добавлении и снятии, а это редкие события.
+    """
+
+    def __init__(self, store, on_suppressed=None):
+        # on_suppressed(chat_id) — вызывается при первой ошибке доставки в чат
+        self.store = store
+        self.on_suppressed = on_suppressed
+        self.chats = set()
+        self.skipped = 0
+
+    def load(self):
+        """Поднимает список из meta хранилища (после StateStore.open)"""
+        self.chats = {int(key[len(META_PREFIX):]) for key in self.store.meta if key.startswith(META_PREFIX)}
+        if self.chats:
+            logger.info(f"Чатов в списке подавления: {len(self.chats)}")
+
+    def __contains__(self, chat_id):
+        return chat_id in self.chats
+
+    def __len__(self):
+        return len(self.chats)
+
+    def check(self, chat_id):
+        """Отказ без запроса к Bot API, если чат в списке"""
+        if chat_id in self.chats:
+            self.skipped += 1
+            raise ChatSuppressed(f"Чат {chat_id} заблокировал бота")
+
+    def observe(self, chat_id, error):
+        """Разбирает ошибку отправки: недоступный чат попадает в список"""
+        if chat_id is None or chat_id in self.chats or not is_unreachable(error):
+            return
+        self.chats.add(chat_id)
+        self.store.set_meta(META_PREFIX + str(chat_id), {'reason': str(error), 'since': time.time()})
+        logger.info(
+            "Чат %s добавлен в список подавления: %s", chat_id, error,
+            extra={'event': 'chat_suppressed', 'chat_id': chat_id}
+        )
+        if self.on_suppressed is not None:
+            self.on_suppressed(chat_id)
+
+    def clear(self, chat_id):
+        """Снимает чат со списка (пользователь снова написал боту)"""
+        if chat_id in self.chats:
+            self.chats.discard(chat_id)
+            self.store.set_meta(META_PREFIX + str(chat_id), None)
+            logger.info("Чат %s снят со списка подавления", chat_id, extra={'event': 'chat_unsuppressed'})
@@ -0,0 +1,315 @@
+"""Несколько ботов (токен + курс) в одном процессе.
+
+BOT_TENANTS — путь к JSON со списком ботов:
+
+    [{"name": "python", "token": "123:ABC", "course": "courses/python.json",
+      "env": {"ADMIN_USER_IDS": "42"}}]
+
+Каждый бот — отдельный экземпляр модуля bot.py со своими user_states, курсом,
+хранилищем (STATE_DB_PATH.<name>), журналом аналитики и очередью отправки
+(лимиты Telegram считаются на токен). Лимиты отправки, сроки хранения и темп
+рассылок берутся из env бота; остальные настройки модулей (таймауты Bot API,
+профилировщик) — общие на процесс. Общие на процесс: цикл событий, импорт
+python-telegram-bot, пул HTTP соединений с Bot API, планировщик таймеров,
+HTTP сервер webhook (у каждого бота свой путь /telegram/<name>) и /metrics,
+где метрики ботов различаются меткой tenant.
+"""
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import time
+
+from telegram import Update
+from telegram.ext import TypeHandler
+from telegram.request import HTTPXRequest
+
+# Модули, общие для всех ботов, импортируются до загрузки первого из них: иначе
+# их настройки из окружения и метрики достались бы окружению и реестру первого бота
+import analytics  # noqa: F401
+import broadcast  # noqa: F401
+import course  # noqa: F401
+import mailboxes  # noqa: F401
+import media_cache  # noqa: F401
+import profiling  # noqa: F401
+import recorder  # noqa: F401
+import retention  # noqa: F401
+import sender  # noqa: F401
+import session  # noqa: F401
+import storage  # noqa: F401
+import suppression  # noqa: F401
+from http_server import HttpServer, Response
+from logs import bind_log_context, log_context
+from metrics import REGISTRY, Gauge, Registry, use_registry
+from scheduler import TimerScheduler
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_PATH = os.path.join(BASE_DIR, 'bot.py')
+
+# Общий пул соединений с Bot API на все боты процесса
+TENANT_POOL_SIZE = int(os.getenv('API_POOL_SIZE', '32'))
+# Как часто писать в лог потребление ресурсов по ботам, секунды (0 — не писать)
+TENANT_REPORT_INTERVAL = float(os.getenv('TENANT_REPORT_INTERVAL', '60'))
+
+_NAME_RE = re.compile(r'^[a-z0-9_]{1,32}$')
+
+
+class TenantError(ValueError):
+    """Описание ботов в BOT_TENANTS не прошло проверку"""
+
+
+def load_tenants_config(path):
+    """Читает и проверяет список ботов"""
+    with open(path, encoding='utf-8') as f:
+        try:
+            specs = json.load(f)
+        except json.JSONDecodeError as e:
+            raise TenantError(f'{path}: {e}') from e
+    if not isinstance(specs, list) or not specs:
+        raise TenantError(f'{path}: нужен непустой список ботов')
+    base_dir = os.path.dirname(os.path.abspath(path))
+    names = set()
+    for index, spec in enumerate(specs):
+        where = f'{path}[{index}]'
+        if not isinstance(spec, dict) or not spec.get('token') or not spec.get('course'):
+            raise TenantError(f'{where}: нужны token и course')
+        name = spec.get('name', '')
+        if not _NAME_RE.match(name):
+            raise TenantError(f'{where}: name — латиница в нижнем регистре, цифры и _, до 32 символов')
+        if name in names:
+            raise TenantError(f'{where}: имя {name} уже занято')
+        names.add(name)
+        spec['course'] = os.path.join(base_dir, spec['course'])
+        spec.setdefault('env', {})
+    return specs
+
+
+# ========== ОБЩИЕ РЕСУРСЫ ==========
+class SharedRequest(HTTPXRequest):
+    """HTTP клиент, общий для нескольких ботов: пул закрывается вместе с последним из них"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._users = 0
+
+    async def initialize(self):
+        self._users += 1
+        if self._users == 1:
+            await super().initialize()
+
+    async def shutdown(self):
+        self._users -= 1
+        if self._users == 0:
+            await super().shutdown()
+
+
+class SharedScheduler(TimerScheduler):
+    """Планировщик, общий для нескольких ботов: цикл останавливается вместе с последним из них"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._users = 0
+
+    def start(self):
+        self._users += 1
+        # Цикл запускается из post_init первого бота и унаследовал бы его контекст лога:
+        # таймеры всех ботов писали бы его имя. Поле tenant таймеру задаёт сам бот (bot.TENANT)
+        token = log_context.set(None)
+        try:
+            super().start()
+        finally:
+            log_context.reset(token)
+
+    async def stop(self, timeout=10):
+        self._users -= 1
+        if self._users > 0:
+            # Остальные боты продолжают работу: дожидаемся только колбэков в работе
+            if self._running:
+                await asyncio.wait(set(self._running), timeout=timeout)
+            return
+        await super().stop(timeout)
+
+
+# ========== БОТЫ ==========
+class Tenant:
+    __slots__ = ('name', 'module', 'registry', 'stop_event', 'updates', 'last_updates', 'last_sent')
+
+    def __init__(self, name, module, registry):
+        self.name = name
+        self.module = module
+        self.registry = registry
+        self.stop_event = asyncio.Event()
+        self.updates = 0
+        self.last_updates = 0
+        self.last_sent = 0
+
+    async def count_update(self, update, context):
+        self.updates += 1
+
+    def usage(self):
+        """Снимок потребления ресурсов ботом"""
+        bot = self.module
+        return {
+            'updates': self.updates,
+            'users': len(bot.user_states),
+            'sent': bot.outbound.sent,
+            'queue': bot.outbound.queue_depth,
+            'in_request': bot.outbound.in_request,
+            'suppressed': len(bot.suppressions),
+            'pending_writes': bot.state_store.pending_writes,
+        }
+
+
+class _Environ:
+    """Временно подменяет переменные окружения: bot.py читает настройки при импорте"""
+
+    def __init__(self, env):
+        self.env = env
+        self.saved = {}
+
+    def __enter__(self):
+        for key, value in self.env.items():
+            self.saved[key] = os.environ.get(key)
+            os.environ[key] = value
+
+    def __exit__(self, *exc):
+        for key, value in self.saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def tenant_env(spec):
+    """Настройки экземпляра bot.py: токен, курс и отдельные файлы состояния"""
+    name = spec['name']
+    state_path = os.getenv('STATE_DB_PATH', os.path.join(BASE_DIR, 'bot_state.db'))
+    root, ext = os.path.splitext(state_path)
+    env = {
+        'TELEGRAM_BOT_TOKEN': spec['token'],
+        'BOT_TENANT': name,
+        'COURSE_FILE': spec['course'],
+        'STATE_DB_PATH': f'{root}.{name}{ext}',
+        'ANALYTICS_DIR': os.path.join(os.getenv('ANALYTICS_DIR', os.path.join(BASE_DIR, 'analytics')), name),
+        'WEBHOOK_PATH': f"{os.getenv('WEBHOOK_PATH', '/telegram').rstrip('/')}/{name}",
+        'API_POOL_SIZE': str(TENANT_POOL_SIZE),
+        # /metrics всех ботов отдаёт общий сервер
+        'METRICS_PORT': '',
+    }
+    env.update({key: str(value) for key, value in spec['env'].items()})
+    return env
+
+
+def load_tenant(spec, scheduler):
+    """Загружает отдельный экземпляр модуля bot.py для бота"""
+    name = spec['name']
+    module_name = f'bot_tenant_{name}'
+    registry = Registry(labels=(('tenant', name),))
+    module_spec = importlib.util.spec_from_file_location(module_name, BOT_PATH)
+    module = importlib.util.module_from_spec(module_spec)
+    sys.modules[module_name] = module
+    try:
+        with _Environ(tenant_env(spec)), use_registry(registry):
+            module_spec.loader.exec_module(module)
+    except SystemExit:
+        # bot.py завершает процесс при ошибке в курсе; причина уже в логе
+        sys.modules.pop(module_name, None)
+        raise TenantError(f'бот {name}: не удалось загрузить') from None
+    module.scheduler = scheduler
+    tenant = Tenant(name, module, registry)
+    # Остальные метрики бота уже в его реестре и получают метку tenant
+    Gauge('bot_updates_received', 'Получено апдейтов', lambda: tenant.updates, registry=registry)
+    REGISTRY.include(registry)
+    return tenant
+
+
+def unload_tenant(tenant):
+    REGISTRY.exclude(tenant.registry)
+    sys.modules.pop(tenant.module.__name__, None)
+
+
+def log_usage(tenants, interval):
+    for tenant in tenants:
+        usage = tenant.usage()
+        updates_rate = (tenant.updates - tenant.last_updates) / interval
+        sent_rate = (usage['sent'] - tenant.last_sent) / interval
+        tenant.last_updates, tenant.last_sent = tenant.updates, usage['sent']
+        logger.info(
+            f"Бот {tenant.name}: апдейтов {updates_rate:.1f}/с, отправок {sent_rate:.1f}/с, "
+            f"пользователей {usage['users']}, в очереди {usage['queue']}, "
+            f"запросов в ожидании ответа {usage['in_request']}, заблокировали {usage['suppressed']}",
+            extra={'event': 'tenant_usage', 'tenant': tenant.name},
+        )
+
+
+async def run_tenants(specs, stop_signals=(signal.SIGINT, signal.SIGTERM)):
+    """Запускает всех ботов в текущем цикле событий; ошибка одного останавливает всех"""
+    scheduler = SharedScheduler()
+    request = SharedRequest(connection_pool_size=TENANT_POOL_SIZE, pool_timeout=5.0)
+    started = time.perf_counter()
+    tenants = [load_tenant(spec, scheduler) for spec in specs]
+    logger.info(f"Загружено ботов: {len(tenants)} за {time.perf_counter() - started:.2f} с")
+
+    def stop_all():
+        for tenant in tenants:
+            tenant.stop_event.set()
+
+    loop = asyncio.get_running_loop()
+    for sig in stop_signals:
+        loop.add_signal_handler(sig, stop_all)
+
+    server = None
+    if any(tenant.module.BOT_MODE == 'webhook' for tenant in tenants):
+        server = HttpServer(os.getenv('WEBHOOK_LISTEN', '0.0.0.0'), int(os.getenv('PORT', '8080')))
+        await server.start()
+    metrics_server = None
+    if os.getenv('METRICS_PORT'):
+        async def metrics_handler(request):
+            return Response(200, REGISTRY.render(), 'text/plain; version=0.0.4; charset=utf-8')
+
+        metrics_server = HttpServer('0.0.0.0', int(os.getenv('METRICS_PORT')))
+        metrics_server.route('GET', '/metrics', metrics_handler)
+        await metrics_server.start()
+
+    async def run_tenant(tenant):
+        # Поле tenant попадает во все записи лога задач этого бота
+        bind_log_context(tenant=tenant.name)
+
+        def setup(application):
+            application.add_handler(TypeHandler(Update, tenant.count_update), group=-1)
+
+        await tenant.module.run(tenant.stop_event, (), request, server, setup)
+
+    async def report():
+        while True:
+            await asyncio.sleep(TENANT_REPORT_INTERVAL)
+            log_usage(tenants, TENANT_REPORT_INTERVAL)
+
+    tasks = [loop.create_task(run_tenant(tenant), name=f'tenant-{tenant.name}') for tenant in tenants]
+    reporter = loop.create_task(report()) if TENANT_REPORT_INTERVAL > 0 else None
+    try:
+        for finished in asyncio.as_completed(tasks):
+            try:
+                await finished
+            except Exception:
+                # Бот упал — останавливаем остальных, перезапуском всего процесса займётся supervisor
+                stop_all()
+                raise
+            # Один бот остановился штатно (сигнал) — останавливаются и остальные
+            stop_all()
+    finally:
+        stop_all()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if reporter is not None:
+            reporter.cancel()
+        for http in (server, metrics_server):
+            if http is not None:
+                await http.stop()
+        for tenant in tenants:
+            unload_tenant(tenant)